@@ -1,17 +1,35 @@
 # Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
 # vim: ts=4 sw=4 
-from typing import (Optional)
+from typing import (Any, Optional)
 from serial import Serial
+import os
 import sys
 import traceback
 
+import rattlebox.archive as archive
+import rattlebox.capture as capture
+import rattlebox.command as command
+import rattlebox.dump as dump
+import rattlebox.follow as follow
 import rattlebox.gpx as gpx
+import rattlebox.index as index
+import rattlebox.metrics as metrics
 import rattlebox.nmea as nmea
 import rattlebox.mt3339 as mt3339
 import rattlebox.options as options
+import rattlebox.reader as reader
+import rattlebox.segment as segment
+import rattlebox.simplify as simplify
 
 RATTLEBOX = "rattlebox"
 
+if len(sys.argv) > 1 and sys.argv[1] == "convert":
+    import rattlebox.convert as convert
+    sys.exit(convert.main(sys.argv[2:]))
+if len(sys.argv) > 1 and sys.argv[1] == "serve":
+    import rattlebox.server as server
+    sys.exit(server.main(sys.argv[2:]))
+
 try:
     opts = options.Options.from_args(sys.argv[1:])
 except Exception as e:
@@ -27,50 +45,180 @@ if opts.help:
 if opts.debug:
     print(f"[options] {opts}", sys.stderr)
 
+port:Any = None
+recorder:Optional[capture.Recorder] = None
 try:
-    port = Serial(opts.device, opts.baudrate, timeout=opts.timeout)
-    if (port.is_open == False):
-        port.open()
-    port.flush()
+    if opts.replay is not None:
+        port = capture.ReplayPort(opts.replay, speed=opts.replay_speed, timeout=opts.timeout)
+    else:
+        port = Serial(opts.device, opts.baudrate, timeout=opts.timeout)
+        if (port.is_open == False):
+            port.open()
+        port.flush()
+    if opts.capture is not None:
+        recorder = capture.Recorder(opts.capture, opts.baudrate)
+        port = capture.CapturePort(port, recorder)
 except Exception as e:
     print(f"failed to open serial device: {type(e)} {e}")
     sys.exit(2)
 
+# When streaming, keep a manifest next to the log file, so that an
+# interrupted dump can be resumed. An explicit manifest makes this a delta
+# dump: only chunks that are not in the manifest are written.
+manifest:Optional[dump.Manifest] = None
+if opts.manifest is not None:
+    manifest = dump.Manifest.load(opts.manifest)
+elif opts.stream:
+    path = f"{opts.logfile}.manifest"
+    manifest = dump.Manifest.load(path) if opts.resume else dump.Manifest(path)
+
+rules = opts.rules if opts.segment else None
+outings:Optional[segment.OutingFiles] = None
+if opts.split and opts.logfile is not None:
+    outings = segment.OutingFiles(opts.logfile)
+
+sink:Optional[dump.Sink] = None
+if opts.stream and opts.logfile is not None:
+    committed = manifest.committed if manifest is not None else 0
+    if outings is not None:
+        sink = dump.SegmentSink(outings, rules)
+    elif archive.is_archive(opts.logfile):
+        sink = dump.ArchiveSink(opts.logfile, resume=opts.resume, committed=committed)
+    else:
+        sink = dump.GPXSink(opts.logfile, resume=opts.resume, committed=committed, rules=rules)
+
+meter = metrics.Metrics() if opts.metrics is not None else None
+profiler = metrics.Profiler(opts.profile, opts.trace_malloc)
+profiler.start()
+
+driver = mt3339.Driver(port,debug=opts.debug,show_prog=opts.show_prog,sink=sink,manifest=manifest,metrics=meter)
+driver.commands.timeout = opts.command_timeout
+driver.commands.retries = opts.retries
+driver.commands.window = opts.pipeline
+# a capture only has the responses to the commands that were sent when it
+# was recorded
+driver.plan_dumps = opts.replay is None
+if opts.auto_baud and opts.replay is None:
+    try:
+        rate = driver.negotiate_baud()
+        print(f"using {rate} baud", file=sys.stderr)
+    except Exception as e:
+        print(f"failed to negotiate baud rate: {e}", file=sys.stderr)
+        port.close()
+        sys.exit(2)
+# drain the port on a background thread, so that decoding and output
+# don't hold up reading from the device
+rdr = reader.Reader(port, metrics=meter)
+follower:Optional[follow.Follower] = None
+rdr.start()
+
+def next_batch(timeout:float) -> list[bytes]:
+    return rdr.get_batch(timeout=timeout)
+
 try:
-    driver = mt3339.Driver(port,debug=opts.debug,show_prog=opts.show_prog)
+    # send the commands (independent ones without waiting for each other's
+    # acknowledgements), and process their responses
+    requests:list[command.Request] = []
     for cmd in opts.commands:
-        driver.send_command(cmd)
-        if cmd.startswith("baud-"):
-            # Will not get a reasonable response when changing baud
-            # TODO: reopen serial port using new baud rate
-            pass
+        if cmd.startswith("baud-") and opts.replay is None:
+            # no reasonable response when changing baud; switch the port,
+            # too, and make sure that the device is still there
+            driver.run_commands(next_batch)
+            if any(not req.ok() for req in requests):
+                break
+            rdr.stop()
+            rate = int(cmd[5:])
+            if not driver.set_baud(rate):
+                print(f"device did not respond at {rate} baud; staying at {port.baudrate} baud", file=sys.stderr)
+            rdr.start()
         else:
-            # process command response packets
-            while driver.is_command_active():
-                driver.recv_message(port.readline())
-    # write the log as GPX, if there is one
-    doc = driver.get_log_as_gpx()
+            requests.append(driver.submit_command(cmd))
+    driver.run_commands(next_batch)
+    failed = [ req for req in requests if not req.ok() ]
+    for req in failed:
+        print(f"command {req.cmd} {req.status()}" + (f" (sent {req.tries} times)" if req.tries > 1 else ""), file=sys.stderr)
+    # write the log as an archive (straight from the points), or as GPX, if
+    # there is one
+    doc:Optional[gpx.Document] = None
+    if opts.logfile is not None and archive.is_archive(opts.logfile):
+        if len(driver.log_points) > 0:
+            print(f"writing log to archive {opts.logfile}", file=sys.stderr)
+            archive.write(opts.logfile, driver.log_points)
+            driver.commit()
+    else:
+        doc = driver.get_log_as_gpx(rules)
     if doc is not None:
-        gpx_str = doc.to_xml()
-        if opts.logfile is None:
-            sys.stdout.write(gpx_str)
+        if opts.simplify > 0:
+            n = len(driver.log_points)
+            dropped = simplify.simplify_document(doc, opts.simplify, opts.simplify_method)
+            print(f"simplified log: dropped {dropped} of {n} points", file=sys.stderr)
+        if outings is not None:
+            segment.write(doc, outings)
+        elif opts.logfile is None:
+            doc.write(sys.stdout)
         else:
             print(f"writing log to GPX file {opts.logfile}", file=sys.stderr)
-            with open(opts.logfile, 'w') as out:
-                out.write(gpx_str)
-    # if follow is enabled, continue processing messages from the device
-    while opts.follow:
-        driver.recv_message(port.readline())
-        loc = driver.get_loc()
-        if loc is not None:
-            print(f"\r{loc}    ",file=sys.stderr)
+            with open(opts.logfile, 'wb') as out:
+                doc.write(out)
+        driver.commit()
+    # add the log to the index, once it is complete: if all of the commands
+    # went through, and the sink (if any) has finished writing it
+    if opts.index is not None and opts.logfile is not None and "logger-dump" in opts.commands and len(failed) > 0:
+        print(f"not indexing {opts.logfile}: the log dump did not complete", file=sys.stderr)
+    elif opts.index is not None and opts.logfile is not None and "logger-dump" in opts.commands:
+        if sink is not None:
+            driver.commit()
+            sink.close()
+            sink = driver.sink = None
+        paths = outings.paths if outings is not None else [ opts.logfile ]
+        with index.Index(opts.index) as idx:
+            for path in paths:
+                if os.path.exists(path):
+                    n = idx.add_file(path, delta=opts.manifest is not None)
+                    print(f"indexed {n} points from {path} in {opts.index}", file=sys.stderr)
+    if len(failed) > 0:
+        sys.exit(4)
+    # if follow is enabled, continue processing messages from the device,
+    # publishing each epoch as soon as it is complete; when following, drop
+    # lines rather than fall behind
+    rdr.block = False
+    if opts.follow:
+        follower = follow.Follower(follow.make_sinks(opts.following, sys.stdout), opts.following, meter)
+        driver.on_fix = follower.add
+        driver.nmea.early = True
+        while True:
+            driver.recv_messages(rdr.get_batch(timeout=follower.wait(0.5)))
+            follower.poll()
+            if meter is not None and opts.metrics is not None and meter.due(opts.metrics_interval):
+                meter.dump(opts.metrics, reader=rdr.stats.to_dict())
 except KeyboardInterrupt as e:
     pass
+except EOFError as e:
+    # replay reached the end of the capture
+    if driver.is_command_active():
+        print(f"{e}: command did not complete: {driver.cmd}",file=sys.stderr)
 except Exception as e:
     print(f"unexpected exception caught: {type(e)} {e}",file=sys.stderr)
     if opts.debug:
         print(traceback.format_exc())
     sys.exit(3)
 finally:
+    rdr.stop(timeout=opts.timeout)
+    if opts.debug:
+        print(f"[reader] {rdr.stats}", file=sys.stderr)
+    profiler.stop()
+    if meter is not None and opts.metrics is not None:
+        meter.dump(opts.metrics, reader=rdr.stats.to_dict())
+    if follower is not None:
+        follower.close()
+    if sink is not None:
+        # record whatever we've got, so that an interrupted dump can be resumed
+        driver.commit()
+        sink.close()
+    if outings is not None and len(outings.paths) > 0:
+        print(f"wrote {len(outings.paths)} outing(s): {', '.join(outings.paths)}", file=sys.stderr)
     port.close()
+    if recorder is not None:
+        print(f"captured {recorder.bytes} bytes to {recorder.path}", file=sys.stderr)
+        recorder.close()
 
@@ -0,0 +1,293 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+asyncio driver for the MT3339.
+
+AsyncDriver wraps mt3339.Driver (which does the parsing) around a pluggable
+async byte-stream Transport, so that one event loop can service many devices.
+Commands go through the driver's command.Pipeline: independent ones are
+pipelined, and each is retried until it is acknowledged (or times out).
+"""
+
+from typing import (Any, AsyncIterator, Optional, Self)
+from abc import (ABC, abstractmethod)
+import asyncio
+import os
+import rattlebox.command as cmdq
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+
+class Transport(ABC):
+    """
+    An async byte stream to/from a device
+    """
+    interactive = True # the device responds to what is written (a replay does not)
+
+    @abstractmethod
+    async def read(self, n:int) -> bytes:
+        """
+        Read up to n bytes; returns b'' at end of stream
+        """
+
+    @abstractmethod
+    async def write(self, data:bytes) -> None:
+        """
+        Write all of data
+        """
+
+    async def close(self) -> None:
+        pass
+
+class MemoryTransport(Transport):
+    """
+    In-memory transport; see pair()
+    """
+    def __init__(self) -> None:
+        self.inbox:asyncio.Queue[bytes] = asyncio.Queue()
+        self.buf = b'' # data received, but not read yet
+        self.peer:Optional[MemoryTransport] = None
+        self.closed = False
+
+    @classmethod
+    def pair(cls) -> tuple[Self,Self]:
+        """
+        Create two connected transports: what is written to one can be read
+        from the other.
+        """
+        a, b = cls(), cls()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def read(self, n:int) -> bytes:
+        if len(self.buf) == 0:
+            if self.closed:
+                return b''
+            # an empty message means that the other end was closed
+            self.buf = await self.inbox.get()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    async def write(self, data:bytes) -> None:
+        if self.closed or self.peer is None:
+            raise IOError("transport is closed")
+        if len(data) > 0:
+            self.peer.inbox.put_nowait(bytes(data))
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # wake up readers at both ends
+        self.inbox.put_nowait(b'')
+        if self.peer is not None:
+            self.peer.inbox.put_nowait(b'')
+
+class FdTransport(Transport):
+    """
+    Transport over a (non-blocking) file descriptor, such as a pty or an
+    open serial port (see open_serial).
+    """
+    def __init__(self, fd:int, owner:Any = None):
+        self.fd = fd
+        self.owner = owner # object that owns the fd (closed with the transport)
+        os.set_blocking(fd, False)
+
+    @classmethod
+    def open_serial(cls, device:str, baudrate:int) -> Self:
+        from serial import Serial
+        import termios
+        port = Serial(device, baudrate, timeout=0)
+        # pyserial leaves VMIN at 0, so a read with no data would return b''
+        # (end of stream) rather than fail with EAGAIN
+        attrs = termios.tcgetattr(port.fileno())
+        attrs[6][termios.VMIN] = 1
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(port.fileno(), termios.TCSANOW, attrs)
+        return cls(port.fileno(), port)
+
+    async def read(self, n:int) -> bytes:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return os.read(self.fd, n)
+            except BlockingIOError:
+                pass
+            except OSError:
+                # e.g., EIO on a pty whose other end has been closed
+                return b''
+            ready = loop.create_future()
+            loop.add_reader(self.fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(self.fd)
+
+    async def write(self, data:bytes) -> None:
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                n = os.write(self.fd, view)
+                view = view[n:]
+                continue
+            except BlockingIOError:
+                pass
+            ready = loop.create_future()
+            loop.add_writer(self.fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(self.fd)
+
+    async def close(self) -> None:
+        if self.owner is not None:
+            self.owner.close()
+        else:
+            os.close(self.fd)
+
+class AsyncDriver:
+    """
+    asyncio MT3339 driver.
+    Call start() to begin processing messages from the device.
+    """
+    def __init__(self, transport:Transport, debug:bool = False, sink:Optional[dump.Sink] = None,
+                 manifest:Optional[dump.Manifest] = None, read_size:int = 4096, max_fixes:int = 256,
+                 timeout:float = 2, retries:int = 2):
+        self.transport = transport
+        self.driver = mt3339.Driver(None, debug=debug, show_prog=False, sink=sink, manifest=manifest)
+        self.driver.commands.timeout = timeout
+        self.driver.commands.retries = retries
+        self.driver.commands.on_done = self._done
+        self.driver.plan_dumps = transport.interactive
+        self.read_size = read_size
+        self.fixes_queue:asyncio.Queue[Optional[gpx.Point]] = asyncio.Queue(max_fixes)
+        self.pending:dict[cmdq.Request,asyncio.Future[cmdq.Request]] = {} # completion of the submitted commands
+        self.wakeup = asyncio.Event() # there may be commands to send
+        self.task:Optional[asyncio.Task[None]] = None
+        self.sender:Optional[asyncio.Task[None]] = None
+        self.closed = False
+
+    async def __aenter__(self) -> Self:
+        self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        if self.sender is None:
+            self.sender = asyncio.create_task(self._send())
+
+    async def close(self) -> None:
+        for task in (self.task, self.sender):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = self.sender = None
+        await self.transport.close()
+        self._closed()
+
+    async def send_command(self, cmd:str) -> asyncio.Future[cmdq.Request]:
+        """
+        Submit a command. It is sent when it is due (see command.Pipeline);
+        returns a future that completes with the request, when the device has
+        acknowledged it ($PMTK001; see its flag), or it timed out.
+        """
+        if self.closed:
+            raise IOError("driver is closed")
+        req = self.driver.submit_command(cmd)
+        fut:asyncio.Future[cmdq.Request] = asyncio.get_running_loop().create_future()
+        self.pending[req] = fut
+        self.wakeup.set()
+        return fut
+
+    async def command(self, cmd:str) -> cmdq.Request:
+        """
+        Send a command, and wait for it to complete; raises an exception if
+        it did not succeed
+        """
+        req = await (await self.send_command(cmd))
+        if not req.ok():
+            raise Exception(f"command {cmd} {req.status()}")
+        return req
+
+    def _done(self, req:cmdq.Request) -> None:
+        fut = self.pending.pop(req, None)
+        if fut is not None and not fut.done():
+            fut.set_result(req)
+        # the next ones may be due
+        self.wakeup.set()
+
+    async def fixes(self) -> AsyncIterator[gpx.Point]:
+        """
+        Iterate over the fixes (GGA locations) reported by the device.
+        If fixes are not consumed fast enough, the oldest ones are dropped.
+        """
+        while True:
+            pt = await self.fixes_queue.get()
+            if pt is None:
+                return
+            yield pt
+
+    async def _run(self) -> None:
+        buf = b''
+        try:
+            while True:
+                data = await self.transport.read(self.read_size)
+                if not data:
+                    break
+                sentences, buf = nmea.parse_many(buf + data)
+                for status, fields in sentences:
+                    if status == nmea.OK:
+                        self._recv(fields)
+                    elif self.driver.metrics is not None:
+                        self.driver.metrics.count(f"nmea.{nmea.STATUS_NAMES[status]}")
+        finally:
+            self._closed()
+
+    async def _send(self) -> None:
+        """
+        Send the commands that are due, until the connection is closed
+        """
+        pipeline = self.driver.commands
+        try:
+            while not self.closed:
+                self.wakeup.clear()
+                for msg in self.driver.due():
+                    await self.transport.write(msg)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), pipeline.wait(1))
+                except TimeoutError:
+                    pass
+        except IOError:
+            self._closed()
+
+    def _recv(self, fields:list[str]) -> None:
+        loc = self.driver.loc
+        self.driver.recv_sentence(fields)
+        if self.driver.loc is not loc and self.driver.loc is not None:
+            self._put_fix(self.driver.loc)
+
+    def _put_fix(self, pt:Optional[gpx.Point]) -> None:
+        if self.fixes_queue.full():
+            self.fixes_queue.get_nowait()
+        self.fixes_queue.put_nowait(pt)
+
+    def _closed(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(IOError("connection to device was closed"))
+        self.driver.commands.clear()
+        self.wakeup.set()
+        self._put_fix(None)
@@ -0,0 +1,223 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Track analytics: distance, speed, elevation gain/loss, and moving time.
+
+The per-point functions (distances, cumulative, speeds) work on whole
+columns at a time. Summary statistics are computed by an Accumulator, which
+can be fed a track in pieces (e.g., while the log is being dumped), so that
+no second pass over the data is needed. See also gpx.Segment.stats, which
+caches the statistics of a segment until it changes.
+"""
+
+from typing import (Callable, Optional)
+from array import array
+from dataclasses import dataclass
+import itertools
+import math
+import rattlebox.gpx as gpx
+
+EARTH_RADIUS = 6371008.8 # meters (mean)
+
+# WGS-84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+MIN_SPEED = 0.5 # meters per second; slower than this is stopped
+MAX_GAP = 300 # seconds; longer gaps between points are neither moving nor stopped
+HYSTERESIS = 5 # meters; elevation changes smaller than this are ignored
+
+def haversine(lat1:float, lon1:float, lat2:float, lon2:float) -> float:
+    """
+    Great circle distance (meters) between two points (decimal degrees)
+    """
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    h = math.sin(dp/2)**2 + math.cos(p1) * math.cos(p2) * math.sin(dl/2)**2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+def vincenty(lat1:float, lon1:float, lat2:float, lon2:float) -> float:
+    """
+    Distance (meters) between two points (decimal degrees) on the WGS-84
+    ellipsoid, using Vincenty's inverse formula. Falls back to haversine for
+    (nearly) antipodal points, where the formula does not converge.
+    """
+    if lat1 == lat2 and lon1 == lon2:
+        return 0.0
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+    L = math.radians(lon2 - lon1)
+    U1 = math.atan((1-f) * math.tan(math.radians(lat1)))
+    U2 = math.atan((1-f) * math.tan(math.radians(lat2)))
+    sinU1, cosU1 = math.sin(U1), math.cos(U1)
+    sinU2, cosU2 = math.sin(U2), math.cos(U2)
+    lam = L
+    for _ in range(100):
+        sinLam, cosLam = math.sin(lam), math.cos(lam)
+        sinSigma = math.hypot(cosU2*sinLam, cosU1*sinU2 - sinU1*cosU2*cosLam)
+        if sinSigma == 0:
+            return 0.0
+        cosSigma = sinU1*sinU2 + cosU1*cosU2*cosLam
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU1*cosU2*sinLam / sinSigma
+        cos2Alpha = 1 - sinAlpha*sinAlpha
+        cos2SigmaM = cosSigma - 2*sinU1*sinU2/cos2Alpha if cos2Alpha != 0 else 0
+        C = f/16 * cos2Alpha * (4 + f*(4 - 3*cos2Alpha))
+        prev = lam
+        lam = L + (1-C) * f * sinAlpha * (sigma + C*sinSigma*(cos2SigmaM + C*cosSigma*(-1 + 2*cos2SigmaM*cos2SigmaM)))
+        if abs(lam - prev) < 1e-12:
+            break
+    else:
+        return haversine(lat1, lon1, lat2, lon2)
+    u2 = cos2Alpha * (a*a - b*b) / (b*b)
+    A = 1 + u2/16384 * (4096 + u2*(-768 + u2*(320 - 175*u2)))
+    B = u2/1024 * (256 + u2*(-128 + u2*(74 - 47*u2)))
+    dSigma = B*sinSigma*(cos2SigmaM + B/4*(cosSigma*(-1 + 2*cos2SigmaM*cos2SigmaM) -
+             B/6*cos2SigmaM*(-3 + 4*sinSigma*sinSigma)*(-3 + 4*cos2SigmaM*cos2SigmaM)))
+    return b * A * (sigma - dSigma)
+
+METHODS:dict[str,Callable[[float,float,float,float],float]] = {
+    "haversine": haversine,
+    "vincenty": vincenty,
+}
+
+def distances(points:gpx.Points, method:str = "haversine") -> array:
+    """
+    Distance (meters) from each point to the next (n-1 values)
+    """
+    _, lat, lon, _, _ = points.columns()
+    if method == "haversine":
+        # inlined, for speed
+        k = math.pi / 180
+        rlat = [ v * k for v in lat ]
+        rlon = [ v * k for v in lon ]
+        cos = [ math.cos(v) for v in rlat ]
+        sin, asin, sqrt = math.sin, math.asin, math.sqrt
+        d = 2 * EARTH_RADIUS
+        return array('d', [ d * asin(min(1.0, sqrt(sin((p2-p1)/2)**2 + c1*c2*sin((l2-l1)/2)**2)))
+                            for p1, p2, l1, l2, c1, c2 in zip(rlat, rlat[1:], rlon, rlon[1:], cos, cos[1:]) ])
+    dist = METHODS[method]
+    return array('d', map(dist, lat, lon, lat[1:], lon[1:]))
+
+def cumulative(dist:array) -> array:
+    """
+    Cumulative distance at each point (n values, starting at 0), given
+    the distances between points
+    """
+    return array('d', itertools.accumulate(dist, initial=0.0))
+
+def speeds(points:gpx.Points, dist:Optional[array] = None) -> array:
+    """
+    Speed (meters per second) from each point to the next (n-1 values);
+    0 where the time does not advance
+    """
+    ts = points.columns()[0]
+    if dist is None:
+        dist = distances(points)
+    return array('d', [ d / (t2 - t1) if t2 > t1 else 0.0 for d, t1, t2 in zip(dist, ts, ts[1:]) ])
+
+@dataclass
+class Stats:
+    """
+    Summary statistics of a track
+    """
+    points:int = 0
+    distance:float = 0 # meters
+    elapsed:int = 0 # seconds, from the first point to the last
+    moving_time:int = 0 # seconds
+    stopped_time:int = 0 # seconds
+    gain:float = 0 # meters of elevation gained
+    loss:float = 0 # meters of elevation lost
+    max_speed:float = 0 # meters per second
+
+    def avg_speed(self) -> float:
+        """
+        Average speed while moving (meters per second)
+        """
+        return self.distance / self.moving_time if self.moving_time > 0 else 0
+
+    def merge(self, other:'Stats') -> 'Stats':
+        """
+        Combine the statistics of two tracks (or segments)
+        """
+        return Stats(self.points + other.points, self.distance + other.distance,
+                     self.elapsed + other.elapsed, self.moving_time + other.moving_time,
+                     self.stopped_time + other.stopped_time, self.gain + other.gain,
+                     self.loss + other.loss, max(self.max_speed, other.max_speed))
+
+    def __str__(self) -> str:
+        return (f"{self.points} points, {self.distance/1000:.2f} km in {format_duration(self.elapsed)}" +
+                f" (moving {format_duration(self.moving_time)}, stopped {format_duration(self.stopped_time)})," +
+                f" avg {self.avg_speed()*3.6:.1f} km/h, max {self.max_speed*3.6:.1f} km/h," +
+                f" +{self.gain:.0f} m / -{self.loss:.0f} m")
+
+def format_duration(secs:int) -> str:
+    return f"{secs//3600}:{secs//60%60:02d}:{secs%60:02d}"
+
+class Accumulator:
+    """
+    Computes the statistics of a track that is given in pieces (in order)
+    """
+    def __init__(self, method:str = "haversine", min_speed:float = MIN_SPEED,
+                 max_gap:int = MAX_GAP, hysteresis:float = HYSTERESIS):
+        if method not in METHODS:
+            raise Exception(f"unknown distance method: {method}")
+        self.method = method
+        self.min_speed = min_speed
+        self.max_gap = max_gap
+        self.hysteresis = hysteresis
+        self.totals = Stats()
+        self.first_ts:Optional[int] = None
+        self.last:Optional[gpx.Points] = None # last point seen
+        self.ref_ele:Optional[int] = None # reference elevation (for hysteresis)
+
+    def add(self, points:gpx.Points) -> None:
+        n = len(points)
+        if n == 0:
+            return
+        s = self.totals
+        s.points += n
+        # include the last point of the previous piece
+        pts = points
+        if self.last is not None:
+            pts = gpx.Points()
+            pts.extend(self.last)
+            pts.extend(points)
+        self.last = points[n-1:]
+        ts, _, _, ele, _ = pts.columns()
+        if self.first_ts is None:
+            self.first_ts = ts[0]
+        s.elapsed = ts[-1] - self.first_ts
+        dist = distances(pts, self.method)
+        s.distance += math.fsum(dist)
+        # moving and stopped time (gaps count as neither)
+        gap = self.max_gap
+        steps = [ (d, t2 - t1) for d, t1, t2 in zip(dist, ts, ts[1:]) if 0 < t2 - t1 <= gap ]
+        moving = [ (d, dt) for d, dt in steps if d >= self.min_speed * dt ]
+        moving_time = sum([ dt for _, dt in moving ])
+        s.moving_time += moving_time
+        s.stopped_time += sum([ dt for _, dt in steps ]) - moving_time
+        s.max_speed = max(s.max_speed, max([ d / dt for d, dt in moving ], default=0))
+        # elevation, with hysteresis
+        ref = self.ref_ele if self.ref_ele is not None else ele[0]
+        h = self.hysteresis
+        for e in ele:
+            if e - ref >= h:
+                s.gain += e - ref
+                ref = e
+            elif ref - e >= h:
+                s.loss += ref - e
+                ref = e
+        self.ref_ele = ref
+
+    def stats(self) -> Stats:
+        return Stats(**vars(self.totals))
+
+def stats(points:gpx.Points, method:str = "haversine") -> Stats:
+    """
+    Statistics of a sequence of points
+    """
+    acc = Accumulator(method)
+    acc.add(points)
+    return acc.stats()
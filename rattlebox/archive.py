@@ -0,0 +1,438 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Rattlebox archive format (.rbx): a compact, binary, column-oriented store
+of logged points.
+
+The file starts with a header:
+* Magic - 8 bytes - b'RBXARC\\x00\\x01'
+* Creation time (Unix/epoch, nanoseconds) - 8 bytes - signed long long
+followed by blocks of (at most BLOCK_POINTS) points. Each block has a
+64 byte header:
+* Magic - 4 bytes - b'RBXB'
+* Number of points (n) - 4 bytes - unsigned long
+* Flags - 1 byte - COMPRESSED
+* (padding) - 3 bytes
+* Size of the data - 4 bytes - unsigned long
+* Min/max timestamp - 2 x 4 bytes - unsigned long
+* Min/max latitude, min/max longitude - 4 x 8 bytes - double
+* Min/max elevation - 2 x 4 bytes - signed long
+followed by the data, padded to a multiple of 8 bytes: the columns of the
+block, one after the other
+* Latitudes - n x 8 bytes - double
+* Longitudes - n x 8 bytes - double
+* Timestamps (Unix/epoch) - n x 4 bytes - unsigned long
+* Elevations - n x 4 bytes - signed long
+* Fix types - n x 1 byte
+(Values are little-endian)
+If the block is COMPRESSED, each column is delta encoded (as unsigned
+integers of the same width, wrapping around), and the columns are
+compressed together with zlib.
+
+An archive is read through mmap; the columns of an uncompressed block are
+views of the file (no copy). The min/max values in the block headers let
+a reader skip the blocks that can't match a query (see Archive.read), and
+exporting (see to_gpx, to_geojson, to_csv) works one block at a time.
+Blocks are only ever appended, so an interrupted write (see ArchiveWriter)
+leaves a readable archive, and can be resumed.
+"""
+
+from typing import (Any, BinaryIO, Callable, Iterable, Iterator, Optional, Self, TextIO)
+from array import array
+from dataclasses import dataclass
+from itertools import (accumulate, chain)
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+import rattlebox.gpx as gpx
+
+MAGIC = b'RBXARC\x00\x01'
+HEADER = struct.Struct('<8sq')
+BLOCK_MAGIC = b'RBXB'
+BLOCK = struct.Struct('<4sIB3xI2I4d2i')
+BLOCK_POINTS = 4096
+COMPRESSED = 0x01
+EXT = ".rbx"
+
+# column layout: (typecode, unsigned typecode of the same width, for deltas)
+COLUMNS = (('d','Q'), ('d','Q'), ('I','I'), ('i','I'), ('B','B'))
+POINT_SIZE = sum(array(t).itemsize for t, _ in COLUMNS) # 25
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+def is_archive(path:str) -> bool:
+    """
+    Whether the path names an archive (by its extension)
+    """
+    return path.endswith(EXT)
+
+@dataclass
+class Block:
+    """
+    A block of an archive: where its data is, and its min/max values
+    """
+    offset:int # of the data
+    n:int # number of points
+    flags:int
+    size:int # of the data
+    ts_min:int
+    ts_max:int
+    lat_min:float
+    lat_max:float
+    lon_min:float
+    lon_max:float
+    ele_min:int
+    ele_max:int
+
+    def end(self) -> int:
+        """
+        Offset of the next block
+        """
+        return self.offset + _align(self.size)
+
+def _align(size:int) -> int:
+    return (size + 7) & ~7
+
+def encode(points:gpx.Points, compress:bool = True, level:int = 6) -> bytes:
+    """
+    Encode points as a block (header and data)
+    """
+    n = len(points)
+    ts, lat, lon, ele, fix = points.columns()
+    cols = [ lat, lon, ts, ele, fix ]
+    if compress:
+        parts = []
+        for col, (_, utype) in zip(cols, COLUMNS):
+            u = array(utype, col.tobytes()) if col.typecode != utype else col
+            mask = (1 << (8 * u.itemsize)) - 1
+            parts.append(array(utype, [ (v - p) & mask for p, v in zip(chain((0,), u), u) ]))
+        data = _to_bytes(parts)
+        data = zlib.compress(data, level)
+        flags = COMPRESSED
+    else:
+        data = _to_bytes(cols)
+        flags = 0
+    header = BLOCK.pack(BLOCK_MAGIC, n, flags, len(data), min(ts), max(ts), min(lat), max(lat),
+                        min(lon), max(lon), min(ele), max(ele))
+    return header + data + bytes(_align(len(data)) - len(data))
+
+def _to_bytes(cols:list[array]) -> bytes:
+    if BIG_ENDIAN:
+        cols = [ array(col.typecode, col) for col in cols ]
+        for col in cols:
+            col.byteswap()
+    return b''.join([ col.tobytes() for col in cols ])
+
+class ArchiveWriter:
+    """
+    Write points to an archive, in blocks of block_points points (the last
+    block, and any block written by flush, may be smaller).
+    If append is set (and the archive exists), points are appended to it,
+    after its last complete block at or before the committed offset (if >0).
+    """
+    def __init__(self, path:str, compress:bool = True, block_points:int = BLOCK_POINTS,
+                 append:bool = False, committed:int = 0):
+        self.path = path
+        self.compress = compress
+        self.block_points = block_points
+        self.pending = gpx.Points() # points that have not been written yet
+        self.points = 0 # number of points written
+        self.blocks = 0 # number of blocks written
+        if append and os.path.exists(path):
+            with Archive(path) as archive:
+                pos = HEADER.size
+                for block in archive.blocks:
+                    if committed > 0 and block.end() > committed:
+                        break
+                    pos = block.end()
+            self.out:Optional[BinaryIO] = open(path, 'r+b')
+            self.out.truncate(pos)
+            self.out.seek(pos)
+        else:
+            self.out = open(path, 'wb')
+            self.out.write(HEADER.pack(MAGIC, time.time_ns()))
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, points:gpx.Points) -> None:
+        self.pending.extend(points)
+        bp = self.block_points
+        n = len(self.pending)
+        if n < bp:
+            return
+        for i in range(0, n - bp + 1, bp):
+            self._write_block(self.pending[i:i+bp])
+        rest = self.pending[i+bp:]
+        self.pending = gpx.Points()
+        self.pending.extend(rest)
+
+    def flush(self) -> None:
+        """
+        Write any pending points (as a smaller block), and flush the file
+        """
+        if len(self.pending) > 0:
+            self._write_block(self.pending)
+            self.pending = gpx.Points()
+        if self.out is not None:
+            self.out.flush()
+
+    def sync(self) -> int:
+        """
+        Flush, and make sure that everything is on disk.
+        Returns the size of the archive.
+        """
+        self.flush()
+        if self.out is None:
+            return 0
+        os.fsync(self.out.fileno())
+        return self.out.tell()
+
+    def close(self) -> None:
+        if self.out is None:
+            return
+        self.flush()
+        self.out.close()
+        self.out = None
+
+    def _write_block(self, points:gpx.Points) -> None:
+        if self.out is None:
+            raise Exception("archive is closed")
+        self.out.write(encode(points, self.compress))
+        self.points += len(points)
+        self.blocks += 1
+
+class Archive:
+    """
+    An archive, memory mapped for reading
+    """
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            self.map:Optional[mmap.mmap] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        if self.map is None or size < HEADER.size:
+            self.close()
+            raise Exception(f"not an archive: {path}")
+        magic, self.created = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise Exception(f"not an archive: {path}")
+        self.data = memoryview(self.map)
+        self.blocks:list[Block] = []
+        pos = HEADER.size
+        while pos + BLOCK.size <= size:
+            magic, *fields = BLOCK.unpack_from(self.map, pos)
+            if magic != BLOCK_MAGIC:
+                self.close()
+                raise Exception(f"corrupt archive: {path}: bad block at {pos}")
+            block = Block(pos + BLOCK.size, *fields)
+            if block.offset + block.size > size:
+                # truncated block (e.g., the write was interrupted)
+                break
+            self.blocks.append(block)
+            pos = block.end()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """
+        Number of points
+        """
+        return sum(block.n for block in self.blocks)
+
+    def columns(self, block:Block) -> tuple[memoryview,memoryview,memoryview,memoryview,memoryview]:
+        """
+        The (ts,lat,lon,ele,fix) columns of a block.
+        For an uncompressed block, these are views of the file (which must
+        be released before the archive is closed).
+        """
+        n = block.n
+        cols:list[Any]
+        if block.flags & COMPRESSED:
+            raw = zlib.decompress(self.data[block.offset:block.offset+block.size])
+            cols = []
+            off = 0
+            for typecode, utype in COLUMNS:
+                u = array(utype)
+                size = n * u.itemsize
+                u.frombytes(raw[off:off+size])
+                off += size
+                if BIG_ENDIAN:
+                    u.byteswap()
+                mask = (1 << (8 * u.itemsize)) - 1
+                u = array(utype, [ v & mask for v in accumulate(u) ])
+                cols.append(memoryview(u if typecode == utype else array(typecode, u.tobytes())))
+        else:
+            views = []
+            off = block.offset
+            for typecode, _ in COLUMNS:
+                size = n * array(typecode).itemsize
+                views.append(self.data[off:off+size])
+                off += size
+            if BIG_ENDIAN:
+                cols = []
+                for view, (typecode, _) in zip(views, COLUMNS):
+                    col = array(typecode, view.tobytes())
+                    col.byteswap()
+                    cols.append(memoryview(col))
+            else:
+                lat, lon, ts, ele, fix = views
+                cols = [ lat.cast('d'), lon.cast('d'), ts.cast('I'), ele.cast('i'), fix ]
+        lat, lon, ts, ele, fix = cols
+        return ts, lat, lon, ele, fix
+
+    def points(self, block:Block) -> gpx.Points:
+        """
+        The points of a block
+        """
+        cols = []
+        for col in self.columns(block):
+            a = array(col.format)
+            a.frombytes(col.cast('B'))
+            cols.append(a)
+        points = gpx.Points()
+        points.extend_columns(*cols)
+        return points
+
+    def __iter__(self) -> Iterator[gpx.Points]:
+        """
+        Iterate over the points, a block at a time
+        """
+        for block in self.blocks:
+            yield self.points(block)
+
+    def read(self, start:Optional[int] = None, end:Optional[int] = None,
+             bbox:Optional[tuple[float,float,float,float]] = None) -> gpx.Points:
+        """
+        The points in the time range [start, end] (inclusive), and in the
+        bounding box (min lat, min lon, max lat, max lon; inclusive);
+        blocks are skipped by their min/max values
+        """
+        t0 = start if start is not None else 0
+        t1 = end if end is not None else 0xffffffff
+        lat0, lon0, lat1, lon1 = bbox if bbox is not None else (-90, -180, 90, 180)
+        result = gpx.Points()
+        for b in self.blocks:
+            if b.ts_max < t0 or b.ts_min > t1 or b.lat_max < lat0 or b.lat_min > lat1 or b.lon_max < lon0 or b.lon_min > lon1:
+                continue
+            points = self.points(b)
+            if not (t0 <= b.ts_min and b.ts_max <= t1 and lat0 <= b.lat_min and b.lat_max <= lat1 and lon0 <= b.lon_min and b.lon_max <= lon1):
+                ts, lat, lon, _, _ = points.columns()
+                points = points.take([ i for i, (t, y, x) in enumerate(zip(ts, lat, lon))
+                                       if t0 <= t <= t1 and lat0 <= y <= lat1 and lon0 <= x <= lon1 ])
+            result.extend(points)
+        return result
+
+    def size(self) -> int:
+        """
+        Size of the archive (bytes)
+        """
+        return self.blocks[-1].end() if len(self.blocks) > 0 else HEADER.size
+
+    def close(self) -> None:
+        if self.map is not None:
+            if hasattr(self, 'data'):
+                self.data.release()
+            self.map.close()
+            self.map = None
+
+def write(path:str, points:gpx.Points, compress:bool = True) -> None:
+    """
+    Write points to a new archive
+    """
+    with ArchiveWriter(path, compress) as writer:
+        writer.write(points)
+
+def to_gpx(pieces:Iterable[gpx.Points], out:TextIO, pretty:bool = True) -> None:
+    """
+    Write points, given in pieces (e.g., the blocks of an Archive), as GPX
+    (a single track and segment)
+    """
+    writer = gpx.Writer(out, pretty)
+    writer.start_document()
+    writer.start_track()
+    writer.start_segment()
+    for points in pieces:
+        writer.write_points(points)
+    writer.end_segment()
+    writer.end_track()
+    writer.end_document()
+
+def to_geojson(pieces:Iterable[gpx.Points], out:TextIO) -> None:
+    """
+    Write points, given in pieces (e.g., the blocks of an Archive), as
+    GeoJSON: a LineString feature, with the time of each point in the
+    coordTimes property. The pieces are iterated twice.
+    """
+    out.write('{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [')
+    sep = ""
+    for points in pieces:
+        if len(points) == 0:
+            continue
+        _, lat, lon, ele, _ = points.columns()
+        out.write(sep + ", ".join([ f"[{x!r}, {y!r}, {e}]" for x, y, e in zip(lon, lat, ele) ]))
+        sep = ", "
+    out.write(']}, "properties": {"coordTimes": [')
+    sep = ""
+    for points in pieces:
+        if len(points) == 0:
+            continue
+        ts = points.columns()[0]
+        out.write(sep + ", ".join([ f'"{gpx.format_time(t)}"' for t in ts ]))
+        sep = ", "
+    out.write(']}}]}\n')
+
+def to_csv(pieces:Iterable[gpx.Points], out:TextIO) -> None:
+    """
+    Write points, given in pieces (e.g., the blocks of an Archive), as CSV,
+    with a header line
+    """
+    out.write("time,lat,lon,ele,fix\n")
+    for points in pieces:
+        ts, lat, lon, ele, fix = points.columns()
+        out.write("".join([ f"{gpx.format_time(t)},{y!r},{x!r},{e},{f}\n" for t, y, x, e, f in zip(ts, lat, lon, ele, fix) ]))
+
+EXPORTS:dict[str,Callable[[Iterable[gpx.Points],TextIO],None]] = {
+    "gpx": to_gpx,
+    "geojson": to_geojson,
+    "csv": to_csv,
+}
+
+def main(args:list[str]) -> None:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox.archive", description="Show or export the contents of an archive")
+    parser.add_argument("archive")
+    parser.add_argument("--export", choices=sorted(EXPORTS), help="write the points to stdout, in the given format")
+    opts = parser.parse_args(args)
+    with Archive(opts.archive) as archive:
+        if opts.export is not None:
+            EXPORTS[opts.export](archive, sys.stdout)
+            return
+        n = len(archive)
+        size = archive.size()
+        print(f"{opts.archive}: {n} points in {len(archive.blocks)} blocks, {size} bytes" +
+              (f" ({size/n:.1f} bytes/point)" if n > 0 else ""))
+        if n > 0:
+            info = {
+                "start": gpx.format_time(min(b.ts_min for b in archive.blocks)),
+                "end": gpx.format_time(max(b.ts_max for b in archive.blocks)),
+                "bbox": [ min(b.lat_min for b in archive.blocks), min(b.lon_min for b in archive.blocks),
+                          max(b.lat_max for b in archive.blocks), max(b.lon_max for b in archive.blocks) ],
+                "ele": [ min(b.ele_min for b in archive.blocks), max(b.ele_max for b in archive.blocks) ],
+            }
+            print(json.dumps(info))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
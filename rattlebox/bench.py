@@ -0,0 +1,377 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Benchmarks of the decode, parse and serialize hot paths.
+
+Each benchmark (see BENCHMARKS) runs one stage over n synthetic records,
+from 1K to 10M: NMEA sentences, or the $PMTKLOX messages of a logger dump,
+as output by the simulator (see nmea_batches and lox_batches). Records are
+generated and run in batches (of BATCH records), so memory use does not grow
+with n, and only the stage itself is timed; its input is prepared before the
+clock starts. For each benchmark we report:
+* ops/s - records per second (the best of repeat runs)
+* MB/s - bytes of input per second (of output, for serializers)
+* peak RSS - of a process that runs only this benchmark (it is forked)
+* alloc/rec - peak bytes allocated (traced by tracemalloc) while running
+  a batch, per record
+
+Results can be saved as a JSON baseline, and compared with a baseline: a
+benchmark that is slower (in ops/s), or allocates more, by more than the
+threshold (a fraction of the baseline) is a regression.
+
+Usage: python -m rattlebox.bench [--records=1K,100K] [--baseline=<file>] [--save=<file>]
+(see main, and `make bench`)
+"""
+
+from typing import (Any, Callable, Iterator, Optional)
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import (asdict, dataclass)
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.simulator as simulator
+
+BATCH = 10000 # records
+
+def nmea_batches(n:int, batch:int = BATCH) -> Iterator[bytes]:
+    """
+    n NMEA sentences (one fix per second, with the simulator's default
+    outputs), in buffers of batch sentences
+    """
+    sim = simulator.Simulator(rate=1)
+    epoch = 0
+    lines:list[bytes] = []
+    while n > 0:
+        k = min(n, batch)
+        while len(lines) < k:
+            sim.emit_epoch(epoch)
+            epoch += 1
+            lines.extend(bytes(sim.out).splitlines(keepends=True))
+            sim.out.clear()
+        yield b''.join(lines[:k])
+        lines = lines[k:]
+        n -= k
+
+def lox_batches(n:int, batch:int = BATCH) -> Iterator[bytes]:
+    """
+    A logger dump of n records (its $PMTKLOX messages), in buffers of about
+    batch records
+    """
+    per_chunk = simulator.WORDS_PER_CHUNK * 4 // locus.RECORD_SIZE
+    batch = max(per_chunk, batch // per_chunk * per_chunk)
+    seq = 0
+    for first in range(0, n, batch):
+        log = simulator.make_log(min(batch, n - first), first=first)
+        buf = bytearray()
+        if first == 0:
+            buf += simulator.sentence(f"PMTKLOX,0,{(n + per_chunk - 1) // per_chunk}")
+        for i in range(0, len(log), per_chunk * locus.RECORD_SIZE):
+            buf += simulator.lox_sentence(seq, log[i:i + per_chunk * locus.RECORD_SIZE])
+            seq += 1
+        if first + batch >= n:
+            buf += simulator.sentence("PMTKLOX,2")
+        yield bytes(buf)
+
+SOURCES:dict[str,Callable[[int],Iterator[bytes]]] = {
+    "nmea": nmea_batches,
+    "lox": lox_batches,
+}
+
+def lox_words(data:bytes) -> list[list[str]]:
+    """
+    The words of the $PMTKLOX,1 messages in data
+    """
+    words = []
+    for line in data.splitlines():
+        status, fields = nmea.tokenize(line)
+        if status == nmea.OK and fields[0] == "$PMTKLOX" and fields[1] == "1":
+            words.append(fields[3:])
+    return words
+
+class Benchmark:
+    """
+    A stage to benchmark. Its input is made from each batch of its source
+    (see SOURCES) by prepare, which is not timed, and then run, which is.
+    """
+    name = ""
+    source = "nmea"
+
+    def start(self) -> None:
+        """
+        Start of a run (over all of the batches)
+        """
+        pass
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        """
+        The input for run, and the number of records and bytes in it
+        """
+        return data, 0, len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        """
+        Run the stage on the input of a batch. Returns the number of bytes
+        of output, if throughput is measured by output (rather than input).
+        """
+        return None
+
+class Checksum(Benchmark):
+    name = "nmea.checksum"
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        bodies = [ line[1:line.rindex(b'*')].decode("latin-1") for line in data.splitlines() ]
+        return bodies, len(bodies), sum(map(len, bodies))
+
+    def run(self, input:Any) -> Optional[int]:
+        for body in input:
+            nmea.checksum(body)
+        return None
+
+class ParseSentence(Benchmark):
+    name = "nmea.parse_sentence"
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        lines = data.decode("latin-1").splitlines()
+        return lines, len(lines), len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        for line in input:
+            nmea.parse_sentence(line)
+        return None
+
+class ParseMany(Benchmark):
+    name = "nmea.parse_many"
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        return data, data.count(b'\n'), len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        nmea.parse_many(input)
+        return None
+
+class RecvNMEA(Benchmark):
+    name = "Driver.recv_message[nmea]"
+
+    def start(self) -> None:
+        self.driver = mt3339.Driver(None, show_prog=False)
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        lines = data.splitlines(keepends=True)
+        return lines, len(lines), len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        for line in input:
+            self.driver.recv_message(line)
+        return None
+
+class LoxToPoints(Benchmark):
+    name = "Driver.lox_to_points"
+    source = "lox"
+
+    def start(self) -> None:
+        self.driver = mt3339.Driver(None, show_prog=False)
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        words = lox_words(data)
+        return words, sum(len(w) for w in words) // 4, len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        for words in input:
+            self.driver.lox_to_points(words)
+        return None
+
+class RecvDump(Benchmark):
+    name = "Driver.recv_message[dump]"
+    source = "lox"
+
+    def start(self) -> None:
+        self.driver = mt3339.Driver(None, show_prog=False, sink=dump.Sink())
+        self.driver.cmd = "logger-dump"
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        return data.splitlines(keepends=True), sum(len(w) for w in lox_words(data)) // 4, len(data)
+
+    def run(self, input:Any) -> Optional[int]:
+        # (the driver reports on the dump when it ends)
+        with contextlib.redirect_stderr(io.StringIO()):
+            for line in input:
+                self.driver.recv_message(line)
+        return None
+
+class ToXML(Benchmark):
+    name = "Document.to_xml"
+    source = "lox"
+
+    def prepare(self, data:bytes) -> tuple[Any,int,int]:
+        points = gpx.Points()
+        points.extend_columns(*locus.decode(bytes.fromhex("".join(sum(lox_words(data), [])))).columns())
+        return points, len(points), 0
+
+    def run(self, input:Any) -> Optional[int]:
+        return len(gpx.Document.from_points(input).to_xml())
+
+BENCHMARKS:list[Benchmark] = [ Checksum(), ParseSentence(), ParseMany(), RecvNMEA(), LoxToPoints(), RecvDump(), ToXML() ]
+
+@dataclass
+class Result:
+    name:str
+    records:int
+    bytes:int
+    seconds:float # best run
+    ops:float # records per second
+    mbps:float # MB per second
+    peak_rss:int # bytes
+    alloc:float # peak bytes allocated per record
+
+def measure(bench:Benchmark, n:int, repeat:int = 3) -> Result:
+    """
+    Run a benchmark over n records
+    """
+    source = SOURCES[bench.source]
+    best = math.inf
+    records = size = 0
+    for _ in range(repeat):
+        bench.start()
+        seconds = 0.0
+        records = size = 0
+        for data in source(n):
+            input, k, nbytes = bench.prepare(data)
+            t = time.perf_counter()
+            out = bench.run(input)
+            seconds += time.perf_counter() - t
+            records += k
+            size += nbytes if out is None else out
+            del input
+        best = min(best, seconds)
+    # allocations while running the first batch
+    bench.start()
+    input, k, _ = bench.prepare(next(source(n)))
+    tracemalloc.start()
+    bench.run(input)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return Result(bench.name, records, size, best, records / best if best > 0 else 0, size / best / 1e6 if best > 0 else 0,
+                  peak_rss(), peak / k if k > 0 else 0)
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of this process, in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def run(benchmarks:list[Benchmark], sizes:list[int], repeat:int = 3, isolate:bool = True) -> Iterator[Result]:
+    """
+    Run the benchmarks over each number of records. If isolate is True, each
+    one is run by a forked process of its own (where possible), so that its
+    peak RSS is its own.
+    """
+    ctx = multiprocessing.get_context("fork") if isolate and "fork" in multiprocessing.get_all_start_methods() else None
+    for n in sizes:
+        for bench in benchmarks:
+            if ctx is None:
+                yield measure(bench, n, repeat)
+                continue
+            with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                yield pool.submit(measure, bench, n, repeat).result()
+
+HEADER = f"{'benchmark':<28}{'records':>10}{'ops/s':>12}{'MB/s':>9}{'peak RSS':>12}{'alloc/rec':>11}"
+
+def format_result(r:Result) -> str:
+    """
+    A line of the report (see HEADER)
+    """
+    return f"{r.name:<28}{r.records:>10}{r.ops:>12.0f}{r.mbps:>9.1f}{r.peak_rss/1e6:>9.1f} MB{r.alloc:>9.0f} B"
+
+def save(path:str, results:list[Result]) -> None:
+    data = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": [ asdict(r) for r in results ],
+    }
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=1)
+
+def load(path:str) -> list[Result]:
+    with open(path, 'r') as file:
+        return [ Result(**r) for r in json.load(file)["results"] ]
+
+def compare(results:list[Result], baseline:list[Result], threshold:float = 0.1) -> list[str]:
+    """
+    The regressions of results from the baseline (of the same benchmark and
+    number of records): more than threshold (a fraction) slower, or more
+    than threshold more allocations per record
+    """
+    base = { (r.name, r.records): r for r in baseline }
+    regressions:list[str] = []
+    for r in results:
+        b = base.get((r.name, r.records))
+        if b is None:
+            continue
+        if r.ops < b.ops * (1 - threshold):
+            regressions.append(f"{r.name} ({r.records} records): {r.ops:.0f} ops/s, was {b.ops:.0f} ({r.ops/b.ops-1:+.0%})")
+        if r.alloc > b.alloc * (1 + threshold) + 1:
+            regressions.append(f"{r.name} ({r.records} records): {r.alloc:.0f} bytes allocated per record, was {b.alloc:.0f}")
+    return regressions
+
+def parse_count(val:str) -> int:
+    """
+    Parse a number of records, e.g., 1000, 1K, or 10M
+    """
+    val = val.strip().upper()
+    scale = { "K": 1000, "M": 1000000 }.get(val[-1:], 1)
+    return int(val[:-1] if scale > 1 else val) * scale
+
+def main(args:list[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox.bench", description="Benchmark the decode, parse and serialize hot paths")
+    parser.add_argument("--records", default="1K,100K", help="numbers of records, e.g., 1K,100K,10M")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (the best is reported)")
+    parser.add_argument("--only", help="only run the benchmarks whose name contains this")
+    parser.add_argument("--baseline", help="compare with this baseline (if it exists)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="regression threshold (a fraction of the baseline)")
+    parser.add_argument("--save", help="save the results as a baseline")
+    opts = parser.parse_args(args)
+    try:
+        sizes = [ parse_count(s) for s in opts.records.split(",") ]
+    except ValueError:
+        parser.error(f"invalid number of records: {opts.records}")
+    if any(n <= 0 for n in sizes):
+        parser.error(f"invalid number of records: {opts.records}")
+    benchmarks = [ b for b in BENCHMARKS if opts.only is None or opts.only in b.name ]
+    results:list[Result] = []
+    print(HEADER)
+    for result in run(benchmarks, sizes, opts.repeat):
+        print(format_result(result), flush=True)
+        results.append(result)
+    if opts.save is not None:
+        save(opts.save, results)
+        print(f"saved baseline: {opts.save}", file=sys.stderr)
+    if opts.baseline is not None:
+        try:
+            baseline = load(opts.baseline)
+        except FileNotFoundError:
+            print(f"no baseline: {opts.baseline}", file=sys.stderr)
+            return 0
+        regressions = compare(results, baseline, opts.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if len(regressions) > 0:
+            return 1
+        print(f"no regressions (threshold {opts.threshold:.0%})", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
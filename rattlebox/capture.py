@@ -0,0 +1,298 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Capture and replay of raw serial traffic.
+
+A capture file records the bytes read from the device, exactly as they
+came off the serial line, with the time at which they were read.
+The file starts with a header:
+* Magic - 8 bytes - b'RBXCAP\\x00\\x01'
+* Start time (Unix/epoch, nanoseconds) - 8 bytes - signed long long
+* Baud rate - 4 bytes - unsigned long
+followed by records:
+* Time since the previous record (microseconds) - 4 bytes - unsigned long
+* Length - 2 bytes - unsigned short
+* Data - <length> bytes
+(Values are little-endian)
+
+A capture can be replayed through ReplayPort (a stand-in for serial.Serial)
+or ReplayTransport (see aio), either at the original pace or as fast as
+possible.
+"""
+
+from typing import (Any, BinaryIO, Iterator, Optional, Self)
+import array
+import asyncio
+import mmap
+import struct
+import time
+import rattlebox.aio as aio
+
+MAGIC = b'RBXCAP\x00\x01'
+HEADER = struct.Struct('<8sqI')
+RECORD = struct.Struct('<IH')
+MAX_DELTA = 0xffffffff # microseconds
+MAX_DATA = 0xffff
+
+class Recorder:
+    """
+    Append raw serial data to a capture file
+    """
+    def __init__(self, path:str, baudrate:int = 0):
+        self.path = path
+        self.out:Optional[BinaryIO] = open(path, 'wb')
+        self.start = time.time_ns()
+        self.last = time.monotonic_ns()
+        self.out.write(HEADER.pack(MAGIC, self.start, baudrate))
+        self.records = 0
+        self.bytes = 0
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, data:bytes, delta_us:Optional[int] = None) -> None:
+        """
+        Record data read from the device; delta_us is the time since the
+        previous record (defaults to the time elapsed since then).
+        """
+        if self.out is None:
+            raise Exception("capture is closed")
+        if delta_us is None:
+            now = time.monotonic_ns()
+            delta_us = (now - self.last) // 1000
+            self.last = now
+        for i in range(0, len(data), MAX_DATA):
+            chunk = data[i:i+MAX_DATA]
+            self.out.write(RECORD.pack(min(delta_us, MAX_DELTA), len(chunk)))
+            self.out.write(chunk)
+            self.records += 1
+            self.bytes += len(chunk)
+            delta_us = 0
+
+    def flush(self) -> None:
+        if self.out is not None:
+            self.out.flush()
+
+    def close(self) -> None:
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+class CapturePort:
+    """
+    Wraps a port (e.g., serial.Serial), recording everything that is read
+    from it.
+    """
+    def __init__(self, port:Any, recorder:Recorder):
+        self.port = port
+        self.recorder = recorder
+
+    def read(self, n:int) -> bytes:
+        data = self.port.read(n)
+        if data:
+            self.recorder.write(data)
+        return data
+
+    def __getattr__(self, name:str) -> Any:
+        # everything else goes straight to the port
+        return getattr(self.port, name)
+
+    def __setattr__(self, name:str, value:Any) -> None:
+        # ... including settings, such as baudrate and timeout
+        if name in ("port", "recorder"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.port, name, value)
+
+class Capture:
+    """
+    A capture file, memory mapped for reading
+    """
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.map.close()
+            raise Exception(f"not a capture file: {path}")
+        magic, self.start, self.baudrate = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.map.close()
+            raise Exception(f"not a capture file: {path}")
+        self.data = memoryview(self.map)
+        # index of the records: offset of the data, and time (from the start)
+        self.offsets = array.array('Q')
+        self.lengths = array.array('H')
+        self.times = array.array('Q') # microseconds
+        pos = HEADER.size
+        t = 0
+        size = len(self.map)
+        unpack = RECORD.unpack_from
+        while pos + RECORD.size <= size:
+            delta, n = unpack(self.map, pos)
+            pos += RECORD.size
+            if pos + n > size:
+                # truncated record (e.g., the capture was interrupted)
+                n = size - pos
+            t += delta
+            self.offsets.append(pos)
+            self.lengths.append(n)
+            self.times.append(t)
+            pos += n
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """
+        Number of records
+        """
+        return len(self.offsets)
+
+    def record(self, i:int) -> memoryview:
+        off = self.offsets[i]
+        return self.data[off:off+self.lengths[i]]
+
+    def __iter__(self) -> Iterator[tuple[int,memoryview]]:
+        """
+        Iterate over the records, as (microseconds since start, data)
+        """
+        for i in range(len(self.offsets)):
+            yield self.times[i], self.record(i)
+
+    def size(self) -> int:
+        """
+        Number of bytes of serial data
+        """
+        return sum(self.lengths)
+
+    def duration(self) -> float:
+        """
+        Time from the start of the capture to the last record (seconds)
+        """
+        return self.times[-1] / 1e6 if len(self.times) > 0 else 0
+
+    def close(self) -> None:
+        if self.data is not None:
+            self.data.release()
+            self.map.close()
+
+class Replay:
+    """
+    Reads the data of a capture, in order.
+    If speed is 0, data is returned as fast as possible, otherwise records
+    are released at the pace at which they were captured (speed>1 replays
+    faster than real time).
+    """
+    def __init__(self, capture:Capture, speed:float = 0):
+        self.capture = capture
+        self.speed = speed
+        self.index = 0 # next record
+        self.pos = 0 # position in the next record
+        self.t0:Optional[float] = None # when the replay started
+
+    def at_end(self) -> bool:
+        return self.index >= len(self.capture)
+
+    def wait(self) -> float:
+        """
+        Time until the next record is due (seconds)
+        """
+        if self.speed == 0 or self.at_end() or self.pos > 0:
+            return 0
+        if self.t0 is None:
+            self.t0 = time.monotonic() - self.capture.times[self.index] / 1e6 / self.speed
+        return self.t0 + self.capture.times[self.index] / 1e6 / self.speed - time.monotonic()
+
+    def read(self, n:int) -> bytes:
+        """
+        Read up to n bytes that are due; when pacing, a read does not cross
+        a record boundary.
+        """
+        cap = self.capture
+        parts:list[memoryview] = []
+        while n > 0 and not self.at_end():
+            rec = cap.record(self.index)
+            part = rec[self.pos:self.pos+n]
+            parts.append(part)
+            n -= len(part)
+            self.pos += len(part)
+            if self.pos >= len(rec):
+                self.index += 1
+                self.pos = 0
+                if self.speed != 0:
+                    break
+        return b''.join(parts)
+
+class ReplayPort:
+    """
+    Replays a capture as if it were a serial port (see reader.Reader).
+    Writes are discarded (and recorded in written). Reading past the end of
+    the capture raises EOFError.
+    """
+    def __init__(self, path:str, speed:float = 0, timeout:Optional[float] = None):
+        self.capture = Capture(path)
+        self.replay = Replay(self.capture, speed)
+        self.timeout = timeout
+        self.baudrate = self.capture.baudrate
+        self.is_open = True
+        self.written:list[bytes] = []
+
+    def read(self, n:int = 1) -> bytes:
+        if self.replay.at_end():
+            raise EOFError("end of capture")
+        wait = self.replay.wait()
+        if wait > 0:
+            if self.timeout is not None and wait > self.timeout:
+                time.sleep(self.timeout)
+                return b''
+            time.sleep(wait)
+        return self.replay.read(n)
+
+    def write(self, data:bytes) -> int:
+        self.written.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.is_open:
+            self.is_open = False
+            self.capture.close()
+
+class ReplayTransport(aio.Transport):
+    """
+    Replays a capture through an async transport.
+    Writes are discarded (and recorded in written).
+    """
+    interactive = False
+
+    def __init__(self, path:str, speed:float = 0):
+        self.capture = Capture(path)
+        self.replay = Replay(self.capture, speed)
+        self.written:list[bytes] = []
+
+    async def read(self, n:int) -> bytes:
+        wait = self.replay.wait()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        elif self.replay.speed == 0:
+            # give others a chance to run
+            await asyncio.sleep(0)
+        return self.replay.read(n)
+
+    async def write(self, data:bytes) -> None:
+        self.written.append(bytes(data))
+
+    async def close(self) -> None:
+        self.capture.close()
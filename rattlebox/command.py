@@ -0,0 +1,251 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Command engine: sending PMTK commands, and matching acknowledgements.
+
+The device acknowledges each command with $PMTK001,<type>,<flag>, where type
+is the message type of the command (e.g., 183 for $PMTK183) and flag tells
+how it went (see FLAGS). A Pipeline keeps track of the commands that have
+been submitted:
+* commands are sent in order; a command that is marked as pipelined (e.g.,
+  configuration) is sent without waiting for the acknowledgement of the
+  ones before it (up to window at a time, and one per message type, so
+  that each acknowledgement matches exactly one command); any other command
+  waits for the ones before it to complete, and holds up the ones after it
+* an acknowledgement completes the oldest outstanding command of its type
+* a command that is not acknowledged by its deadline (timeout seconds after
+  it was sent, or after the last response to it; e.g., a chunk of a logger
+  dump) is sent again, up to retries times, and then times out
+* when a command fails (it is invalid, unsupported, failed, or timed out),
+  the commands that have not been sent yet are cancelled, unless it is
+  marked as optional (e.g., getting the logger status to plan a dump)
+* a command that turns out to be unnecessary before it is sent (e.g., dumping
+  an empty log) can be skipped; this does not hold up the ones after it
+The pipeline does not do any I/O: due returns the messages to send, and the
+acknowledgements are passed to ack (see mt3339.Driver).
+"""
+
+from typing import (Callable, Optional)
+from collections import deque
+from dataclasses import dataclass
+import time
+import rattlebox.metrics as metrics
+import rattlebox.nmea as nmea
+
+# Flags of $PMTK001 (the status of a command)
+INVALID = 0
+UNSUPPORTED = 1
+FAILED = 2
+SUCCEEDED = 3
+# ... and of commands that were not acknowledged
+TIMED_OUT = -1 # after all tries
+CANCELLED = -2 # not sent, because an earlier command failed
+SKIPPED = -3 # not sent, because there was no need to (see Pipeline.skip)
+FLAGS = {
+    INVALID: "invalid",
+    UNSUPPORTED: "unsupported",
+    FAILED: "failed",
+    SUCCEEDED: "succeeded",
+    TIMED_OUT: "timed out",
+    CANCELLED: "cancelled",
+    SKIPPED: "skipped",
+}
+
+def message(body:str) -> bytes:
+    """
+    The message (sentence) for the body of a command; e.g., PMTK183
+    """
+    return ('$%s*%s\r\n' % (body, nmea.checksum(body))).encode("ascii")
+
+def message_type(body:str) -> int:
+    """
+    The message type of a command; e.g., 183 for PMTK183
+    """
+    return int(body[4:].split(",")[0])
+
+@dataclass(eq=False)
+class Request:
+    """
+    A submitted command
+    """
+    cmd:str # as submitted (see mt3339.Driver.start_command)
+    body:str # of the message
+    pipelined:bool = False # may be sent before the ones before it are acknowledged
+    acked:bool = True # the device acknowledges it (it does not when changing baud)
+    optional:bool = False # if it fails, carry on with the ones after it
+    tries:int = 0 # times sent
+    sent_at:float = 0 # when it was last sent
+    deadline:float = 0
+    flag:Optional[int] = None # the status, once it is complete (see FLAGS)
+
+    @property
+    def type(self) -> int:
+        return message_type(self.body)
+
+    def done(self) -> bool:
+        return self.flag is not None
+
+    def ok(self) -> bool:
+        return self.flag == SUCCEEDED or self.flag == SKIPPED
+
+    def status(self) -> str:
+        return "pending" if self.flag is None else FLAGS[self.flag]
+
+class Pipeline:
+    """
+    Commands that have been submitted, but not completed (see the module
+    docstring)
+    """
+    def __init__(self, timeout:float = 2, retries:int = 2, window:int = 4, metrics:Optional[metrics.Metrics] = None,
+                 clock:Callable[[],float] = time.monotonic):
+        self.timeout = timeout # seconds
+        self.retries = retries
+        self.window = window # pipelined commands that can be outstanding
+        self.metrics = metrics
+        self.clock = clock
+        self.queued:deque[Request] = deque() # not sent yet
+        self.outstanding:list[Request] = [] # sent, and not acknowledged yet (in the order they were sent)
+        self.on_done:Optional[Callable[[Request],None]] = None # if set, called with each completed command
+        self.stray = 0 # acknowledgements that did not match a command
+
+    def submit(self, req:Request) -> Request:
+        """
+        Queue a command, to be sent when it is due
+        """
+        self.queued.append(req)
+        return req
+
+    def start(self, req:Request) -> bytes:
+        """
+        Send a command now (regardless of the others); returns the message
+        """
+        self._sent(req, self.clock())
+        return message(req.body)
+
+    def due(self) -> list[bytes]:
+        """
+        The messages to send now: of commands that are due to be sent, or
+        sent again; commands that have run out of tries time out
+        """
+        now = self.clock()
+        msgs:list[bytes] = []
+        for req in [ r for r in self.outstanding if r.deadline <= now ]:
+            if req.tries > self.retries:
+                self.outstanding.remove(req)
+                self._done(req, TIMED_OUT)
+                continue
+            self._count("command.retries")
+            self._sent(req, now)
+            msgs.append(message(req.body))
+        while len(self.queued) > 0 and self._can_send(self.queued[0]):
+            req = self.queued.popleft()
+            self._sent(req, now)
+            msgs.append(message(req.body))
+        return msgs
+
+    def ack(self, cmd_type:int, flag:int) -> Optional[Request]:
+        """
+        An acknowledgement ($PMTK001); returns the command that it completes
+        (if any)
+        """
+        for req in self.outstanding:
+            if req.type == cmd_type:
+                self.outstanding.remove(req)
+                if self.metrics is not None:
+                    self.metrics.observe("command.rtt_us", int((self.clock() - req.sent_at) * 1e6))
+                self._done(req, flag if flag in FLAGS and flag >= 0 else INVALID)
+                return req
+        self.stray += 1
+        self._count("command.stray_acks")
+        return None
+
+    def extend(self) -> None:
+        """
+        A response to the oldest outstanding command (other than its
+        acknowledgement); it is making progress, so move its deadline
+        """
+        if len(self.outstanding) > 0:
+            self.outstanding[0].deadline = self.clock() + self.timeout
+
+    def active(self) -> Optional[Request]:
+        """
+        The oldest outstanding command (if any)
+        """
+        return self.outstanding[0] if len(self.outstanding) > 0 else None
+
+    def idle(self) -> bool:
+        return len(self.queued) == 0 and len(self.outstanding) == 0
+
+    def wait(self, timeout:float) -> float:
+        """
+        How long to wait for input (at most timeout seconds), so that due is
+        called when the next deadline passes
+        """
+        if len(self.outstanding) == 0:
+            return 0 if len(self.queued) > 0 else timeout
+        deadline = min(r.deadline for r in self.outstanding)
+        return max(0, min(timeout, deadline - self.clock()))
+
+    def cancel(self, req:Request) -> None:
+        """
+        Forget a command (e.g., one that was started, and given up on)
+        """
+        if req in self.outstanding:
+            self.outstanding.remove(req)
+        elif req in self.queued:
+            self.queued.remove(req)
+        else:
+            return
+        self._done(req, CANCELLED)
+
+    def skip(self, req:Request) -> None:
+        """
+        Don't send a queued command after all
+        """
+        if req in self.queued:
+            self.queued.remove(req)
+            self._done(req, SKIPPED)
+
+    def next(self) -> Optional[Request]:
+        """
+        The next command to be sent (if any)
+        """
+        return self.queued[0] if len(self.queued) > 0 else None
+
+    def clear(self) -> None:
+        """
+        Cancel all commands (e.g., the connection to the device was lost)
+        """
+        for req in self.outstanding + list(self.queued):
+            self.cancel(req)
+
+    def _can_send(self, req:Request) -> bool:
+        if len(self.outstanding) == 0:
+            return True
+        return (req.pipelined and len(self.outstanding) < self.window and
+                all(r.pipelined and r.type != req.type for r in self.outstanding))
+
+    def _sent(self, req:Request, now:float) -> None:
+        req.tries += 1
+        req.sent_at = now
+        req.deadline = now + self.timeout
+        self._count("command.sent")
+        if not req.acked:
+            # (no way of telling if it worked)
+            self._done(req, SUCCEEDED)
+        elif req not in self.outstanding:
+            self.outstanding.append(req)
+
+    def _done(self, req:Request, flag:int) -> None:
+        req.flag = flag
+        self._count(f"command.{FLAGS[flag].replace(' ', '_')}")
+        if self.on_done is not None:
+            self.on_done(req)
+        if not req.ok() and not req.optional:
+            # don't carry on as if it had worked
+            while len(self.queued) > 0:
+                self._done(self.queued.popleft(), CANCELLED)
+
+    def _count(self, name:str) -> None:
+        if self.metrics is not None:
+            self.metrics.count(name)
@@ -0,0 +1,353 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Offline batch conversion of logger dumps.
+
+Inputs are raw capture files (see capture) or text dumps of the $PMTKLOX
+messages of a logger dump (e.g., as echoed with --debug, or saved from a
+terminal). Each input is decoded (through mt3339.Driver, as if it came from
+the device), validated, optionally segmented (see segment), and exported
+as GPX, an archive (see archive), GeoJSON or CSV.
+
+Inputs are converted in parallel, by a pool of processes (one per CPU, by
+default); results are reported, and outputs are recorded, in the order of
+the inputs, regardless of which finishes first. The SHA-256 of each input,
+along with the settings that it was converted with, is kept in a state file
+in the output directory, so a re-run skips the inputs that have not changed.
+
+Usage: python -m rattlebox convert <input> ... --out <dir> [<option> ...]
+(see main)
+"""
+
+from typing import (Any, Iterable, Iterator, Optional)
+from concurrent.futures import (Executor, ProcessPoolExecutor)
+from dataclasses import (asdict, dataclass, field)
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import rattlebox.archive as archive
+import rattlebox.capture as capture
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.segment as segment
+
+FORMATS = { "gpx": ".gpx", "rbx": archive.EXT, "geojson": ".geojson", "csv": ".csv" }
+INPUT_EXTS = (".cap", ".txt", ".lox", ".log", ".nmea")
+STATE_FILE = ".rattlebox-convert.json"
+READ_SIZE = 1024*1024
+
+@dataclass
+class Settings:
+    """
+    How inputs are converted
+    """
+    out_dir:str
+    format:str = "gpx" # see FORMATS
+    rules:Optional[segment.Rules] = None # segment the log (GPX output only, unless split)
+    split:bool = False # write each outing to its own file
+
+    def key(self) -> str:
+        """
+        The settings that affect the output (see State)
+        """
+        rules = asdict(self.rules) if self.rules is not None else None
+        return json.dumps([ self.format, rules, self.split ])
+
+@dataclass
+class Result:
+    """
+    The outcome of converting an input
+    """
+    input:str
+    sha256:str = ""
+    size:int = 0 # bytes of input
+    outputs:list[str] = field(default_factory=list)
+    points:int = 0 # valid points
+    invalid:int = 0 # records that failed validation (checksum, fix type, or timestamp)
+    bad_sentences:int = 0 # lines that are not valid NMEA sentences
+    missing:list[int] = field(default_factory=list) # chunks of the dump that were not found
+    seconds:float = 0
+    skipped:bool = False # unchanged since the last run
+    error:Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            return f"{self.input}: failed: {self.error}"
+        if self.skipped:
+            return f"{self.input}: unchanged"
+        s = f"{self.input}: {self.points} points"
+        if self.invalid > 0:
+            s += f" ({self.invalid} invalid)"
+        if self.bad_sentences > 0:
+            s += f", {self.bad_sentences} bad sentences"
+        if len(self.missing) > 0:
+            s += f", missing chunks {self.missing}"
+        s += f" in {self.seconds:.2f}s"
+        if self.seconds > 0:
+            s += f" ({self.size/self.seconds/1e6:.1f} MB/s, {self.points/self.seconds:.0f} points/s)"
+        return s + f" -> {', '.join(os.path.basename(p) for p in self.outputs)}"
+
+def inputs(paths:Iterable[str]) -> list[str]:
+    """
+    Expand the given paths (files, or directories, which are searched for
+    files with one of the INPUT_EXTS), in a deterministic order
+    """
+    found:list[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                found.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                             if os.path.splitext(name)[1].lower() in INPUT_EXTS)
+        else:
+            found.append(path)
+    # drop duplicates, keeping the first
+    return list(dict.fromkeys(found))
+
+def read_chunks(path:str) -> Iterator[bytes]:
+    """
+    The data of an input: the serial data of a capture file, or the contents
+    of a text dump
+    """
+    with open(path, 'rb') as file:
+        is_capture = file.read(len(capture.MAGIC)) == capture.MAGIC
+    if is_capture:
+        with capture.Capture(path) as cap:
+            # (no views of the records may be held when the capture is closed)
+            for i in range(len(cap)):
+                yield bytes(cap.record(i))
+        return
+    with open(path, 'rb') as file:
+        while data := file.read(READ_SIZE):
+            yield data
+
+def decode(chunks:Iterable[bytes], result:Result) -> gpx.Points:
+    """
+    Decode the logger dump in the given data, as the driver would, updating
+    the validation counts of result
+    """
+    sink = dump.MemorySink()
+    driver = mt3339.Driver(None, show_prog=False, sink=sink)
+    driver.cmd = "logger-dump"
+    rest = b''
+    # the driver reports on the dump; we have our own report
+    with contextlib.redirect_stderr(io.StringIO()):
+        for data in chunks:
+            sentences, rest = nmea.parse_many(rest + data)
+            for status, fields in sentences:
+                if status == nmea.OK:
+                    driver.recv_sentence(fields)
+                else:
+                    result.bad_sentences += 1
+        if rest.strip():
+            status, fields = nmea.tokenize(rest)
+            if status == nmea.OK:
+                driver.recv_sentence(fields)
+            else:
+                result.bad_sentences += 1
+    if driver.log_total == 0 and len(driver.log_seqs) == 0:
+        raise Exception("no logger dump found")
+    result.points = len(sink.points)
+    result.invalid = driver.log_bytes // locus.RECORD_SIZE - driver.log_count
+    result.missing = driver.missing_chunks()
+    return sink.points
+
+def export(points:gpx.Points, path:str, settings:Settings) -> list[str]:
+    """
+    Write the points to the output(s) for the input path.
+    Returns the paths of the outputs.
+    """
+    base = os.path.join(settings.out_dir, os.path.splitext(os.path.basename(path))[0])
+    ext = FORMATS[settings.format]
+    if settings.split:
+        outputs:list[str] = []
+        for track in segment.segment(points, settings.rules).tracks:
+            out = segment.outing_path(base, ext, track.segs[0].points[0].ts, outputs)
+            write(out, gpx.Document([ track ]), settings.format)
+            outputs.append(out)
+        return outputs
+    out = base + ext
+    if settings.format == "gpx" and settings.rules is not None:
+        write(out, segment.segment(points, settings.rules), settings.format)
+    else:
+        write(out, gpx.Document.from_points(points), settings.format)
+    return [ out ]
+
+def write(path:str, doc:gpx.Document, format:str) -> None:
+    """
+    Write a document in the given format (the points of all of its segments,
+    in order, for formats other than GPX), atomically
+    """
+    pieces = [ seg.points for track in doc.tracks for seg in track.segs ]
+    tmp = f"{path}.tmp"
+    try:
+        if format == "gpx":
+            with open(tmp, 'wb') as file:
+                doc.write(file)
+        elif format == "rbx":
+            with archive.ArchiveWriter(tmp) as writer:
+                for points in pieces:
+                    writer.write(points)
+        else:
+            with open(tmp, 'w', encoding='utf-8') as text:
+                archive.EXPORTS[format](pieces, text)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def sha256(path:str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while data := file.read(READ_SIZE):
+            h.update(data)
+    return h.hexdigest()
+
+def convert(path:str, settings:Settings, prev:Optional[dict] = None) -> Result:
+    """
+    Convert one input, unless it (and the settings) are unchanged since it
+    was converted (as recorded in prev; see State)
+    """
+    start = time.monotonic()
+    result = Result(path)
+    try:
+        result.size = os.path.getsize(path)
+        result.sha256 = sha256(path)
+        if (prev is not None and prev.get("sha256") == result.sha256 and prev.get("settings") == settings.key() and
+            all(os.path.exists(out) for out in prev.get("outputs", []))):
+            result.skipped = True
+            result.outputs = prev["outputs"]
+            result.points = prev.get("points", 0)
+            return result
+        points = decode(read_chunks(path), result)
+        result.outputs = export(points, path, settings)
+    except Exception as e:
+        result.error = str(e)
+    result.seconds = time.monotonic() - start
+    return result
+
+class State:
+    """
+    What was converted in earlier runs: input path -> sha256, settings,
+    outputs (see convert)
+    """
+    def __init__(self, out_dir:str):
+        self.path = os.path.join(out_dir, STATE_FILE)
+        self.inputs:dict[str,dict] = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                self.inputs = json.load(file)
+
+    def get(self, path:str) -> Optional[dict]:
+        return self.inputs.get(os.path.abspath(path))
+
+    def update(self, result:Result, settings:Settings) -> None:
+        if result.error is not None:
+            self.inputs.pop(os.path.abspath(result.input), None)
+            return
+        self.inputs[os.path.abspath(result.input)] = {
+            "sha256": result.sha256,
+            "settings": settings.key(),
+            "outputs": result.outputs,
+            "points": result.points,
+        }
+
+    def save(self) -> None:
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as file:
+            json.dump(dict(sorted(self.inputs.items())), file, indent=1)
+        os.replace(tmp, self.path)
+
+def _convert(args:tuple[str,Settings,Optional[dict]]) -> Result:
+    return convert(*args)
+
+def convert_all(paths:list[str], settings:Settings, jobs:Optional[int] = None, out:Any = sys.stderr) -> list[Result]:
+    """
+    Convert the inputs, using a pool of jobs processes (one per CPU, by
+    default), reporting on each one (in order) as it completes
+    """
+    os.makedirs(settings.out_dir, exist_ok=True)
+    # outputs are named after the inputs, so they must be distinct
+    names:dict[str,str] = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            raise Exception(f"inputs would have the same output: {names[name]} and {path}")
+        names[name] = path
+    state = State(settings.out_dir)
+    work = [ (path, settings, state.get(path)) for path in paths ]
+    start = time.monotonic()
+    results:list[Result] = []
+    with _pool(jobs, len(work)) as pool:
+        for result in (pool.map(_convert, work) if pool is not None else map(_convert, work)):
+            print(result, file=out)
+            state.update(result, settings)
+            results.append(result)
+    state.save()
+    elapsed = time.monotonic() - start
+    done = [ r for r in results if not r.skipped and r.error is None ]
+    size = sum(r.size for r in done)
+    points = sum(r.points for r in done)
+    failed = sum(1 for r in results if r.error is not None)
+    print(f"converted {len(done)} files ({size} bytes, {points} points) in {elapsed:.2f}s" +
+          (f": {size/elapsed/1e6:.1f} MB/s, {points/elapsed:.0f} points/s" if elapsed > 0 else "") +
+          f"; {len(results)-len(done)-failed} unchanged, {failed} failed", file=out)
+    return results
+
+@contextlib.contextmanager
+def _pool(jobs:Optional[int], n:int) -> Iterator[Optional[Executor]]:
+    if jobs == 1 or n <= 1:
+        yield None
+        return
+    # python -m rattlebox is not safe to re-import, so workers are forked
+    # (rather than spawned) where possible
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork") if "fork" in methods else None
+    with ProcessPoolExecutor(min(jobs or os.cpu_count() or 1, n), mp_context=ctx) as pool:
+        yield pool
+
+def main(args:list[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox convert",
+                                     description="Convert capture files and text dumps of the logger to GPX (or another format)")
+    parser.add_argument("inputs", nargs="+", help="input files, or directories")
+    parser.add_argument("-o", "--out", required=True, help="output directory")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS), default="gpx")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument("--segment", action="store_true", help="split the log into tracks (outings) and segments")
+    parser.add_argument("--split", action="store_true", help="write each outing to its own file")
+    parser.add_argument("--outing-gap", type=int, default=segment.Rules.outing_gap, help="seconds")
+    parser.add_argument("--segment-gap", type=int, default=segment.Rules.segment_gap, help="seconds")
+    parser.add_argument("--max-jump", type=float, default=segment.Rules.max_jump, help="meters")
+    parser.add_argument("--force", action="store_true", help="convert all inputs, even if they have not changed")
+    opts = parser.parse_args(args)
+    rules = None
+    if opts.segment or opts.split:
+        rules = segment.Rules(opts.outing_gap, opts.segment_gap, opts.max_jump)
+    settings = Settings(opts.out, opts.format, rules, opts.split)
+    paths = inputs(opts.inputs)
+    if len(paths) == 0:
+        print("no inputs found", file=sys.stderr)
+        return 1
+    if opts.force:
+        state = State(opts.out)
+        if os.path.exists(state.path):
+            os.remove(state.path)
+    try:
+        results = convert_all(paths, settings, opts.jobs)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 2 if any(r.error is not None for r in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,347 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Incremental handling of LOCUS log dumps.
+
+The driver hands each decoded $PMTKLOX,1 chunk to a Sink as it arrives,
+rather than collecting the whole log in memory.
+"""
+
+from typing import (BinaryIO, Optional, Self)
+from dataclasses import (dataclass, field)
+import json
+import os
+import sys
+import zlib
+import rattlebox.archive as archive
+import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.segment as segment
+
+class Sink:
+    """
+    Receives log data from the driver while the log is being dumped.
+    """
+    def begin(self, total:int) -> None:
+        """
+        Start of a log dump; total is the number of chunks that will follow
+        """
+        pass
+
+    def write(self, seq:int, points:gpx.Points) -> None:
+        """
+        Valid points decoded from chunk number seq
+        """
+        pass
+
+    def end(self) -> None:
+        """
+        End of the log dump
+        """
+        pass
+
+    def sync(self) -> int:
+        """
+        Make sure that everything written so far is on disk.
+        Returns the size of the output (if any).
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
+
+class MemorySink(Sink):
+    """
+    Collect all of the points in memory
+    """
+    def __init__(self):
+        self.points = gpx.Points()
+
+    def write(self, seq:int, points:gpx.Points) -> None:
+        self.points.extend(points)
+
+class GPXSink(Sink):
+    """
+    Write points to a GPX file as they arrive.
+    After each chunk, the file ends with a complete trkpt element, and the
+    file is fsync'ed every sync_every chunks, so a partially written file (say,
+    because the serial link dropped) can later be completed (see complete)
+    or resumed (resume=True).
+    If rules are given, the log is split into tracks and segments (see
+    segment); the points of a resumed dump continue in the last segment of
+    the file.
+    """
+    def __init__(self, path:str, pretty:bool = True, sync_every:int = 16, resume:bool = False, committed:int = 0,
+                 rules:Optional[segment.Rules] = None):
+        self.path = path
+        self.pretty = pretty
+        self.sync_every = sync_every
+        self.resume = resume
+        self.committed = committed # when resuming, discard anything after this offset (if >0)
+        self.out:Optional[BinaryIO] = None
+        self.writer:Optional[gpx.Writer] = None
+        self.rules = rules
+        self.segmenter:Optional[segment.Segmenter] = None
+        self.chunks = 0
+        self.ended = False
+
+    def begin(self, total:int) -> None:
+        if self.writer is not None:
+            return
+        if self.resume and os.path.exists(self.path):
+            self.out, self.writer = reopen(self.path, self.committed)
+        else:
+            self.out = open(self.path, 'wb')
+            self.writer = gpx.Writer(self.out, self.pretty)
+            self.writer.start_document()
+            self.writer.start_track()
+            self.writer.start_segment()
+            self.writer.flush()
+        if self.rules is not None:
+            # the first points go into the track and segment that are
+            # already open
+            self.segmenter = segment.Segmenter(segment.WriterOutput(self.writer), self.rules)
+            self.segmenter.resume()
+
+    def write(self, seq:int, points:gpx.Points) -> None:
+        if self.writer is None:
+            self.begin(0)
+        assert(self.writer is not None)
+        if self.segmenter is not None:
+            self.segmenter.add(points)
+        else:
+            self.writer.write_points(points)
+        self.writer.flush()
+        self.chunks += 1
+        if self.chunks % self.sync_every == 0:
+            self.sync()
+
+    def end(self) -> None:
+        if self.writer is None or self.ended:
+            return
+        if self.segmenter is not None:
+            self.segmenter.end()
+        else:
+            self.writer.end_segment()
+            self.writer.end_track()
+        self.writer.end_document()
+        self.sync()
+        self.ended = True
+
+    def sync(self) -> int:
+        if self.out is None:
+            return 0
+        if self.writer is not None:
+            self.writer.flush()
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        return self.out.tell()
+
+    def close(self) -> None:
+        """
+        Close the file. If the dump did not finish, the file is completed
+        so that it is well-formed GPX.
+        """
+        if self.out is None:
+            return
+        if not self.ended:
+            print(f"log dump did not finish; {self.path} is incomplete", file=sys.stderr)
+            self.end()
+        self.out.close()
+        self.out = None
+        self.writer = None
+
+class SegmentSink(Sink):
+    """
+    Split the log into tracks and segments as it arrives (see segment), and
+    write them to out; e.g., to write each outing to its own file
+    (segment.OutingFiles).
+    """
+    def __init__(self, out:segment.Output, rules:Optional[segment.Rules] = None):
+        self.out = out
+        self.segmenter = segment.Segmenter(out, rules)
+        self.ended = False
+
+    def write(self, seq:int, points:gpx.Points) -> None:
+        self.segmenter.add(points)
+        self.out.flush()
+
+    def end(self) -> None:
+        if not self.ended:
+            self.segmenter.end()
+            self.ended = True
+
+    def close(self) -> None:
+        self.end()
+        self.out.close()
+
+class ArchiveSink(Sink):
+    """
+    Write points to an archive (see archive) as they arrive.
+    Pending points are written (as a block) whenever the sink is synced, so
+    a partially written archive can be resumed (resume=True).
+    """
+    def __init__(self, path:str, compress:bool = True, resume:bool = False, committed:int = 0):
+        self.path = path
+        self.compress = compress
+        self.resume = resume
+        self.committed = committed # when resuming, discard anything after this offset (if >0)
+        self.writer:Optional[archive.ArchiveWriter] = None
+
+    def begin(self, total:int) -> None:
+        if self.writer is None:
+            self.writer = archive.ArchiveWriter(self.path, self.compress, append=self.resume, committed=self.committed)
+
+    def write(self, seq:int, points:gpx.Points) -> None:
+        if self.writer is None:
+            self.begin(0)
+        assert(self.writer is not None)
+        self.writer.write(points)
+
+    def end(self) -> None:
+        self.sync()
+
+    def sync(self) -> int:
+        return self.writer.sync() if self.writer is not None else 0
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def reopen(path:str, committed:int = 0) -> tuple[BinaryIO,gpx.Writer]:
+    """
+    Reopen a (possibly partial) GPX file written by GPXSink, positioned so that
+    more points can be appended to its last segment.
+    The file is truncated after its last complete trkpt element, at or before
+    the committed offset (if given).
+    """
+    out = open(path, 'r+b')
+    try:
+        head = out.read(4096)
+        pretty = head.startswith(b'<?xml')
+        size = out.seek(0, os.SEEK_END)
+        if committed > 0:
+            size = min(size, committed)
+        tail_start = max(0, size - 64*1024)
+        out.seek(tail_start)
+        tail = out.read(size - tail_start)
+        i = tail.rfind(b'</trkpt>')
+        if i >= 0:
+            pos = tail_start + i + len(b'</trkpt>') + (1 if pretty else 0)
+            open_tag = False
+        else:
+            i = head.find(b'<trkseg')
+            if i < 0:
+                raise Exception(f"not a GPX log file: {path}")
+            pos = i + len(b'<trkseg')
+            open_tag = True
+            if head[pos:pos+1] == b'>':
+                pos += 2 if pretty else 1
+                open_tag = False
+        out.truncate(pos)
+        out.seek(pos)
+        writer = gpx.Writer(out, pretty)
+        writer.resume(['gpx','trk','trkseg'], open_tag)
+        return out, writer
+    except:
+        out.close()
+        raise
+
+def complete(path:str) -> None:
+    """
+    Complete a partial GPX file written by GPXSink, so that it is well-formed.
+    """
+    out, writer = reopen(path)
+    with out:
+        writer.end_segment()
+        writer.end_track()
+        writer.end_document()
+
+@dataclass
+class Manifest:
+    """
+    Record of the LOCUS log chunks that have been ingested from a device,
+    keyed by the sequence number of the $PMTKLOX,1 message.
+    For each chunk, we keep the CRC-32 of each of its records, so that a
+    later dump can skip chunks that have not changed, and only decode the
+    new records of a chunk that has grown since the last dump. Records that
+    are all 0xFF are unwritten flash (a device pads the last chunk with
+    them), and are left out.
+    """
+    path:Optional[str] = None # where the manifest is saved
+    total:int = 0 # number of chunks in the latest dump
+    committed:int = 0 # size of the output file when the manifest was saved
+    chunks:dict[int,list[int]] = field(default_factory=dict) # seq -> crc32 of each written record
+
+    @classmethod
+    def load(cls, path:str) -> Self:
+        """
+        Load the manifest from the given file; returns an empty manifest
+        if there is no such file.
+        """
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, 'r') as file:
+            m = json.load(file)
+        chunks = { int(seq): [ int(crc) for crc in c ] for seq,c in m.get("chunks",{}).items() }
+        return cls(path, int(m.get("total",0)), int(m.get("committed",0)), chunks)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        m = {
+            "total": self.total,
+            "committed": self.committed,
+            "chunks": { str(seq): list(c) for seq,c in sorted(self.chunks.items()) },
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as file:
+            json.dump(m, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+
+    def reset(self) -> None:
+        self.total = 0
+        self.committed = 0
+        self.chunks.clear()
+
+    def check(self, seq:int, data:bytes) -> int:
+        """
+        Check the data of chunk seq against the manifest.
+        Returns the offset of the data that has not been ingested yet: past
+        the leading records that have already been ingested (unchanged), so
+        0 if the chunk is new (or has changed), and len(data) if there are
+        no new records.
+        If an ingested record of the first chunk has changed, the log has
+        been erased since the last dump, and the manifest is reset.
+        """
+        if seq not in self.chunks:
+            return 0
+        ingested = self.chunks[seq]
+        crcs = record_crcs(data)
+        if crcs[:len(ingested)] == ingested:
+            # (the rest may be unwritten)
+            return len(data) if len(crcs) == len(ingested) else len(ingested) * locus.RECORD_SIZE
+        if seq == 0:
+            self.reset()
+        return 0
+
+    def add(self, seq:int, data:bytes) -> None:
+        self.chunks[seq] = record_crcs(data)
+
+_UNWRITTEN = b'\xff' * locus.RECORD_SIZE
+
+def record_crcs(data:bytes) -> list[int]:
+    """
+    CRC-32 of each of the written records of a chunk (up to the first one
+    that is unwritten)
+    """
+    crcs:list[int] = []
+    for i in range(0, len(data) - len(data) % locus.RECORD_SIZE, locus.RECORD_SIZE):
+        rec = data[i:i+locus.RECORD_SIZE]
+        if rec == _UNWRITTEN:
+            break
+        crcs.append(zlib.crc32(rec))
+    return crcs
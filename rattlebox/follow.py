@@ -0,0 +1,393 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Real-time position stream (--follow).
+
+A Follower receives each complete epoch from the driver (see
+mt3339.Driver.on_fix), as soon as the sentence that ends it arrives (see
+nmea.Assembler.early), and:
+* drops fixes without a position, with a GGA fix quality below
+  min_quality, or with an HDOP above max_hdop
+* optionally smooths the position (and estimates the velocity), with an
+  alpha-beta filter or a (constant velocity) Kalman filter
+* drops fixes that moved less than min_move meters since the last published
+  one, and limits the output to rate fixes per second; fixes that arrive
+  faster are coalesced (the latest one wins)
+* publishes the rest to its sinks: a stream (stdout), a file, or the
+  clients of a UNIX socket; one line per fix, as text or JSON (see FORMATS)
+
+Each published fix carries its latency (from the epoch being complete to
+it being published) and its age (from the time of the fix, by the device's
+clock, to it being published, by ours; this includes the receiver and the
+serial line, but is only meaningful if our clock is synchronized).
+"""
+
+from typing import (Callable, Optional, TextIO)
+from dataclasses import (asdict, dataclass)
+import json
+import math
+import os
+import socket
+import stat
+import time
+import rattlebox.analytics as analytics
+import rattlebox.metrics as metrics
+import rattlebox.nmea as nmea
+
+@dataclass
+class Settings:
+    """
+    How fixes are filtered, smoothed and published
+    """
+    min_quality:int = 1 # GGA fix quality: 1 - GPS, 2 - DGPS, ... (0 also accepts fixes without GGA)
+    max_hdop:float = 0 # drop fixes with a higher HDOP (0: no limit)
+    smooth:str = "none" # see SMOOTHERS
+    rate:float = 0 # fixes per second (0: no limit)
+    min_move:float = 0 # meters
+    format:str = "text" # see FORMATS
+    socket:Optional[str] = None # publish to the clients of this UNIX socket
+    file:Optional[str] = None # append to this file
+
+@dataclass
+class Position:
+    """
+    A published fix
+    """
+    ts:float # Unix/epoch (including the fraction of a second)
+    lat:float # decimal degrees
+    lon:float # decimal degrees
+    ele:float # meters
+    speed:float # meters per second
+    course:float # degrees true
+    quality:int
+    sats:int
+    hdop:float
+    latency:float = 0 # seconds
+    age:float = 0 # seconds
+
+def fix_time(fix:nmea.Fix) -> float:
+    """
+    Unix/epoch time of a fix, including the fraction of a second
+    """
+    return fix.ts + (fix.tod % 1 if fix.tod >= 0 else 0)
+
+def iso_time(ts:float) -> str:
+    """
+    ISO 8601 time (UTC), to the millisecond; e.g., 2020-08-11T21:06:40.200Z
+    """
+    ms = int(round(ts * 1000))
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ms // 1000))}.{ms % 1000:03d}Z"
+
+def format_text(pos:Position) -> str:
+    """
+    Line protocol: time, then key=value pairs
+    """
+    return (f"{iso_time(pos.ts)} lat={pos.lat:.6f} lon={pos.lon:.6f} ele={pos.ele:.1f} "
+            f"speed={pos.speed:.2f} course={pos.course:.1f} quality={pos.quality} sats={pos.sats} hdop={pos.hdop:.2f} "
+            f"latency_ms={pos.latency*1000:.2f} age_ms={pos.age*1000:.0f}")
+
+def format_json(pos:Position) -> str:
+    return json.dumps({ k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in asdict(pos).items() })
+
+FORMATS:dict[str,Callable[[Position],str]] = {
+    "text": format_text,
+    "json": format_json,
+}
+
+class Smoother:
+    """
+    Estimates the position (and velocity) from noisy measurements, in meters
+    on a local plane; the base class passes the measurements through
+    """
+    def update(self, dt:float, x:float, y:float, sigma:float) -> tuple[float,float,float,float]:
+        """
+        Add a measurement (x, y), with standard deviation sigma, dt seconds
+        after the previous one (dt < 0: this is the first). Returns the
+        estimated position and velocity (x, y, vx, vy); the velocity is NaN
+        if it is not estimated.
+        """
+        return x, y, math.nan, math.nan
+
+class AlphaBeta(Smoother):
+    """
+    Alpha-beta filter (for each axis)
+    """
+    def __init__(self, alpha:float = 0.5, beta:float = 0.1):
+        self.alpha = alpha
+        self.beta = beta
+        self.state = [0.0, 0.0, 0.0, 0.0] # x, y, vx, vy
+
+    def update(self, dt:float, x:float, y:float, sigma:float) -> tuple[float,float,float,float]:
+        s = self.state
+        if dt < 0:
+            self.state = [x, y, 0.0, 0.0]
+            return x, y, 0.0, 0.0
+        for i, z in ((0, x), (1, y)):
+            p = s[i] + s[i+2] * dt
+            r = z - p
+            s[i] = p + self.alpha * r
+            if dt > 0:
+                s[i+2] += self.beta * r / dt
+        return s[0], s[1], s[2], s[3]
+
+class Kalman(Smoother):
+    """
+    Kalman filter with a constant velocity model (for each axis); accel is
+    the standard deviation of the (unmodeled) acceleration (m/s^2)
+    """
+    def __init__(self, accel:float = 1.0):
+        self.q = accel * accel
+        self.axes:list[list[float]] = [] # per axis: position, velocity, and covariance (p00, p01, p11)
+
+    def update(self, dt:float, x:float, y:float, sigma:float) -> tuple[float,float,float,float]:
+        r = sigma * sigma
+        if dt < 0:
+            self.axes = [ [z, 0.0, r, 0.0, 100.0] for z in (x, y) ]
+            return x, y, 0.0, 0.0
+        q = self.q
+        for a, z in zip(self.axes, (x, y)):
+            p, v, p00, p01, p11 = a
+            # predict
+            p += v * dt
+            p00 += 2 * dt * p01 + dt * dt * p11 + q * dt**4 / 4
+            p01 += dt * p11 + q * dt**3 / 2
+            p11 += q * dt * dt
+            # update
+            s = p00 + r
+            k0, k1 = p00 / s, p01 / s
+            e = z - p
+            a[:] = [ p + k0 * e, v + k1 * e, (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01 ]
+        return self.axes[0][0], self.axes[1][0], self.axes[0][1], self.axes[1][1]
+
+SMOOTHERS:dict[str,Callable[[],Smoother]] = {
+    "none": Smoother,
+    "alpha-beta": AlphaBeta,
+    "kalman": Kalman,
+}
+
+UERE = 4.0 # meters; user equivalent range error (position error = HDOP * UERE)
+MAX_GAP = 10.0 # seconds; the smoother starts over after a longer gap
+
+class Sink:
+    """
+    Receives published fixes, as lines (without the line delimiter)
+    """
+    def publish(self, line:str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class StreamSink(Sink):
+    def __init__(self, out:TextIO):
+        self.out = out
+
+    def publish(self, line:str) -> None:
+        self.out.write(line + "\n")
+        self.out.flush()
+
+class FileSink(StreamSink):
+    """
+    Append to a file
+    """
+    def __init__(self, path:str):
+        super().__init__(open(path, 'a', encoding='utf-8'))
+
+    def close(self) -> None:
+        self.out.close()
+
+class SocketSink(Sink):
+    """
+    Serve the fixes to the clients of a UNIX (stream) socket. Clients that
+    do not keep up (their socket buffer is full) are disconnected, rather
+    than holding up the others.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # left over from an earlier run
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.clients:list[socket.socket] = []
+        self.dropped = 0 # clients that were disconnected
+
+    def accept(self) -> None:
+        """
+        Accept the clients that are waiting to connect
+        """
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            client.setblocking(False)
+            self.clients.append(client)
+
+    def publish(self, line:str) -> None:
+        self.accept()
+        data = (line + "\n").encode('utf-8')
+        for client in list(self.clients):
+            try:
+                if client.send(data) == len(data):
+                    continue
+            except OSError:
+                pass
+            # slow, or gone
+            self.clients.remove(client)
+            client.close()
+            self.dropped += 1
+
+    def close(self) -> None:
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def make_sinks(settings:Settings, out:TextIO) -> list[Sink]:
+    """
+    The sinks for the settings: the socket and/or file, if given, or else
+    the out stream
+    """
+    sinks:list[Sink] = []
+    if settings.socket is not None:
+        sinks.append(SocketSink(settings.socket))
+    if settings.file is not None:
+        sinks.append(FileSink(settings.file))
+    if len(sinks) == 0:
+        sinks.append(StreamSink(out))
+    return sinks
+
+class Follower:
+    """
+    Filters, smooths, and publishes fixes to sinks (see the module
+    docstring). Call add with each complete epoch, and poll periodically
+    (e.g., while waiting for input), to publish coalesced fixes when they
+    are due.
+    """
+    def __init__(self, sinks:list[Sink], settings:Optional[Settings] = None, metrics:Optional[metrics.Metrics] = None,
+                 clock:Callable[[],float] = time.monotonic, wallclock:Callable[[],float] = time.time):
+        self.sinks = sinks
+        self.settings = settings if settings is not None else Settings()
+        self.metrics = metrics
+        self.clock = clock
+        self.wallclock = wallclock
+        self.format = FORMATS[self.settings.format]
+        self.smoother = SMOOTHERS[self.settings.smooth]()
+        self.interval = 1 / self.settings.rate if self.settings.rate > 0 else 0
+        self.origin:Optional[tuple[float,float]] = None # of the smoother's plane (lat, lon)
+        self.last_ts = 0.0 # of the last fix that was smoothed
+        self.published:Optional[Position] = None # the last published fix
+        self.published_at = -math.inf # when (clock)
+        self.pending:Optional[tuple[Position,float]] = None # coalesced fix, and when its epoch was complete
+        # counts
+        self.epochs = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.unmoved = 0
+        self.count = 0 # published
+
+    def add(self, fix:nmea.Fix) -> None:
+        """
+        A complete epoch
+        """
+        done = self.clock()
+        self.epochs += 1
+        reason = self.check(fix)
+        if reason is not None:
+            self.rejected += 1
+            self._count(f"follow.rejected.{reason}")
+            return
+        pos = self.position(fix)
+        if self.published is not None and self.settings.min_move > 0 and \
+            analytics.haversine(self.published.lat, self.published.lon, pos.lat, pos.lon) < self.settings.min_move:
+            self.unmoved += 1
+            self._count("follow.unmoved")
+            return
+        if self.pending is not None:
+            self.coalesced += 1
+            self._count("follow.coalesced")
+        self.pending = (pos, done)
+        self.poll()
+
+    def check(self, fix:nmea.Fix) -> Optional[str]:
+        """
+        Why the fix should be dropped (if it should)
+        """
+        if not fix.has_position():
+            return "position"
+        if fix.quality < self.settings.min_quality:
+            return "quality"
+        if self.settings.max_hdop > 0 and not (fix.hdop <= self.settings.max_hdop):
+            return "hdop"
+        return None
+
+    def position(self, fix:nmea.Fix) -> Position:
+        """
+        The (smoothed) position of a fix
+        """
+        ts = fix_time(fix)
+        lat, lon = fix.lat, fix.lon
+        speed, course = fix.speed, fix.course
+        dt = ts - self.last_ts
+        if self.origin is None or not (0 <= dt <= MAX_GAP):
+            self.origin = (lat, lon)
+            dt = -1
+        self.last_ts = ts
+        # (equirectangular projection around the origin)
+        lat0, lon0 = self.origin
+        scale = analytics.EARTH_RADIUS * math.pi / 180
+        coslat = math.cos(math.radians(lat0))
+        sigma = (fix.hdop if not math.isnan(fix.hdop) else 1.0) * UERE
+        x, y, vx, vy = self.smoother.update(dt, (lon - lon0) * scale * coslat, (lat - lat0) * scale, sigma)
+        lat = lat0 + y / scale
+        lon = lon0 + x / (scale * coslat)
+        if not math.isnan(vx):
+            speed = math.hypot(vx, vy)
+            course = math.degrees(math.atan2(vx, vy)) % 360
+        return Position(ts, lat, lon, fix.ele, speed, course, fix.quality, fix.sats, fix.hdop)
+
+    def wait(self, timeout:float) -> float:
+        """
+        How long to wait for input (at most timeout seconds), so that poll
+        is called when the pending fix is due
+        """
+        if self.pending is None:
+            return timeout
+        return max(0, min(timeout, self.published_at + self.interval - self.clock()))
+
+    def poll(self) -> None:
+        """
+        Publish the pending fix, if it is due
+        """
+        if self.pending is None:
+            return
+        now = self.clock()
+        if now - self.published_at < self.interval:
+            return
+        pos, done = self.pending
+        self.pending = None
+        pos.latency = now - done
+        pos.age = self.wallclock() - pos.ts
+        line = self.format(pos)
+        for sink in self.sinks:
+            sink.publish(line)
+        self.published = pos
+        self.published_at = now
+        self.count += 1
+        if self.metrics is not None:
+            self.metrics.count("follow.published")
+            self.metrics.observe("follow.latency_us", int(pos.latency * 1e6))
+            self.metrics.observe("follow.age_ms", int(pos.age * 1000))
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+    def _count(self, name:str) -> None:
+        if self.metrics is not None:
+            self.metrics.count(name)
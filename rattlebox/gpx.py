@@ -4,19 +4,24 @@
 GPX data model and serialization to XML
 """
 
-from typing import (Any,Self)
-from collections.abc import Mapping
+from typing import (TYPE_CHECKING,Any,BinaryIO,Iterable,Iterator,Optional,Self,TextIO,cast,overload)
+from collections.abc import (Mapping, Sized)
 from dataclasses import (dataclass, field)
+from array import array
+import calendar
 import io
-from xml.dom.minidom import parseString as parse_xml
-from xml.sax.saxutils import XMLGenerator
+import time
+from xml.sax.saxutils import (XMLGenerator, quoteattr)
 from xml.sax.xmlreader import AttributesNSImpl
 from datetime import (datetime,timezone)
 
+if TYPE_CHECKING:
+    import rattlebox.analytics as analytics
+
 GPX_NS = "http://www.topografix.com/GPX/1/1"
 NO_ATTRS = AttributesNSImpl({}, {})
 
-@dataclass
+@dataclass(slots=True)
 class Point:
     """
     A point on the surface of the earth recorded by a GPS receiver
@@ -45,24 +50,201 @@ class Point:
         xml.endElementNS(("", u'ele'), u'ele')
         xml.endElementNS(("", u'trkpt'), u'trkpt')
 
+class Points:
+    """
+    A compact sequence of points, stored column-wise in parallel typed arrays
+    (ts/lat/lon/ele/fix).
+    Slicing returns a view that shares the underlying arrays, and Point
+    objects are only created when an element is accessed.
+    Appending to a view that does not extend to the end of the underlying
+    arrays first copies the view's data (copy-on-write).
+    """
+    __slots__ = ('_ts','_lat','_lon','_ele','_fix','_start','_stop','_version')
+
+    def __init__(self, points:Iterable[Point]=()):
+        self._ts = array('I')
+        self._lat = array('d')
+        self._lon = array('d')
+        self._ele = array('i')
+        self._fix = array('B')
+        self._start = 0
+        self._stop = 0
+        self._version = 0
+        self.extend(points)
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    @overload
+    def __getitem__(self, i:int) -> Point: ...
+    @overload
+    def __getitem__(self, i:slice) -> 'Points': ...
+    def __getitem__(self, i:int|slice) -> 'Point|Points':
+        if isinstance(i,slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return Points(self[j] for j in range(start,stop,step))
+            view = Points.__new__(Points)
+            view._ts, view._lat, view._lon, view._ele, view._fix = self._ts, self._lat, self._lon, self._ele, self._fix
+            view._start = self._start + start
+            view._stop = self._start + max(start,stop)
+            view._version = 0
+            return view
+        n = len(self)
+        if i<0:
+            i += n
+        if i<0 or i>=n:
+            raise IndexError("point index out of range")
+        j = self._start + i
+        return Point(self._ts[j],self._lat[j],self._lon[j],self._ele[j])
+
+    def __iter__(self) -> Iterator[Point]:
+        for ts,lat,lon,ele in zip(*self.columns()[:4]):
+            yield Point(ts,lat,lon,ele)
+
+    def __eq__(self, other:object) -> bool:
+        if isinstance(other,Points):
+            return self.columns() == other.columns()
+        if isinstance(other,list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Points(len={len(self)})"
+
+    @property
+    def version(self) -> int:
+        """
+        Incremented whenever points are added (see analytics)
+        """
+        return self._version
+
+    def fix(self, i:int) -> int:
+        """
+        Return the fix type of the i'th point
+        """
+        return self._fix[self._start + range(len(self))[i]]
+
+    def columns(self) -> tuple[array,array,array,array,array]:
+        """
+        Return the (ts,lat,lon,ele,fix) columns of this sequence.
+        This is a copy of the data, unless the sequence covers all of the
+        underlying arrays.
+        """
+        cols = (self._ts,self._lat,self._lon,self._ele,self._fix)
+        if self._start==0 and self._stop==len(self._ts):
+            return cols
+        a, b = self._start, self._stop
+        return (cols[0][a:b],cols[1][a:b],cols[2][a:b],cols[3][a:b],cols[4][a:b])
+
+    def take(self, indices:Iterable[int]) -> 'Points':
+        """
+        Return a new sequence with the points at the given indices
+        """
+        indices = list(indices)
+        pts = Points()
+        dsts:tuple[array,...] = (pts._ts,pts._lat,pts._lon,pts._ele,pts._fix)
+        for src, dst in zip(self.columns(), dsts):
+            dst.extend([ src[i] for i in indices ])
+        pts._stop = len(pts._ts)
+        return pts
+
+    def nbytes(self) -> int:
+        """
+        Number of bytes used to store the points of this sequence
+        """
+        return sum(c.itemsize for c in (self._ts,self._lat,self._lon,self._ele,self._fix)) * len(self)
+
+    def append(self, pt:Point, fix:int=0) -> None:
+        self.__own()
+        self._ts.append(pt.ts)
+        self._lat.append(pt.lat)
+        self._lon.append(pt.lon)
+        self._ele.append(pt.ele)
+        self._fix.append(fix)
+        self._stop += 1
+        self._version += 1
+
+    def extend(self, points:Iterable[Point]) -> None:
+        if isinstance(points,Points):
+            self.extend_columns(*points.columns())
+        else:
+            for pt in points:
+                self.append(pt)
+
+    def extend_columns(self, ts:Iterable[int], lat:Iterable[float], lon:Iterable[float], ele:Iterable[int], fix:Optional[Iterable[int]]=None) -> None:
+        """
+        Append points given as columns (e.g., locus.Records).
+        All columns must have the same length; if they don't (or a value
+        does not fit its column), the points are left unchanged.
+        """
+        cols = [ c if isinstance(c,Sized) else list(c) for c in (ts,lat,lon,ele) ]
+        k = len(cols[0])
+        if fix is not None:
+            cols.append(fix if isinstance(fix,Sized) else list(fix))
+        if any(len(c) != k for c in cols):
+            raise Exception("column lengths do not match")
+        self.__own()
+        n = len(self._ts)
+        dsts:list[array] = [self._ts,self._lat,self._lon,self._ele,self._fix]
+        try:
+            for dst, src in zip(dsts,cols):
+                _extend(dst,src)
+            if fix is None:
+                self._fix.extend(bytes(k))
+        except:
+            for dst in dsts:
+                del dst[n:]
+            raise
+        self._stop = n + k
+        self._version += 1
+
+    def __own(self) -> None:
+        # make sure that we can append to the underlying arrays
+        if self._stop != len(self._ts) or self._start != 0:
+            self._ts, self._lat, self._lon, self._ele, self._fix = (array(c.typecode,c) for c in self.columns())
+            self._start = 0
+            self._stop = len(self._ts)
+
+def _extend(dst:array, src:Iterable) -> None:
+    if isinstance(src,array) and src.typecode != dst.typecode:
+        dst.fromlist(src.tolist())
+    else:
+        dst.extend(src)
+
 @dataclass
 class Segment:
     """
     A segment of a GPS track
     """
-    points: list[Point] = field(default_factory=list)
+    points: Points = field(default_factory=Points)
+    # cached statistics: (points, points.version, stats)
+    _stats: Optional[tuple[Points,int,Any]] = field(default=None, init=False, repr=False, compare=False)
+    def __post_init__(self) -> None:
+        if not isinstance(self.points,Points):
+            self.points = Points(self.points)
+    def stats(self) -> 'analytics.Stats':
+        """
+        Distance, speed, etc. (see analytics); cached until the points change
+        """
+        import rattlebox.analytics as analytics
+        cached = self._stats
+        if cached is not None and cached[0] is self.points and cached[1] == self.points.version:
+            return cached[2]
+        stats = analytics.stats(self.points)
+        self._stats = (self.points, self.points.version, stats)
+        return stats
     def len(self) -> int:
         return len(self.points)
     def add_point(self, pt:Point) -> None:
         self.points.append(pt)
-    def add_points(self, pts:list[Point]) -> None:
-        for pt in pts:
-            self.points.append(pt)
+    def add_points(self, pts:Iterable[Point]) -> None:
+        self.points.extend(pts)
     def to_xml(self, xml:XMLGenerator) -> None:
-        xml.startElementNS(("", u'trkseg'), u'trk', NO_ATTRS)
+        xml.startElementNS(("", u'trkseg'), u'trkseg', NO_ATTRS)
         for pt in self.points:
             pt.to_xml(xml)
-        xml.endElementNS(("", u'trkseg'), u'trk')
+        xml.endElementNS(("", u'trkseg'), u'trkseg')
 
 @dataclass
 class Track:
@@ -72,6 +254,23 @@ class Track:
     segs: list[Segment] = field(default_factory=list)
     def add_seg(self, seg:Segment) -> None:
         self.segs.append(seg)
+    def add_points(self, points:Iterable[Point]) -> Segment:
+        """
+        Add the given points as a new segment.
+        If points is a Points sequence, the segment shares its storage.
+        """
+        seg = Segment(points if isinstance(points,Points) else Points(points))
+        self.add_seg(seg)
+        return seg
+    def stats(self) -> 'analytics.Stats':
+        """
+        Statistics of all of the segments of this track
+        """
+        import rattlebox.analytics as analytics
+        stats = analytics.Stats()
+        for seg in self.segs:
+            stats = stats.merge(seg.stats())
+        return stats
     def to_xml(self, xml:XMLGenerator) -> None:
         xml.startElementNS(("", u'trk'), u'trk', NO_ATTRS)
         for seg in self.segs:
@@ -90,39 +289,183 @@ class Document:
 
     def to_xml(self, pretty:bool = True) -> str:
         out = io.StringIO()
-        xml = XMLGenerator(out, 'utf-8', True)
-        root_attr_names = map({ 
-            ("", u'xmlns'): u'xmlns', 
-            ("",u'version'): u'version',
-            ("",u'creator'): u'creator',
-        })
-        root_attr_vals = map({ 
-            ("", u'xmlns'): GPX_NS, 
-            ("",u'version'): u'1.1',
-            ("",u'creator'): u'rattlebox',
-        })
-        root_attrs = AttributesNSImpl(root_attr_vals, root_attr_names)
-        xml.startElementNS(("", u'gpx'), u'gpx', root_attrs)
+        self.write(out, pretty)
+        return out.getvalue()
+
+    def write(self, out:TextIO|BinaryIO, pretty:bool = True) -> None:
+        """
+        Write this document as GPX to the given (text or binary) file
+        """
+        writer = Writer(out, pretty)
+        writer.start_document()
         for track in self.tracks:
-            track.to_xml(xml)
-        xml.endElementNS(("", u'gpx'), u'gpx')
-        xml.endDocument()
-        gpx_str = out.getvalue()
-        if pretty:
-            dom = parse_xml(gpx_str)
-            gpx_str = dom.toprettyxml(indent="  ")
-        return gpx_str
+            writer.start_track()
+            for seg in track.segs:
+                writer.start_segment()
+                writer.write_points(seg.points)
+                writer.end_segment()
+            writer.end_track()
+        writer.end_document()
 
     @classmethod
-    def from_points(cls,points:list[Point]) -> Self:
-        seg = Segment()
-        seg.add_points(points)
+    def from_points(cls,points:Iterable[Point]) -> Self:
         track = Track()
-        track.add_seg(seg)
+        track.add_points(points)
         doc = cls()
         doc.add_track(track)
         return doc
 
+class Writer:
+    """
+    Streaming GPX serializer.
+    Elements are written to the output as they are added, in chunks of
+    (roughly) chunk_size characters, so memory use does not depend on the
+    number of points. The output is the same as that of
+    XMLGenerator (pretty=False) or of minidom's toprettyxml (pretty=True).
+    """
+    INDENT = "  "
+
+    def __init__(self, out:TextIO|BinaryIO, pretty:bool = True, chunk_size:int = 64*1024):
+        self.out = out
+        self.pretty = pretty
+        self.chunk_size = chunk_size
+        self.buf:list[str] = []
+        self.buf_len = 0
+        self.stack:list[str] = [] # open elements
+        self.open_tag = False # is the start tag of the innermost element still open?
+
+    def start_document(self) -> None:
+        if self.pretty:
+            self._write('<?xml version="1.0" ?>\n')
+        self._start('gpx', f' xmlns={quoteattr(GPX_NS)} version="1.1" creator="rattlebox"')
+
+    def end_document(self) -> None:
+        self._end('gpx')
+        self.flush()
+
+    def resume(self, elements:list[str], open_tag:bool = False) -> None:
+        """
+        Continue writing inside the given, already written, elements; e.g.,
+        ['gpx','trk','trkseg'] when appending to a partially written file.
+        open_tag indicates that the start tag of the last element has not
+        been closed (with '>') yet.
+        """
+        self.stack = list(elements)
+        self.open_tag = open_tag
+
+    def start_track(self) -> None:
+        self._start('trk')
+
+    def end_track(self) -> None:
+        self._end('trk')
+
+    def start_segment(self) -> None:
+        self._start('trkseg')
+
+    def end_segment(self) -> None:
+        self._end('trkseg')
+
+    def write_points(self, points:Iterable[Point]) -> None:
+        """
+        Write trkpt elements for the given points, to the current segment
+        """
+        if self.pretty:
+            ind = self.INDENT * len(self.stack)
+            fmt = (f'{ind}<trkpt lat="%s" lon="%s">\n{ind}{self.INDENT}<time>%s</time>\n'
+                   f'{ind}{self.INDENT}<ele>%s</ele>\n{ind}</trkpt>\n')
+        else:
+            fmt = '<trkpt lat="%s" lon="%s"><time>%s</time><ele>%s</ele></trkpt>'
+        if isinstance(points,Points):
+            ts, lat, lon, ele, _ = points.columns()
+            rows:Iterable = zip(lat,lon,ts,ele)
+        else:
+            rows = ((pt.lat,pt.lon,pt.ts,pt.ele) for pt in points)
+        for lat_, lon_, ts_, ele_ in rows:
+            if self.open_tag:
+                self._close_tag()
+            self._write(fmt % (lat_, lon_, format_time(ts_), ele_))
+
+    def flush(self) -> None:
+        """
+        Write any buffered output to the underlying file
+        """
+        if len(self.buf)>0:
+            chunk = "".join(self.buf)
+            self.buf.clear()
+            self.buf_len = 0
+            if isinstance(self.out, io.TextIOBase):
+                self.out.write(chunk)
+            else:
+                cast(BinaryIO,self.out).write(chunk.encode('utf-8'))
+        self.out.flush()
+
+    def _start(self, name:str, attrs:str = "") -> None:
+        if self.open_tag:
+            self._close_tag()
+        ind = self.INDENT * len(self.stack) if self.pretty else ""
+        self._write(f"{ind}<{name}{attrs}")
+        self.stack.append(name)
+        self.open_tag = True
+
+    def _end(self, name:str) -> None:
+        if len(self.stack)==0 or self.stack[-1]!=name:
+            raise Exception(f"invalid GPX structure: unexpected end of {name}")
+        self.stack.pop()
+        nl = "\n" if self.pretty else ""
+        if self.open_tag:
+            self._write(f"/>{nl}")
+            self.open_tag = False
+        else:
+            ind = self.INDENT * len(self.stack) if self.pretty else ""
+            self._write(f"{ind}</{name}>{nl}")
+
+    def _close_tag(self) -> None:
+        self._write(">\n" if self.pretty else ">")
+        self.open_tag = False
+
+    def _write(self, s:str) -> None:
+        self.buf.append(s)
+        self.buf_len += len(s)
+        if self.buf_len >= self.chunk_size:
+            self.flush()
+
+def format_time(ts:int) -> str:
+    """
+    Format a Unix/epoch timestamp as an ISO 8601 string (UTC)
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(ts))
+
+_days:dict[str,int] = {}
+
+def parse_time(val:str) -> int:
+    """
+    Parse an ISO 8601 (xsd:dateTime) string, as used by GPX, into a
+    Unix/epoch timestamp; e.g., 2020-08-11T21:06:10Z, 2020-08-11T21:06:10.5+00:00
+    Fractional seconds are truncated.
+    """
+    if len(val) < 19 or val[10] not in "Tt" or val[13] != ":" or val[16] != ":":
+        raise ValueError(f"invalid time: {val}")
+    day = _days.get(val[:10])
+    if day is None:
+        day = calendar.timegm(time.strptime(val[:10], "%Y-%m-%d"))
+        if len(_days) < 4096:
+            _days[val[:10]] = day
+    ts = day + int(val[11:13])*3600 + int(val[14:16])*60 + int(val[17:19])
+    # skip fractional seconds, to the time zone (if any)
+    i = 19
+    n = len(val)
+    if i < n and val[i] == '.':
+        i += 1
+        while i < n and val[i].isdigit():
+            i += 1
+    tz = val[i:]
+    if tz in ("", "Z", "z", "+00:00", "-00:00"):
+        return ts
+    if len(tz) != 6 or tz[0] not in "+-" or tz[3] != ':':
+        raise ValueError(f"invalid time: {val}")
+    offset = int(tz[1:3])*3600 + int(tz[4:6])*60
+    return ts - offset if tz[0] == '+' else ts + offset
+
 def map(m:Mapping) -> Mapping:
     """
     Make mypy happy.
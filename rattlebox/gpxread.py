@@ -0,0 +1,172 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Streaming GPX reader.
+
+Tracks are read with an incremental (SAX-style) expat parser, straight into
+columnar gpx.Points, without building a DOM, so memory is bounded by the
+size of the pieces that are yielded (see iter_pieces), not by the size of
+the file.
+GPX 1.0 and 1.1 are supported; routes and waypoints are ignored.
+"""
+
+from typing import (BinaryIO, Iterable, Iterator, Optional)
+from array import array
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from xml.parsers import expat
+import rattlebox.gpx as gpx
+
+GPX_NAMESPACES = (
+    "http://www.topografix.com/GPX/1/0",
+    "http://www.topografix.com/GPX/1/1",
+)
+
+@dataclass
+class Piece:
+    """
+    Points read from a track segment. A long segment is yielded in several
+    pieces; last is set on the last piece of each segment.
+    """
+    track:int # index of the track in the file
+    seg:int # index of the segment in the track
+    points:gpx.Points
+    last:bool = True
+
+def iter_pieces(source:str|BinaryIO, max_points:int = 64*1024, chunk_size:int = 256*1024) -> Iterator[Piece]:
+    """
+    Read the track segments of a GPX file (given as a path or a binary file),
+    in pieces of at most max_points points.
+    Empty segments are yielded as a single (empty) piece.
+    """
+    if isinstance(source,str):
+        with open(source, 'rb') as file:
+            yield from iter_pieces(file, max_points, chunk_size)
+        return
+    reader = _Reader(max_points)
+    while True:
+        data = source.read(chunk_size)
+        reader.parser.Parse(data, not data)
+        yield from reader.pieces
+        reader.pieces.clear()
+        if not data:
+            break
+
+class _Reader:
+    """
+    Expat (SAX-style) handlers that collect trkpts into columns
+    """
+    def __init__(self, max_points:int):
+        self.max_points = max_points
+        self.pieces:list[Piece] = [] # completed pieces
+        self.track = -1
+        self.seg = -1
+        self.ts, self.lat, self.lon, self.ele = array('I'), array('d'), array('d'), array('i')
+        self.pt_ts = 0
+        self.pt_ele = 0
+        self.in_pt = False # inside a trkpt element
+        self.in_trk = False # inside a trk element
+        self.root = True # next element is the root
+        self.text:list[str] = [] # character data of the current element
+        self.names:dict[str,str] = {} # qualified name -> local name
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.buffer_text = True
+        self.parser.buffer_size = 64*1024
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.text.append
+
+    def name(self, qname:str) -> str:
+        name = self.names.get(qname)
+        if name is None:
+            ns, _, name = qname.rpartition(' ')
+            if ns and ns not in GPX_NAMESPACES:
+                # extensions, etc.
+                name = ""
+            self.names[qname] = name
+        return name
+
+    def start(self, qname:str, attrs:dict[str,str]) -> None:
+        name = self.names.get(qname)
+        if name is None:
+            name = self.name(qname)
+        self.text.clear()
+        if name == 'trkpt':
+            try:
+                self.lat.append(float(attrs['lat']))
+                self.lon.append(float(attrs['lon']))
+            except (KeyError, ValueError):
+                raise Exception(f"invalid trkpt: {attrs}")
+            self.in_pt = True
+            self.pt_ts = 0
+            self.pt_ele = 0
+        elif self.root:
+            if name != 'gpx':
+                raise Exception(f"not a GPX file: {qname}")
+            self.root = False
+        elif name == 'trkseg':
+            if not self.in_trk:
+                raise Exception("invalid GPX: trkseg outside of a trk")
+            self.seg += 1
+        elif name == 'trk':
+            self.track += 1
+            self.seg = -1
+            self.in_trk = True
+
+    def end(self, qname:str) -> None:
+        name = self.names[qname]
+        if not self.in_pt:
+            if name == 'trkseg':
+                self.piece(True)
+            elif name == 'trk':
+                self.in_trk = False
+            return
+        match name:
+            case 'trkpt':
+                self.ts.append(self.pt_ts)
+                self.ele.append(self.pt_ele)
+                self.in_pt = False
+                if len(self.ts) >= self.max_points:
+                    self.piece(False)
+            case 'time':
+                text = self.text[0] if len(self.text) == 1 else "".join(self.text)
+                if text:
+                    self.pt_ts = gpx.parse_time(text.strip())
+                    if not 0 <= self.pt_ts <= 0xffffffff:
+                        # (timestamps are unsigned 32-bit; see gpx.Points)
+                        raise Exception(f"invalid GPX: time out of range: {text.strip()}")
+            case 'ele':
+                text = "".join(self.text).strip()
+                if text:
+                    self.pt_ele = round(float(text))
+
+    def piece(self, last:bool) -> None:
+        points = gpx.Points()
+        points.extend_columns(self.ts, self.lat, self.lon, self.ele)
+        del self.ts[:], self.lat[:], self.lon[:], self.ele[:]
+        self.pieces.append(Piece(self.track, self.seg, points, last))
+
+def read(source:str|BinaryIO, max_points:int = 64*1024) -> gpx.Document:
+    """
+    Read the tracks of a GPX file into a document
+    """
+    doc = gpx.Document()
+    for p in iter_pieces(source, max_points):
+        while len(doc.tracks) <= p.track:
+            doc.add_track(gpx.Track())
+        track = doc.tracks[p.track]
+        if len(track.segs) <= p.seg:
+            track.add_seg(gpx.Segment())
+        track.segs[p.seg].add_points(p.points)
+    return doc
+
+def read_many(paths:Iterable[str], processes:Optional[int] = None) -> list[gpx.Document]:
+    """
+    Read many GPX files, in parallel, using a pool of processes (one per
+    CPU, by default). The documents are returned in the order of paths.
+    """
+    paths = list(paths)
+    if processes == 1 or len(paths) <= 1:
+        return [ read(path) for path in paths ]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(read, paths))
@@ -0,0 +1,269 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Spatial-temporal index of logged points.
+
+Points are stored in a SQLite database, in chunks of consecutive points
+(at most CHUNK_POINTS points, and never spanning a gap of more than
+CHUNK_GAP seconds or the end of a UTC day), so that each chunk covers a
+small box in time and space. The bounds of the chunks are kept in an R*Tree,
+so a bounding box, time range, or nearest point query only decodes the
+chunks that may contain matching points.
+
+Each chunk's points are stored as a blob of columns (in native byte order):
+* Timestamps (Unix/epoch) - 4 bytes each - unsigned long
+* Latitudes - 8 bytes each - double
+* Longitudes - 8 bytes each - double
+* Elevations - 4 bytes each - signed long
+
+Points are added by source (e.g., the GPX file written by a logger dump);
+adding a source again replaces its points, and add_file skips files that
+have not changed since they were added, so a collection of dumps can be indexed
+incrementally. The file of a delta dump (see dump.Manifest) only holds the
+points that are new since the previous dump, which is usually written to the
+same file; each delta is a source of its own (see add_file), so that it adds
+to the points of the previous ones, rather than replacing them.
+See also main, for querying an index from the command line.
+"""
+
+from typing import (Iterable, Iterator, Optional, Self)
+from array import array
+import math
+import os
+import sqlite3
+import sys
+import time
+import rattlebox.analytics as analytics
+import rattlebox.archive as archive
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+
+CHUNK_POINTS = 1024
+CHUNK_GAP = 600 # seconds
+DAY = 86400 # seconds
+
+BBox = tuple[float,float,float,float] # (min lat, min lon, max lat, max lon)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    mtime INTEGER NOT NULL DEFAULT 0,
+    points INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    source INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source);
+CREATE VIRTUAL TABLE IF NOT EXISTS bounds USING rtree(id, t0, t1, lat0, lat1, lon0, lon1);
+"""
+
+class Index:
+    """
+    An index in the given SQLite database file (created if it does not exist)
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def add(self, points:gpx.Points|Iterable[gpx.Points], name:str, size:int = 0, mtime:int = 0) -> int:
+        """
+        Add points (a sequence, or a sequence of pieces) from the named
+        source, replacing any points that were added from it before.
+        Returns the number of points added.
+        """
+        pieces = [ points ] if isinstance(points,gpx.Points) else points
+        with self.db:
+            self._remove(name)
+            cur = self.db.execute("INSERT INTO sources (name, size, mtime) VALUES (?, ?, ?)", (name, size, mtime))
+            source = cur.lastrowid
+            total = 0
+            for piece in pieces:
+                for chunk in chunks(piece):
+                    self._add_chunk(source, chunk)
+                    total += len(chunk)
+            self.db.execute("UPDATE sources SET points = ? WHERE id = ?", (total, source))
+        return total
+
+    def add_file(self, path:str, delta:bool = False) -> int:
+        """
+        Add the points of a GPX file (or an archive), unless it has not
+        changed since it was added. Returns the number of points added.
+        If delta is set, the file holds a delta dump: rather than replacing
+        the points that were added from the file before, each version of the
+        file (by modification time) is added as a source of its own.
+        """
+        st = os.stat(path)
+        name = os.path.abspath(path)
+        if delta:
+            name = f"{name}@{st.st_mtime_ns}"
+        row = self.db.execute("SELECT size, mtime FROM sources WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return 0
+        if archive.is_archive(path):
+            with archive.Archive(path) as arc:
+                return self.add(arc, name, st.st_size, st.st_mtime_ns)
+        return self.add((piece.points for piece in gpxread.iter_pieces(path)), name, st.st_size, st.st_mtime_ns)
+
+    def remove(self, name:str) -> None:
+        with self.db:
+            self._remove(name)
+
+    def sources(self) -> list[tuple[str,int]]:
+        """
+        The sources in the index, and the number of points from each
+        """
+        return self.db.execute("SELECT name, points FROM sources ORDER BY name").fetchall()
+
+    def __len__(self) -> int:
+        """
+        Number of points in the index
+        """
+        return self.db.execute("SELECT COALESCE(SUM(points), 0) FROM sources").fetchone()[0]
+
+    def query(self, bbox:Optional[BBox] = None, start:Optional[int] = None, end:Optional[int] = None) -> gpx.Points:
+        """
+        Points in the bounding box (inclusive), and in the time range
+        [start, end] (Unix/epoch; inclusive), in order of the chunks' start time
+        """
+        lat0, lon0, lat1, lon1 = bbox if bbox is not None else (-90, -180, 90, 180)
+        t0 = start if start is not None else 0
+        t1 = end if end is not None else 0xffffffff
+        rows = self.db.execute(
+            "SELECT b.t0, b.t1, b.lat0, b.lat1, b.lon0, b.lon1, c.n, c.data FROM bounds b JOIN chunks c ON c.id = b.id"
+            " WHERE b.t1 >= ? AND b.t0 <= ? AND b.lat1 >= ? AND b.lat0 <= ? AND b.lon1 >= ? AND b.lon0 <= ?"
+            " ORDER BY b.t0", (t0, t1, lat0, lat1, lon0, lon1))
+        result = gpx.Points()
+        for ct0, ct1, clat0, clat1, clon0, clon1, n, data in rows:
+            points = decode(n, data)
+            # the R*Tree rounds bounds outwards, so a chunk that is inside the
+            # query (by its bounds) matches as a whole
+            if not (t0 <= ct0 and ct1 <= t1 and lat0 <= clat0 and clat1 <= lat1 and lon0 <= clon0 and clon1 <= lon1):
+                ts, lat, lon, _, _ = points.columns()
+                points = points.take([ i for i, (t, y, x) in enumerate(zip(ts, lat, lon))
+                                       if t0 <= t <= t1 and lat0 <= y <= lat1 and lon0 <= x <= lon1 ])
+            result.extend(points)
+        return result
+
+    def nearest(self, lat:float, lon:float, k:int = 1, start:Optional[int] = None, end:Optional[int] = None) -> list[tuple[float,gpx.Point]]:
+        """
+        The (up to) k points closest to (lat, lon), with their distance (meters),
+        closest first
+        """
+        # search boxes of increasing size, until the k'th closest point is
+        # within the circle inscribed in the box
+        radius = 100.0
+        while True:
+            dlat = min(radius / analytics.EARTH_RADIUS * 180 / math.pi, 180)
+            coslat = math.cos(math.radians(lat))
+            dlon = min(dlat / coslat, 360) if coslat > 1e-9 else 360
+            points = self.query((lat - dlat, lon - dlon, lat + dlat, lon + dlon), start, end)
+            _, plat, plon, _, _ = points.columns()
+            found = sorted(zip(map(analytics.haversine, [lat]*len(points), [lon]*len(points), plat, plon), range(len(points))))
+            if (len(found) >= k and found[k-1][0] <= radius) or dlat >= 180:
+                return [ (d, points[i]) for d, i in found[:k] ]
+            radius *= 4
+
+    def _add_chunk(self, source:Optional[int], points:gpx.Points) -> None:
+        ts, lat, lon, ele, _ = points.columns()
+        data = b''.join([ array('I', ts).tobytes(), array('d', lat).tobytes(), array('d', lon).tobytes(), array('i', ele).tobytes() ])
+        cur = self.db.execute("INSERT INTO chunks (source, n, data) VALUES (?, ?, ?)", (source, len(points), data))
+        self.db.execute("INSERT INTO bounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (cur.lastrowid, min(ts), max(ts), min(lat), max(lat), min(lon), max(lon)))
+
+    def _remove(self, name:str) -> None:
+        row = self.db.execute("SELECT id FROM sources WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM bounds WHERE id IN (SELECT id FROM chunks WHERE source = ?)", row)
+        self.db.execute("DELETE FROM chunks WHERE source = ?", row)
+        self.db.execute("DELETE FROM sources WHERE id = ?", row)
+
+def chunks(points:gpx.Points) -> Iterator[gpx.Points]:
+    """
+    Split points into chunks (see CHUNK_POINTS, CHUNK_GAP)
+    """
+    ts = points.columns()[0]
+    cuts = [ i+1 for i, (t1, t2) in enumerate(zip(ts, ts[1:])) if not (0 <= t2 - t1 <= CHUNK_GAP) or t1 // DAY != t2 // DAY ]
+    start = 0
+    for stop in cuts + [ len(points) ]:
+        for i in range(start, stop, CHUNK_POINTS):
+            yield points[i:min(i+CHUNK_POINTS, stop)]
+        start = stop
+
+def decode(n:int, data:bytes) -> gpx.Points:
+    """
+    The points of a chunk
+    """
+    ts, lat, lon, ele = array('I'), array('d'), array('d'), array('i')
+    mv = memoryview(data)
+    off = 0
+    for col in (ts, lat, lon, ele):
+        size = n * col.itemsize
+        col.frombytes(mv[off:off+size])
+        off += size
+    points = gpx.Points()
+    points.extend_columns(ts, lat, lon, ele)
+    return points
+
+def main(args:list[str]) -> None:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox.index", description="Index GPX files, and query the index")
+    parser.add_argument("db", help="index database file")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    add = sub.add_parser("add", help="add (or update) GPX files or archives")
+    add.add_argument("files", nargs="+")
+    add.add_argument("--delta", action="store_true", help="the files hold delta dumps (see --manifest); add to their earlier versions")
+    sub.add_parser("list", help="list the indexed files")
+    query = sub.add_parser("query", help="write the points in a bounding box and/or time range, as GPX")
+    query.add_argument("--bbox", help="min-lat,min-lon,max-lat,max-lon")
+    query.add_argument("--start", help="e.g., 2024-03-01T00:00:00Z")
+    query.add_argument("--end", help="e.g., 2024-04-01T00:00:00Z")
+    near = sub.add_parser("nearest", help="list the points closest to a location")
+    near.add_argument("lat", type=float)
+    near.add_argument("lon", type=float)
+    near.add_argument("-k", type=int, default=1, help="number of points")
+    opts = parser.parse_args(args)
+    with Index(opts.db) as index:
+        match opts.cmd:
+            case "add":
+                for path in opts.files:
+                    t = time.monotonic()
+                    n = index.add_file(path, opts.delta)
+                    print(f"{path}: " + (f"added {n} points in {time.monotonic()-t:.2f}s" if n > 0 else "unchanged"), file=sys.stderr)
+            case "list":
+                for name, n in index.sources():
+                    print(f"{name}: {n} points")
+            case "query":
+                bbox:Optional[BBox] = None
+                if opts.bbox is not None:
+                    v = [ float(s) for s in opts.bbox.split(",") ]
+                    if len(v) != 4:
+                        parser.error(f"invalid bounding box: {opts.bbox}")
+                    bbox = (v[0], v[1], v[2], v[3])
+                start = gpx.parse_time(opts.start) if opts.start is not None else None
+                end = gpx.parse_time(opts.end) if opts.end is not None else None
+                t = time.monotonic()
+                points = index.query(bbox, start, end)
+                print(f"{len(points)} points in {time.monotonic()-t:.3f}s", file=sys.stderr)
+                gpx.Document.from_points(points).write(sys.stdout)
+            case "nearest":
+                for d, pt in index.nearest(opts.lat, opts.lon, opts.k):
+                    print(f"{d:.1f} m: {gpx.format_time(pt.ts)} {pt.lat} {pt.lon} {pt.ele}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
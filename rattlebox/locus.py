@@ -0,0 +1,232 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Batch decoding of LOCUS log data.
+
+A LOCUS "basic" record is 16 bytes, little-endian:
+* Timestamp (Unix/epoch UTC) - u32
+* Fix type - u8
+* Latitude (decimal degrees) - f32
+* Longitude (decimal degrees) - f32
+* Elevation (meters) - u16
+* Checksum - u8 - xor of the previous 15 bytes
+
+Rather than decoding one record at a time, the functions here take a whole
+dump (or the payloads of many $PMTKLOX,1 messages) and decode it in one pass,
+returning the result as parallel arrays (columns).
+
+Status is the state of the logger (the response to logger-status), which
+tells how big a dump of the log is going to be.
+"""
+
+from typing import (Iterable, Self)
+from array import array
+from dataclasses import (dataclass, field)
+from itertools import compress
+import struct
+import rattlebox.gpx as gpx
+
+RECORD = struct.Struct('<IBffHB')
+RECORD_SIZE = RECORD.size # 16
+
+# Valid timestamp range: [2001-01-01 ... 2100-01-01]; same as gpx.Point.is_valid
+TS_MIN = 978325200
+TS_MAX = 4102462800
+
+# fix types that we accept (2: 3D fix; 4: seen on real devices)
+VALID_FIX = (2, 4)
+_FIX_TABLE = bytes(1 if i in VALID_FIX else 0 for i in range(256))
+_ZERO_TABLE = bytes(1 if i==0 else 0 for i in range(256))
+
+# bytes of log data per $PMTKLOX,1 message (24 words)
+CHUNK_SIZE = 96
+
+# size of the LOCUS flash (about 16 hours of records at 15s intervals)
+FLASH_SIZE = 64*1024
+
+# logging modes (bits of Status.mode)
+MODES = {
+    0x01: "AlwaysLocate",
+    0x02: "FixOnly",
+    0x04: "Normal",
+    0x08: "Interval",
+    0x10: "Distance",
+    0x20: "Speed",
+}
+
+@dataclass
+class Records:
+    """
+    Decoded LOCUS records, stored as columns.
+    """
+    ts: array = field(default_factory=lambda: array('I'))
+    fix: array = field(default_factory=lambda: array('B'))
+    lat: array = field(default_factory=lambda: array('f'))
+    lon: array = field(default_factory=lambda: array('f'))
+    ele: array = field(default_factory=lambda: array('H'))
+    bad_checksum: int = 0 # number of records skipped due to checksum mismatch
+    invalid: int = 0 # number of records skipped due to bad fix type or timestamp
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def extend(self, other:Self) -> None:
+        self.ts.extend(other.ts)
+        self.fix.extend(other.fix)
+        self.lat.extend(other.lat)
+        self.lon.extend(other.lon)
+        self.ele.extend(other.ele)
+        self.bad_checksum += other.bad_checksum
+        self.invalid += other.invalid
+
+    def columns(self) -> tuple[array,array,array,array,array]:
+        """
+        Return the (ts,lat,lon,ele,fix) columns; see gpx.Points.extend_columns
+        """
+        return (self.ts,self.lat,self.lon,self.ele,self.fix)
+
+    def to_points(self) -> list[gpx.Point]:
+        return [ gpx.Point(ts,lat,lon,ele) for ts,lat,lon,ele in zip(self.ts,self.lat,self.lon,self.ele) ]
+
+@dataclass
+class Status:
+    """
+    Status of the logger, from its response to logger-status (PMTK183):
+    $PMTKLOG,serial,type,mode,content,interval,distance,speed,status,records,percent
+    """
+    serial: int = 0 # serial number of the log
+    overlap: bool = False # when the flash is full, overwrite the oldest records (otherwise, stop logging)
+    mode: int = 0 # bitmask of MODES
+    content: int = 0 # what is logged (1: basic records)
+    interval: int = 0 # seconds between records, when logging by interval
+    distance: int = 0 # meters between records, when logging by distance
+    speed: int = 0 # logging by speed (above this speed)
+    logging: bool = False # otherwise, logging is stopped
+    records: int = 0 # number of records in the log
+    percent: int = 0 # of the flash that is used
+
+    @classmethod
+    def parse(cls, fields:list[str]) -> Self:
+        """
+        Parse the fields of a $PMTKLOG message (see nmea.parse_sentence)
+        """
+        if len(fields) != 11 or fields[0] != "$PMTKLOG":
+            raise Exception(f"invalid logger status: {fields}")
+        try:
+            v = [ int(f) for f in fields[1:] ]
+        except ValueError:
+            raise Exception(f"invalid logger status: {fields}")
+        return cls(serial=v[0], overlap=v[1]==0, mode=v[2], content=v[3], interval=v[4], distance=v[5], speed=v[6],
+                   logging=v[7]==0, records=v[8], percent=v[9])
+
+    def modes(self) -> list[str]:
+        return [ name for bit, name in MODES.items() if self.mode & bit ]
+
+    def data_size(self) -> int:
+        """
+        Bytes of log data in a dump
+        """
+        return self.records * RECORD_SIZE
+
+    def chunks(self) -> int:
+        """
+        Number of $PMTKLOX,1 messages in a dump
+        """
+        return (self.data_size() + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def dump_size(self) -> int:
+        """
+        Bytes of the messages of a dump: the data is sent as hex-encoded
+        words, 9 bytes ("," and 8 hex digits) for every 4 bytes of data
+        """
+        chunks = self.chunks()
+        start = len(f"$PMTKLOX,0,{chunks}*00\r\n")
+        end = len("$PMTKLOX,2*00\r\n")
+        data = chunks * len("$PMTKLOX,1,*00\r\n") + sum(len(str(seq)) for seq in range(chunks)) + self.data_size() * 9 // 4
+        return start + data + end
+
+    def dump_time(self, baudrate:int) -> float:
+        """
+        Seconds that a dump takes at the given baud rate (10 bits per byte),
+        if nothing else is sent by the device in the meantime
+        """
+        return self.dump_size() * 10 / baudrate
+
+    def __str__(self) -> str:
+        state = "logging" if self.logging else "stopped"
+        full = "overwrites oldest records" if self.overlap else "stops"
+        return (f"log #{self.serial}: {state}, {self.records} records ({self.percent}% of flash), " +
+                f"mode {'+'.join(self.modes()) or 'none'}, interval {self.interval}s; when full, {full}")
+
+def decode(data:bytes) -> Records:
+    """
+    Decode a buffer of 16-byte LOCUS records.
+    Records with a bad checksum, an unexpected fix type, or an out-of-range
+    timestamp are skipped.
+    """
+    if len(data)%RECORD_SIZE != 0:
+        raise Exception("invalid LOCUS data: length is not a multiple of the record size")
+    recs = Records()
+    n = len(data)//RECORD_SIZE
+    if n==0:
+        return recs
+    chk_ok = checksums(data).translate(_ZERO_TABLE)
+    fix_ok = data[4::RECORD_SIZE].translate(_FIX_TABLE)
+    ok = (int.from_bytes(chk_ok,"little") & int.from_bytes(fix_ok,"little")).to_bytes(n,"little")
+    rows = [ r for r in compress(RECORD.iter_unpack(data),ok) if TS_MIN <= r[0] <= TS_MAX ]
+    recs.bad_checksum = n - chk_ok.count(1)
+    recs.invalid = n - recs.bad_checksum - len(rows)
+    if len(rows)>0:
+        ts, fix, lat, lon, ele, _ = zip(*rows)
+        recs.ts.extend(ts)
+        recs.fix.extend(fix)
+        recs.lat.extend(lat)
+        recs.lon.extend(lon)
+        recs.ele.extend(ele)
+    return recs
+
+def decode_words(words:Iterable[str]) -> Records:
+    """
+    Decode LOCUS data given as a sequence of hex-encoded words, e.g., the
+    data fields of one or more $PMTKLOX,1 messages.
+    """
+    return decode(bytes.fromhex("".join(words)))
+
+def decode_lox(messages:Iterable[list[str]]) -> Records:
+    """
+    Decode the data of many $PMTKLOX,1 messages at once.
+    Each message is given as its list of fields (see nmea.parse_sentence).
+    Messages other than $PMTKLOX,1 are ignored.
+    """
+    words:list[str] = []
+    for fields in messages:
+        if len(fields)>3 and fields[0]=="$PMTKLOX" and fields[1]=='1':
+            words.extend(fields[3:])
+    return decode_words(words)
+
+def checksums(data:bytes) -> bytes:
+    """
+    Compute the xor of all 16 bytes of each record in the given buffer.
+    The result has one byte per record, which is zero when the record's
+    checksum byte matches.
+    The whole buffer is treated as a single (large) integer, and each 16-byte
+    lane is folded in half until a single byte remains.
+    """
+    n = len(data)//RECORD_SIZE
+    x = int.from_bytes(data[:n*RECORD_SIZE],"little")
+    for width in (8,4,2,1):
+        x ^= x >> (width*8)
+        x &= _lane_mask(n,width)
+    return x.to_bytes(n*RECORD_SIZE,"little")[::RECORD_SIZE]
+
+def encode(ts:int, fix:int, lat:float, lon:float, ele:int) -> bytes:
+    """
+    Encode a single LOCUS record, including its checksum.
+    """
+    rec = bytearray(RECORD.pack(ts,fix,lat,lon,ele,0))
+    rec[15] = checksums(bytes(rec))[0]
+    return bytes(rec)
+
+def _lane_mask(n:int, width:int) -> int:
+    # mask that selects the low `width` bytes of each 16-byte lane
+    return int.from_bytes((b'\xff'*width + b'\x00'*(RECORD_SIZE-width))*n,"little")
@@ -0,0 +1,170 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Metrics of the hot paths: counters and histograms.
+
+The driver (and the reader) take an optional Metrics; when it is None,
+instrumented code does nothing more than check for that, so metrics cost
+next to nothing unless they are enabled (with --metrics). Metrics can be
+written as JSON (see dump), at exit, or periodically when following.
+
+Histograms have power-of-2 buckets, so adding a value is cheap, and
+percentiles are approximate (the upper bound of a bucket).
+
+Profiler is a hook for profiling a run with cProfile and/or tracemalloc
+(see --profile and --trace-malloc).
+"""
+
+from typing import (Any, Optional)
+from collections import Counter
+import json
+import os
+import sys
+import time
+
+class Histogram:
+    """
+    Distribution of non-negative integer values (e.g., microseconds)
+    """
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.buckets = [0] * 65 # bucket i: values < 2**i (and >= 2**(i-1))
+
+    def add(self, value:int) -> None:
+        if value < 0:
+            value = 0
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+        self.buckets[min(value.bit_length(), 64)] += 1
+
+    def percentile(self, p:float) -> int:
+        """
+        Approximate p'th percentile (0 < p <= 100): the upper bound of the
+        bucket that it falls in (but no more than the maximum)
+        """
+        rank = p / 100 * self.count
+        n = 0
+        for i, k in enumerate(self.buckets):
+            n += k
+            if k > 0 and n >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def to_dict(self) -> dict[str,Any]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": { f"<{1 << i}": k for i, k in enumerate(self.buckets) if k > 0 },
+        }
+
+class Metrics:
+    """
+    Named counters and histograms. Names are dotted; e.g., "nmea.GPGGA", or
+    "lox.decode_us" (the unit, if any, is the last part of a name).
+    """
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.counters:Counter[str] = Counter()
+        self.histograms:dict[str,Histogram] = {}
+        self.last_dump = self.start
+
+    def count(self, name:str, n:int = 1) -> None:
+        self.counters[name] += n
+
+    def observe(self, name:str, value:int) -> None:
+        """
+        Add a value to the named histogram
+        """
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.add(value)
+
+    def to_dict(self) -> dict[str,Any]:
+        return {
+            "elapsed": round(time.monotonic() - self.start, 3),
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": { name: h.to_dict() for name, h in sorted(self.histograms.items()) },
+        }
+
+    def dump(self, path:str, **extra:Any) -> None:
+        """
+        Write the metrics (and any extra sections; e.g., reader statistics)
+        as JSON to the given file (replacing it), or to stderr if path is "-"
+        """
+        data = self.to_dict()
+        data.update(extra)
+        self.last_dump = time.monotonic()
+        if path == "-":
+            print(json.dumps(data), file=sys.stderr)
+            return
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as file:
+            json.dump(data, file, indent=1)
+        os.replace(tmp, path)
+
+    def due(self, interval:float) -> bool:
+        """
+        Determines if interval seconds have passed since the last dump
+        """
+        return interval > 0 and time.monotonic() - self.last_dump >= interval
+
+def elapsed_us(t0:int) -> int:
+    """
+    Microseconds since t0 (see time.perf_counter_ns)
+    """
+    return (time.perf_counter_ns() - t0) // 1000
+
+class Profiler:
+    """
+    Profile a run: with cProfile, saving the statistics to profile (a file,
+    for pstats, snakeviz, ...), and/or with tracemalloc, reporting the
+    top trace_malloc allocation sites
+    """
+    def __init__(self, profile:Optional[str] = None, trace_malloc:int = 0):
+        self.profile = profile
+        self.trace_malloc = trace_malloc
+        self.profiler:Any = None
+
+    def start(self) -> None:
+        if self.trace_malloc > 0:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self) -> None:
+        """
+        Stop profiling, and report (to stderr)
+        """
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+            print(f"saved profile to {self.profile}; top functions (by cumulative time):", file=sys.stderr)
+            pstats.Stats(self.profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(15)
+            self.profiler = None
+        if self.trace_malloc > 0:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                return
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print(f"traced memory: {current/1e6:.1f} MB, peak {peak/1e6:.1f} MB; top allocation sites:", file=sys.stderr)
+            for stat in snapshot.statistics("lineno")[:self.trace_malloc]:
+                print(f"  {stat}", file=sys.stderr)
@@ -1,64 +1,180 @@
 # Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
 # vim: ts=4 sw=4 
-from typing import (Any, Optional)
+from typing import (Any, Callable, Iterable, Optional)
+import rattlebox.analytics as analytics
+import rattlebox.command as command
+import rattlebox.dump as dump
 import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.metrics as metrics
 import rattlebox.nmea as nmea
 import rattlebox.progress as progress
+import rattlebox.segment as segment
 from dataclasses import dataclass
-import struct
+import math
+import re
 import sys
+import time
 
 @dataclass
 class Command:
     body:str # message sent to device
     help:Optional[str] = None # human readable help string
+    pipelined:bool = False # independent of other commands (see command.Pipeline)
 class Driver:
     """
     MT3339 driver
     """
     # commands that we can send to the device
     COMMANDS:dict[str,Command] = {
-        'output-all'       : Command('PMTK314,1,1,1,1,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0',"turn on all output"),
-        'output-off'       : Command('PMTK314,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0',"turn off all output"),
-        'output-grmc-only' : Command('PMTK314,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0',"GRMC output only"),
+        'output-all'       : Command('PMTK314,1,1,1,1,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0',"turn on all output",True),
+        'output-off'       : Command('PMTK314,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0',"turn off all output",True),
+        'output-grmc-only' : Command('PMTK314,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0',"GRMC output only",True),
         'logger-status'    : Command('PMTK183',"get logger status"),
         'logger-erase'     : Command('PMTK184,1',"erase logger firmware"),
-        'logger-start'     : Command('PMTK185,0',"start logging"),
-        'logger-stop'      : Command('PMTK185,1',"stop logging"),
+        'logger-start'     : Command('PMTK185,0',"start logging",True),
+        'logger-stop'      : Command('PMTK185,1',"stop logging",True),
         #'logger-now'       : Command('PMTK186,1',"no idea"),
         'logger-dump'      : Command('PMTK622,1',"export logger data"),
         #'logger-config'    : Command('PMTK187,1',"configure logger"),
         'baud-9600'        : Command('PMTK251,9600',"set device baud rate to 9600"),
+        'baud-38400'       : Command('PMTK251,38400',"set device baud rate to 38400"),
+        'baud-57600'       : Command('PMTK251,57600',"set device baud rate to 57600"),
         'baud-115200'      : Command('PMTK251,115200',"set device baud rate to 115200"),
+        'ping'             : Command('PMTK000',"test the connection to the device",True),
         }
 
-    def __init__(self,port:Any, debug:bool = False, show_prog:bool = True):
+    # message types of the commands that the device does not acknowledge
+    UNACKED = { 251 }
+
+    # baud rates that we can switch to, fastest first
+    BAUD_RATES = sorted([ int(c[5:]) for c in COMMANDS if c.startswith("baud-") ], reverse=True)
+
+    # how often (in chunks) the manifest is saved during a logger dump
+    COMMIT_EVERY = 16
+
+    def __init__(self,port:Any, debug:bool = False, show_prog:bool = True, sink:Optional[dump.Sink] = None, manifest:Optional[dump.Manifest] = None,
+                 metrics:Optional[metrics.Metrics] = None):
         self.port = port
         self.debug = debug
+        self.metrics = metrics # if set, counters and timings of the hot paths are recorded here
         self.show_prog = show_prog
-        self.cmd:Optional[str] = None # the currently active command (if any)
-        self.log_points:list[gpx.Point] = [] # points from latest logger dump
+        self.cmd:Optional[str] = None # the currently active command (if any; the oldest outstanding one)
+        self.commands = command.Pipeline(metrics=metrics) # commands that have been submitted (and not completed)
+        self.log_points = gpx.Points() # points from latest logger dump (if there is no sink)
+        self.log_count = 0 # number of valid points in latest logger dump
+        self.log_total = 0 # number of chunks announced for the latest logger dump
+        self.log_seqs:set[int] = set() # sequence numbers of the chunks received
+        self.log_dups = 0 # number of duplicate chunks received
+        self.log_skipped = 0 # number of chunks that had already been ingested
+        self.log_bytes = 0 # bytes of log data received in latest logger dump
+        self.log_start = 0.0 # when the latest logger dump started
+        self.log_stats = analytics.Accumulator() # statistics of the latest logger dump
+        self.sink = sink # if set, log data is written here as it arrives
+        self.manifest = manifest # if set, chunks that have already been ingested are skipped
         self.prog:Optional[progress.Progress] = None
-        self.loc:Optional[gpx.Point] = None
+        self.log_status:Optional[locus.Status] = None # latest logger status reported by the device
+        self.log_plan:Optional[locus.Status] = None # the logger status that the current logger dump was planned with
+        self.plan_dumps = True # get the logger status before each logger dump, to plan it (see plan_dump)
+        self.loc:Optional[gpx.Point] = None # latest location reported by the device
+        self.nmea = nmea.Assembler()
+        self.fix:Optional[nmea.Fix] = None # latest complete epoch (see nmea.Assembler)
+        self.on_fix:Optional[Callable[[nmea.Fix],None]] = None # if set, called with each complete epoch
 
-    def get_log_as_gpx(self) -> Optional[gpx.Document]:
-        return gpx.Document.from_points(self.log_points) if len(self.log_points)>0 else None
+    def get_log_as_gpx(self, rules:Optional[segment.Rules] = None) -> Optional[gpx.Document]:
+        """
+        The points from the latest logger dump, as a single track, or split
+        into tracks and segments by the given rules (see segment)
+        """
+        if len(self.log_points)==0:
+            return None
+        if rules is not None:
+            return segment.segment(self.log_points, rules)
+        return gpx.Document.from_points(self.log_points)
     
     def get_loc(self) -> Optional[gpx.Point]:
         return self.loc
 
-    def send_command(self, cmd:str):
-        if not cmd in self.COMMANDS:
-            raise Exception(f"unrecognized command: {cmd}")
-        # Send command message to device
-        body = type(self).COMMANDS[cmd].body
-        # build message for the command
-        msg = '$%s*%s\r\n' % (body, nmea.checksum(body))
-        msg_bytes = msg.encode("ascii")
+    def send_command(self, cmd:str) -> command.Request:
+        req, msg = self.start_command(cmd)
+        self.port.write(msg)
+        return req
+
+    def start_command(self, cmd:str) -> tuple[command.Request,bytes]:
+        """
+        Send cmd now (regardless of any other commands), and make it active;
+        returns the request, and the message to send to the device (without
+        sending it). cmd is the name of a command (see COMMANDS), or the body
+        of a PMTK message; e.g., PMTK220,200.
+        """
+        req = self.request(cmd)
+        msg_bytes = self.commands.start(req)
         if self.debug:
             print(f"[send] {msg_bytes!r}", file=sys.stderr)
-        self.port.write(msg_bytes)
-        self.cmd = cmd
+        self._update_active()
+        return req, msg_bytes
+
+    def submit_command(self, cmd:str) -> command.Request:
+        """
+        Queue cmd, to be sent when it is due (see service, and
+        command.Pipeline). If plan_dumps is set, a logger dump is preceded by
+        logger-status (unless it already is), so that it can be planned; if
+        that fails, the dump goes ahead without a plan.
+        """
+        req = self.request(cmd)
+        if self.plan_dumps and req.body == self.COMMANDS['logger-dump'].body:
+            last = self.commands.queued[-1] if len(self.commands.queued) > 0 else None
+            if last is None or last.body != self.COMMANDS['logger-status'].body:
+                status = self.request('logger-status')
+                status.optional = True
+                self.commands.submit(status)
+        return self.commands.submit(req)
+
+    def due(self) -> list[bytes]:
+        """
+        The messages to send to the device now: of the commands that are due
+        (or due to be sent again); commands that have run out of tries time
+        out
+        """
+        msgs = self.commands.due()
+        if self.debug:
+            for msg_bytes in msgs:
+                print(f"[send] {msg_bytes!r}", file=sys.stderr)
+        self._update_active()
+        return msgs
+
+    def service(self) -> None:
+        """
+        Send the commands that are due (see due)
+        """
+        for msg_bytes in self.due():
+            self.port.write(msg_bytes)
+
+    def run_commands(self, get_batch:Callable[[float],list[bytes]], timeout:float = 0.5) -> None:
+        """
+        Send the queued commands, and receive messages from the device (in
+        batches, from get_batch, which waits up to the given number of
+        seconds), until all of the commands are complete
+        """
+        self.service()
+        while not self.commands.idle():
+            self.recv_messages(get_batch(self.commands.wait(timeout)))
+            self.service()
+
+    def request(self, cmd:str) -> command.Request:
+        """
+        A request for a command (see start_command)
+        """
+        body = self.command_body(cmd)
+        kind = command.message_type(body)
+        if cmd in self.COMMANDS:
+            pipelined = self.COMMANDS[cmd].pipelined
+        else:
+            # like the named commands of the same type, if any (otherwise
+            # it is likely to be configuration)
+            same = [ c.pipelined for c in self.COMMANDS.values() if command.message_type(c.body) == kind ]
+            pipelined = all(same)
+        return command.Request(cmd, body, pipelined=pipelined, acked=kind not in self.UNACKED)
 
     def is_command_active(self) -> bool:
         """
@@ -72,20 +188,28 @@ class Driver:
         """
         if self.debug:
             print(f"[recv] {msg_bytes!r}", file=sys.stderr)
-        msg:str = ""
-        fields:list[str] = []
-        try:
-            msg = msg_bytes.decode("ascii").rstrip()
-            if len(msg)>0:
-                fields = nmea.parse_sentence(msg)
-        except Exception as e:
-            if self.debug:
-               print(f"error reading from device: {e}",file=sys.stderr)
-        if len(fields)==0:
+        status, fields = nmea.tokenize(msg_bytes)
+        if self.metrics is not None:
+            self.metrics.count("nmea.lines")
+            self.metrics.count("nmea.bytes", len(msg_bytes))
+            if status != nmea.OK:
+                self.metrics.count(f"nmea.{nmea.STATUS_NAMES[status]}")
+        if status != nmea.OK:
+            if self.debug and status != nmea.EMPTY:
+               print(f"error reading from device: invalid sentence: {nmea.STATUS[status]}",file=sys.stderr)
             return False
+        return self.recv_sentence(fields)
+
+    def recv_sentence(self, fields:list[str]) -> bool:
+        """
+        Handle a (valid) sentence received from the device, given as its
+        fields (see nmea.tokenize).
+        """
+        if self.metrics is not None:
+            self.metrics.count(f"nmea.type.{fields[0][1:]}")
         if fields[0].startswith("$PMTK"):
             self.handle_pmtk(fields)
-        elif fields[0].startswith("$GP"):
+        elif fields[0][1:3] in nmea.TALKERS:
             self.handle_nmea(fields)
         else:
             # unrecognized packet
@@ -94,6 +218,98 @@ class Driver:
             return False
         return True
 
+    def recv_messages(self, lines:Iterable[bytes]) -> int:
+        """
+        Receive a batch of messages from the device.
+        Returns the number of messages that were handled.
+        """
+        n = 0
+        for msg_bytes in lines:
+            if self.recv_message(msg_bytes):
+                n += 1
+        return n
+
+    def ping(self, timeout:float = 1) -> bool:
+        """
+        Send a test packet, and wait (up to timeout seconds) for the device
+        to acknowledge it, reading directly from the port.
+        Returns True if the device responded.
+        """
+        port_timeout = self.port.timeout
+        self.port.timeout = min(timeout, 0.1)
+        try:
+            self.port.reset_input_buffer()
+            req = self.send_command("ping")
+            deadline = time.monotonic() + timeout
+            buf = b''
+            while not req.done() and time.monotonic() < deadline:
+                data = self.port.read(max(1, self.port.in_waiting))
+                sentences, buf = nmea.parse_many(buf + data)
+                for status, fields in sentences:
+                    if status == nmea.OK:
+                        self.recv_sentence(fields)
+        finally:
+            self.port.timeout = port_timeout
+        if not req.done():
+            # no response
+            self.commands.cancel(req)
+            self._update_active()
+            return False
+        return req.ok()
+
+    def probe_baud(self, timeout:float = 1) -> Optional[int]:
+        """
+        Find the baud rate that the device is using, starting with the
+        port's current rate. The port is left at the device's rate.
+        Returns the device's baud rate, or None if the device did not respond.
+        """
+        current = self.port.baudrate
+        for rate in [current] + [ r for r in self.BAUD_RATES if r != current ]:
+            self.port.baudrate = rate
+            if self.ping(timeout):
+                return rate
+        self.port.baudrate = current
+        return None
+
+    def set_baud(self, rate:int, timeout:float = 1) -> bool:
+        """
+        Switch the device, and then the port, to the given baud rate, and
+        verify that the device responds at that rate.
+        If it doesn't, the port is switched back.
+        Returns True if the switch succeeded.
+        """
+        current = self.port.baudrate
+        self.send_command(f"baud-{rate}") # (not acknowledged)
+        self.port.flush()
+        # give the device a moment to switch
+        time.sleep(0.05)
+        self.port.baudrate = rate
+        if self.ping(timeout):
+            return True
+        self.port.baudrate = current
+        if self.debug:
+            print(f"failed to switch to {rate} baud",file=sys.stderr)
+        return False
+
+    def negotiate_baud(self, timeout:float = 1) -> int:
+        """
+        Switch the device and port to the fastest baud rate that works.
+        Returns the baud rate.
+        """
+        current = self.probe_baud(timeout)
+        if current is None:
+            raise Exception("no response from device")
+        for rate in self.BAUD_RATES:
+            if rate <= current:
+                break
+            if self.set_baud(rate, timeout):
+                return rate
+            # find out where the device ended up
+            current = self.probe_baud(timeout)
+            if current is None:
+                raise Exception("lost connection to device")
+        return current
+
     def handle_pmtk(self,fields:list[str]):
         """
         Handle a MTK-specific packets, typically in response to a command that
@@ -109,37 +325,216 @@ class Driver:
             case "$PMTK001":
                 # This marks the end of the response to the command that we
                 # had submitted
-                self.cmd = None
+                req = None
+                if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit():
+                    req = self.commands.ack(int(fields[1]), int(fields[2]))
+                if req is None and self.debug:
+                    print(f"unexpected acknowledgement: {fields}",file=sys.stderr)
+                self._update_active()
             case "$PMTKLOX":
+                self.commands.extend()
                 if fields[1]=='0':
                     # start of log
-                    max = int(fields[2])
-                    if self.show_prog:
-                        self.prog = progress.Progress(max=max,label="dump log: ")
+                    self.handle_lox_start(int(fields[2]))
                 elif fields[1]=='2':
                     # end of log
-                    sys.stderr.write(f"\nlog contains {len(self.log_points)} valid points\n")
+                    self.handle_lox_end()
                 else:
                     # Log data
                     assert(fields[1]=='1')
-                    # Parse log data and add to list
-                    self.log_points.extend(self.lox_to_points(fields[3:]))
-                    # Show progress
-                    if self.show_prog and self.prog is not None:
-                        self.prog.display(sys.stderr,delta=1)
+                    self.handle_lox_data(int(fields[2]),fields[3:])
+            case "$PMTKLOG":
+                self.commands.extend()
+                self.handle_log_status(fields)
             case _:
                 # any other type, just echo it for now
+                self.commands.extend()
                 print(f"{fields}",file=sys.stderr)
 
+    def handle_log_status(self,fields:list[str]):
+        try:
+            status = locus.Status.parse(fields)
+        except Exception as e:
+            print(f"{e}",file=sys.stderr)
+            return
+        self.log_status = status
+        print(f"{status}",file=sys.stderr)
+        self.plan_dump(status)
+
+    def plan_dump(self,status:locus.Status):
+        """
+        If the next command is a logger dump, plan it with the given logger
+        status: skip it if the log is empty, and otherwise estimate how big
+        it is, and how long it is going to take at the current baud rate.
+        """
+        req = self.commands.next()
+        if req is None or req.body != self.COMMANDS['logger-dump'].body:
+            return
+        if status.records == 0:
+            print("log is empty; skipping logger dump",file=sys.stderr)
+            self.commands.skip(req)
+            return
+        self.log_plan = status
+        msg = f"dump log: {status.chunks()} chunks, {status.dump_size()} bytes"
+        baudrate = self.baudrate()
+        if baudrate > 0:
+            msg += f", about {progress.format_duration(status.dump_time(baudrate))} at {baudrate} baud"
+        print(msg,file=sys.stderr)
+
+    def baudrate(self) -> int:
+        """
+        The baud rate of the port (0 if unknown)
+        """
+        return getattr(self.port,"baudrate",0) or 0
+
+    def handle_lox_start(self,total:int):
+        self.log_count = 0
+        self.log_total = total
+        self.log_seqs.clear()
+        self.log_dups = 0
+        self.log_skipped = 0
+        self.log_bytes = 0
+        self.log_start = time.monotonic()
+        self.log_stats = analytics.Accumulator()
+        if self.manifest is not None:
+            self.manifest.total = total
+        if self.sink is not None:
+            self.sink.begin(total)
+        if self.show_prog:
+            # (throughput in bytes: all but the last chunk are full)
+            expected = 0.0
+            if self.log_plan is not None and self.baudrate() > 0:
+                expected = self.log_plan.dump_time(self.baudrate())
+            self.prog = progress.Progress(max=total,label="dump log: ",eta=True,unit="B",scale=locus.CHUNK_SIZE,expected=expected)
+
+    def handle_lox_data(self,seq:int,lox_words:list[str]):
+        if self.metrics is not None:
+            self.metrics.count("lox.chunks")
+        if seq in self.log_seqs:
+            # we already have this one
+            self.log_dups += 1
+            if self.metrics is not None:
+                self.metrics.count("lox.duplicates")
+            if self.debug:
+                print(f"duplicate log chunk: {seq}",file=sys.stderr)
+            return
+        self.log_seqs.add(seq)
+        data = self.lox_to_bytes(lox_words)
+        self.log_bytes += len(data)
+        offset = 0
+        if self.manifest is not None:
+            offset = self.manifest.check(seq,data)
+            self.manifest.add(seq,data)
+        if offset < len(data):
+            # Parse log data and add to list (or pass on to sink)
+            t0 = time.perf_counter_ns() if self.metrics is not None else 0
+            recs = self.decode_lox(data[offset:])
+            self.log_count += len(recs)
+            points = gpx.Points()
+            points.extend_columns(*recs.columns())
+            self.log_stats.add(points)
+            if self.metrics is not None:
+                self.metrics.observe("lox.decode_us", metrics.elapsed_us(t0))
+                self.metrics.count("lox.records", len(recs))
+                self.metrics.count("lox.bad_checksum", recs.bad_checksum)
+                self.metrics.count("lox.invalid", recs.invalid)
+                t0 = time.perf_counter_ns()
+            if self.sink is not None:
+                self.sink.write(seq,points)
+            else:
+                self.log_points.extend(points)
+            if self.metrics is not None:
+                self.metrics.observe("lox.write_us", metrics.elapsed_us(t0))
+        else:
+            self.log_skipped += 1
+        if self.sink is not None and len(self.log_seqs) % self.COMMIT_EVERY == 0:
+            t0 = time.perf_counter_ns() if self.metrics is not None else 0
+            self.commit()
+            if self.metrics is not None:
+                self.metrics.observe("lox.commit_us", metrics.elapsed_us(t0))
+        # Show progress
+        if self.show_prog and self.prog is not None:
+            t0 = time.perf_counter_ns() if self.metrics is not None else 0
+            self.prog.display(sys.stderr,delta=1)
+            if self.metrics is not None:
+                self.metrics.observe("progress_us", metrics.elapsed_us(t0))
+
+    def handle_lox_end(self):
+        if self.sink is not None:
+            self.sink.end()
+            self.commit()
+        sys.stderr.write(f"\nlog contains {self.log_count} valid points\n")
+        if self.log_count > 0:
+            sys.stderr.write(f"{self.log_stats.stats()}\n")
+        elapsed = time.monotonic() - self.log_start
+        if elapsed > 0 and self.log_bytes > 0:
+            fixes = self.log_bytes // locus.RECORD_SIZE
+            sys.stderr.write(f"received {self.log_bytes} bytes of log data in {elapsed:.1f}s: " +
+                             f"{self.log_bytes/elapsed:.0f} bytes/s, {fixes/elapsed:.0f} fixes/s\n")
+            if self.log_plan is not None and self.baudrate() > 0:
+                sys.stderr.write(f"expected {self.log_plan.data_size()} bytes in " +
+                                 f"{self.log_plan.dump_time(self.baudrate()):.1f}s\n")
+        self.log_plan = None
+        if self.log_skipped > 0:
+            sys.stderr.write(f"skipped {self.log_skipped} chunks that were already ingested\n")
+        if self.log_dups > 0:
+            sys.stderr.write(f"ignored {self.log_dups} duplicate chunks\n")
+        missing = self.missing_chunks()
+        if len(missing) > 0:
+            sys.stderr.write(f"missing {len(missing)} chunks: {missing}\n")
+
+    def missing_chunks(self) -> list[int]:
+        """
+        Sequence numbers of the chunks of the latest logger dump that were not
+        received. When using a manifest, these are picked up by the next dump.
+        """
+        return [ seq for seq in range(self.log_total) if seq not in self.log_seqs ]
+
+    def commit(self):
+        """
+        Sync the sink and save the manifest, so that the manifest describes
+        what is on disk.
+        This is done periodically while dumping to a sink. Without a sink, it
+        is up to the caller to commit once the log data has been saved.
+        """
+        if self.manifest is None:
+            return
+        if self.sink is not None:
+            self.manifest.committed = self.sink.sync()
+        self.manifest.save()
+
     def handle_nmea(self,fields:list[str]):
         """
-        Handler NMEA packets
+        Handle NMEA packets.
+        Sentences are assembled into fixes (one per epoch); the location is
+        updated by each sentence that reports a valid position. (Only GGA
+        reports elevation; until it does, the previous elevation is kept.)
         """
-        match fields[0]:
-            case "$GPGGA":
-                point = nmea.parse_gpgga(fields)
-                if point is not None:
-                    self.loc = point
+        fix, has_pos = self.nmea.add(fields)
+        if fix is not None:
+            self.fix = fix
+            if self.on_fix is not None:
+                self.on_fix(fix)
+        if has_pos and self.nmea.fix is not None:
+            loc = self.nmea.fix.to_point()
+            if self.loc is not None and math.isnan(self.nmea.fix.ele):
+                loc.ele = self.loc.ele
+            self.loc = loc
+
+    def _update_active(self) -> None:
+        active = self.commands.active()
+        self.cmd = active.cmd if active is not None else None
+
+    @classmethod
+    def command_body(cls,cmd:str) -> str:
+        """
+        The body of the message for a command (see start_command)
+        """
+        if cmd in cls.COMMANDS:
+            return cls.COMMANDS[cmd].body
+        if re.fullmatch(r"PMTK\d{3}(,[0-9A-Za-z.-]*)*", cmd) is None:
+            raise Exception(f"unrecognized command: {cmd}")
+        return cmd
 
     @classmethod
     def is_valid_command(cls,cmd:str) -> bool:
@@ -148,6 +543,19 @@ class Driver:
     def lox_to_points(self,lox_words:list[str]) -> list[gpx.Point]:
         """
         Convert a LOCUS/lox word list into a list of GPX points.
+        See lox_to_records.
+        """
+        return self.lox_to_records(lox_words).to_points()
+
+    def lox_to_records(self,lox_words:list[str]) -> locus.Records:
+        """
+        Convert a LOCUS/lox word list into columns of decoded records.
+        """
+        return self.decode_lox(self.lox_to_bytes(lox_words))
+
+    def lox_to_bytes(self,lox_words:list[str]) -> bytes:
+        """
+        Convert a LOCUS/lox word list into the bytes of its data blocks.
         According to the spec, there can be at most 24 words per LOX message.
         Each word is 32-bits (4 bytes) and encoded as a hex string.
         Words a grouped into 16 byte data blocks, with the following fields:
@@ -161,29 +569,13 @@ class Driver:
         if len(lox_words)%4 != 0 or len(lox_words) > 24:
             # must be multiple of 4 and less than 24 words
             raise Exception("invalid LOCUS data: unexpected word count")
-        # convert words to byte array
-        bytes = bytearray()
-        for w in lox_words:
-            bytes.extend(bytearray.fromhex(w))
-        # convert each 16-byte data block to a GPX point
-        points:list[gpx.Point] = []
-        for i in range(0,len(bytes),16):
-            block = bytes[i:i+16]
-            chk = checksum(block[:15])
-            if chk != block[15]:
-                # checksum does not match; skip this block
-                if self.debug:
-                    print(f"checksum does not match: expected {block[15]}; computed {chk}")
-                continue
-            wp = gpx.Point()
-            wp.ts = int.from_bytes(block[0:4],"little")
-            fix = bytes[4]
-            wp.lat = struct.unpack('f', block[5:9])[0]
-            wp.lon = struct.unpack('f', block[9:13])[0]
-            wp.ele = int.from_bytes(block[13:15],"little")
-            if (fix==2 or fix==4) and wp.is_valid():
-                points.append(wp)
-        return points
+        return bytes.fromhex("".join(lox_words))
+
+    def decode_lox(self,data:bytes) -> locus.Records:
+        recs = locus.decode(data)
+        if self.debug and recs.bad_checksum>0:
+            print(f"checksum does not match: skipped {recs.bad_checksum} data block(s)",file=sys.stderr)
+        return recs
 
 def checksum(bytes:bytearray) -> int:
     """
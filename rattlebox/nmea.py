@@ -7,57 +7,387 @@ See:
 * https://aprs.gids.nl/nmea/
 """
 
-from typing import (Optional)
+from typing import (Callable, Optional)
+from dataclasses import (dataclass, field)
+import calendar
+import math
+import time
 import rattlebox.gpx as gpx
-from datetime import datetime, timezone
+
+NAN = float('nan')
+
+# Status of tokenize
+OK = 0
+EMPTY = 1 # empty line
+NO_START = 2 # missing start delimiter
+NO_CHECKSUM = 3 # missing or invalid checksum
+BAD_CHECKSUM = 4 # checksum does not match
+STATUS = {
+    OK: "ok",
+    EMPTY: "empty sentence",
+    NO_START: "missing start delimiter",
+    NO_CHECKSUM: "missing or invalid checksum",
+    BAD_CHECKSUM: "checksum does not match",
+}
+# Short names of the statuses (e.g., for metrics)
+STATUS_NAMES = {
+    OK: "ok",
+    EMPTY: "empty",
+    NO_START: "no_start",
+    NO_CHECKSUM: "no_checksum",
+    BAD_CHECKSUM: "bad_checksum",
+}
+
+# hex digit values (-1: not a hex digit)
+_HEX_VAL = [ int(chr(i),16) if chr(i) in "0123456789ABCDEFabcdef" else -1 for i in range(256) ]
+# hex strings for checksum values
+_HEX_STR = [ '%02X' % (i) for i in range(256) ]
 
 def parse_sentence(line:str) -> list[str]:
     """
     Parse and validate an NMEA sentence.
     Returns the fields as a list of strings
     """
-    if line[0] != "$":
-        raise Exception("invalid sentence: missing start delimiter")
-    body_chk = line.split('*')
-    if len(body_chk) != 2 or len(body_chk[1]) != 2:
-        raise Exception(f"invalid sentence: missing or invalid checksum")
-    # verify checksum
-    chk = checksum(body_chk[0][1:])
-    if chk != body_chk[1]:
-        raise Exception(f"invalid sentence: checksum does not match: expected {body_chk[1]}; computed {chk}")
-    fields = body_chk[0].split(",")
+    status, fields = tokenize(line.encode("latin-1"))
+    if status != OK:
+        raise Exception(f"invalid sentence: {STATUS[status]}")
     return fields
 
+def tokenize(line:bytes) -> tuple[int,list[str]]:
+    """
+    Validate and split an NMEA sentence given as bytes (e.g., as read from
+    the device), in a single pass.
+    Returns a status (OK, EMPTY, ...) and, if the status is OK, the fields
+    of the sentence. Errors are reported through the status, rather than by
+    raising an exception.
+    """
+    line = line.rstrip()
+    n = len(line)
+    if n == 0:
+        return EMPTY, []
+    if line[0] != 0x24: # '$'
+        return NO_START, []
+    star = n - 3
+    if star < 1 or line[star] != 0x2A: # '*'
+        return NO_CHECKSUM, []
+    hi = _HEX_VAL[line[star+1]]
+    lo = _HEX_VAL[line[star+2]]
+    if hi < 0 or lo < 0:
+        return NO_CHECKSUM, []
+    if xor(line[1:star]) != (hi << 4 | lo):
+        return BAD_CHECKSUM, []
+    return OK, line[:star].decode("latin-1").split(",")
+
+def parse_many(buf:bytes) -> tuple[list[tuple[int,list[str]]],bytes]:
+    """
+    Tokenize all of the (complete) sentences in the given buffer, e.g., a
+    chunk read from the device.
+    Returns the (status, fields) of each non-empty line, and the remainder of
+    the buffer following the last line delimiter.
+    """
+    lines = buf.split(b'\n')
+    rest = lines.pop()
+    results:list[tuple[int,list[str]]] = []
+    for line in lines:
+        status, fields = tokenize(line)
+        if status != EMPTY:
+            results.append((status, fields))
+    return results, rest
+
+def xor(data:bytes) -> int:
+    """
+    Compute the xor of all of the bytes of data.
+    The bytes are treated as one integer, which is folded onto itself
+    (halving the width each time) until a single byte remains.
+    """
+    x = int.from_bytes(data, "little")
+    shift = 8
+    while shift < len(data) * 8:
+        shift <<= 1
+    while shift > 8:
+        shift >>= 1
+        x ^= x >> shift
+    return x & 0xFF
+
 def checksum(body:str):
     """
     Compute the checksum of the body of a NMEA sentence
     """
-    chk = 0
-    for c in body:
-        chk = chk ^ ord(c)
-    return '%02X' % (chk)
+    return _HEX_STR[xor(body.encode("latin-1"))]
+
+# Talker IDs of the sentences that we handle: GPS, GNSS (combined), GLONASS
+TALKERS = ("GP", "GN", "GL")
+
+KNOTS = 0.514444 # meters per second
+
+@dataclass(slots=True)
+class Fix:
+    """
+    Position, velocity and quality information for one epoch (i.e., all of
+    the sentences that the receiver reports for a given time).
+    """
+    tod: float = -1 # UTC time of day (seconds), as reported by the device
+    ts: int = 0 # Unix/epoch; from the device's date (RMC) and time
+    lat: float = NAN # decimal degrees
+    lon: float = NAN # decimal degrees
+    ele: float = NAN # meters
+    quality: int = 0 # GGA fix quality: 0 - invalid, 1 - GPS, 2 - DGPS, ...
+    mode: int = 0 # GSA fix mode: 1 - no fix, 2 - 2D, 3 - 3D
+    valid: bool = False # RMC/GLL status: A (valid) or V (void)
+    sats: int = 0 # number of satellites used
+    sats_in_view: int = 0
+    prns: list[int] = field(default_factory=list) # satellites used (GSA)
+    hdop: float = NAN
+    pdop: float = NAN
+    vdop: float = NAN
+    speed: float = NAN # speed over ground (m/s)
+    course: float = NAN # course over ground (degrees true)
+    date: int = -1 # Unix/epoch of midnight (UTC) of the date reported by RMC
+
+    def has_position(self) -> bool:
+        return not (math.isnan(self.lat) or math.isnan(self.lon))
+
+    def to_point(self) -> gpx.Point:
+        ele = 0 if math.isnan(self.ele) else int(self.ele)
+        return gpx.Point(self.ts, self.lat, self.lon, ele)
+
+def parse_gga(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse Global Positioning System Fix Data.
+    Returns False if there is no valid position.
+    """
+    if len(fields)<15:
+        return False
+    fix.quality = parse_int(fields[6])
+    fix.sats = parse_int(fields[7])
+    fix.hdop = parse_float(fields[8])
+    if fields[10] == 'M':
+        fix.ele = parse_float(fields[9])
+    if fix.quality == 0:
+        # no fix
+        return False
+    fix.lat = parse_coord(fields[2], fields[3])
+    fix.lon = parse_coord(fields[4], fields[5])
+    return fix.has_position()
+
+def parse_rmc(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse Recommended Minimum Specific GNSS Data
+    """
+    if len(fields)<12:
+        return False
+    fix.valid = fields[2] == 'A'
+    fix.speed = parse_float(fields[7]) * KNOTS
+    fix.course = parse_float(fields[8])
+    fix.date = parse_date(fields[9])
+    if not fix.valid:
+        return False
+    fix.lat = parse_coord(fields[3], fields[4])
+    fix.lon = parse_coord(fields[5], fields[6])
+    return fix.has_position()
+
+def parse_gsa(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse GNSS DOP and Active Satellites
+    """
+    if len(fields)<18:
+        return False
+    fix.mode = parse_int(fields[2])
+    prns = [ parse_int(prn) for prn in fields[3:15] if len(prn)>0 ]
+    if fields[0][1:3] == "GN":
+        # one GSA per constellation
+        fix.prns.extend(prns)
+    else:
+        fix.prns = prns
+    fix.pdop = parse_float(fields[15])
+    fix.hdop = parse_float(fields[16])
+    fix.vdop = parse_float(fields[17])
+    return False
+
+def parse_gsv(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse GNSS Satellites in View
+    """
+    if len(fields)<4:
+        return False
+    fix.sats_in_view = parse_int(fields[3])
+    return False
+
+def parse_vtg(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse Course Over Ground and Ground Speed
+    """
+    if len(fields)<9:
+        return False
+    fix.course = parse_float(fields[1])
+    fix.speed = parse_float(fields[7]) / 3.6 # km/h
+    return False
+
+def parse_gll(fields:list[str], fix:Fix) -> bool:
+    """
+    Parse Geographic Position - Latitude/Longitude
+    """
+    if len(fields)<7:
+        return False
+    fix.valid = fields[6] == 'A'
+    if not fix.valid:
+        return False
+    fix.lat = parse_coord(fields[1], fields[2])
+    fix.lon = parse_coord(fields[3], fields[4])
+    return fix.has_position()
+
+# Parsers, keyed by sentence ID (without the talker ID)
+PARSERS:dict[str,Callable[[list[str],Fix],bool]] = {
+    "GGA": parse_gga,
+    "RMC": parse_rmc,
+    "GSA": parse_gsa,
+    "GSV": parse_gsv,
+    "VTG": parse_vtg,
+    "GLL": parse_gll,
+}
+
+# Index of the UTC time field, for sentences that have one
+TIME_FIELD:dict[str,int] = {
+    "GGA": 1,
+    "RMC": 1,
+    "GLL": 5,
+}
+
+class Assembler:
+    """
+    Assembles fixes from NMEA sentences.
+    Sentences are grouped into epochs by the UTC time that they report;
+    sentences without a time (GSA, GSV, VTG) belong to the current epoch.
+    The date comes from RMC sentences; until the first RMC, today's date is
+    assumed.
+    An epoch is complete when the next one starts, or, if early is True, as
+    soon as the sentence that ends it arrives: the assembler learns which
+    sentence that is, from the epochs that it has seen (it is a sentence that
+    has ended an epoch, and has never been followed by another sentence of
+    the same epoch). This saves waiting for the next epoch (e.g., a second).
+    """
+    def __init__(self, early:bool = False) -> None:
+        self.fix:Optional[Fix] = None # fix for the current epoch
+        self.date = -1 # midnight of the current date (Unix/epoch)
+        self.early = early
+        self.sid:Optional[str] = None # ID of the previous sentence of the current epoch
+        self.last:set[str] = set() # IDs of sentences that have ended an epoch
+        self.not_last:set[str] = set() # IDs of sentences that have been followed by another in the same epoch
+        self.done = False # the current epoch is complete (early)
+
+    def add(self, fields:list[str]) -> tuple[Optional[Fix],bool]:
+        """
+        Add a sentence.
+        Returns the fix for the previous epoch, if this sentence starts a new
+        one (and the previous epoch had a position), or for the current epoch,
+        if this sentence completes it (see early); and whether this sentence
+        reported a valid position.
+        """
+        sid = fields[0][3:]
+        parser = PARSERS.get(sid)
+        if parser is None:
+            return None, False
+        done:Optional[Fix] = None
+        fix = self.fix
+        i = TIME_FIELD.get(sid)
+        if i is not None and len(fields)>i and len(fields[i])>0:
+            tod = parse_time(fields[i])
+            if fix is None or tod != fix.tod:
+                if fix is not None and fix.has_position() and not self.done:
+                    done = fix
+                if fix is not None and tod < fix.tod - 43200:
+                    # passed midnight
+                    self.date += 86400
+                fix = Fix(tod=tod)
+                if self.sid is not None:
+                    self.last.add(self.sid)
+                self.sid = None
+                self.done = False
+        if fix is None:
+            fix = Fix()
+        if self.sid is not None:
+            self.not_last.add(self.sid)
+        self.sid = sid
+        self.fix = fix
+        has_pos = parser(fields, fix)
+        if fix.date >= 0:
+            self.date = fix.date
+        elif self.date < 0:
+            self.date = today()
+        if fix.tod >= 0:
+            fix.ts = self.date + int(fix.tod)
+        if (self.early and done is None and not self.done and fix.has_position() and
+            sid in self.last and sid not in self.not_last):
+            done = fix
+            self.done = True
+        return done, has_pos
 
 def parse_gpgga(fields:list[str]) -> Optional[gpx.Point]:
     """
-    Parse Global Positioning System Fix Data
+    Parse Global Positioning System Fix Data.
+    GGA has no date; the point is stamped with the current time.
+    (See Assembler, which uses the date reported by the device.)
     """
-    if len(fields)<15 or fields[6]==0:
+    fix = Fix()
+    if not parse_gga(fields, fix):
         # invalid data
         return None
-    pt = gpx.Point()
-    pt.lat = parse_deg(fields[2])
-    if fields[3] == 'S':
-        pt.lat *= -1
-    pt.lon = parse_deg(fields[4])
-    if fields[5] == 'W':
-        pt.lon *= -1
-    if fields[10] == 'M':
-        pt.ele = int(float(fields[9]))
+    pt = fix.to_point()
+    pt.ts = int(time.time())
+    return pt
 
-    # REVIEW: how to get this from the device? the GGA packet contains UTC time but not date.
-    pt.ts = int(datetime.now(timezone.utc).timestamp())
+def parse_time(val:str) -> float:
+    """
+    Parse UTC time: hhmmss.sss
+    Returns seconds since midnight (or -1 if invalid).
+    """
+    try:
+        return int(val[0:2])*3600 + int(val[2:4])*60 + float(val[4:])
+    except ValueError:
+        return -1
 
-    return pt
+_dates:dict[str,int] = {}
+
+def parse_date(val:str) -> int:
+    """
+    Parse a date: ddmmyy
+    Returns Unix/epoch time of midnight of that date (or -1 if invalid).
+    """
+    ts = _dates.get(val)
+    if ts is None:
+        try:
+            ts = calendar.timegm((2000+int(val[4:6]), int(val[2:4]), int(val[0:2]), 0, 0, 0))
+        except ValueError:
+            ts = -1
+        if len(_dates) < 1024:
+            _dates[val] = ts
+    return ts
+
+def today() -> int:
+    """
+    Unix/epoch time of midnight (UTC) today
+    """
+    now = int(time.time())
+    return now - now % 86400
+
+def parse_coord(val:str, hemi:str) -> float:
+    """
+    Parse a latitude or longitude, and its hemisphere (N/S or E/W)
+    """
+    deg = parse_deg(val)
+    return -deg if hemi in ('S','W') else deg
+
+def parse_int(val:str, default:int = 0) -> int:
+    try:
+        return int(val)
+    except ValueError:
+        return default
+
+def parse_float(val:str) -> float:
+    try:
+        return float(val)
+    except ValueError:
+        return NAN
 
 def parse_deg(val:str) -> float:
     """
@@ -4,7 +4,11 @@
 from typing import (Optional, Self, TextIO)
 from dataclasses import (dataclass, field)
 import sys
+import rattlebox.archive as archive
+import rattlebox.follow as follow
 import rattlebox.mt3339 as mt3339
+import rattlebox.segment as segment
+import rattlebox.simplify as simplify
 
 @dataclass
 class Options:
@@ -16,15 +20,39 @@ class Options:
     device:str = "" # device name; e.g., "/dev/tty.usbserial-410"
     baudrate:int = DEF_BAUD # serial port baud rate; e.g., 115200
     timeout:int = 2 # serial port timeout
+    command_timeout:float = 2 # seconds to wait for a command to be acknowledged (see command.Pipeline)
+    retries:int = 2 # times a command is sent again, if it is not acknowledged
+    pipeline:int = 4 # independent commands that can be sent without waiting for acknowledgements
     debug:bool = False
     show_prog:bool = True
+    following:follow.Settings = field(default_factory=follow.Settings) # how fixes are published (if follow)
     follow:bool = False
+    auto_baud:bool = False # switch to the fastest baud rate that works
     logfile:Optional[str] = None
+    stream:bool = False # write log data to logfile as it arrives
+    resume:bool = False # resume a partially written logfile
+    manifest:Optional[str] = None # record of the log chunks that have been dumped
+    index:Optional[str] = None # add the dumped log to this index (see index)
+    capture:Optional[str] = None # record raw serial data to this file
+    replay:Optional[str] = None # read serial data from this capture file, instead of the device
+    replay_speed:float = 0 # replay pace: 0 - as fast as possible, 1 - as captured
+    simplify:float = 0 # simplify tracks with this tolerance (meters), if > 0
+    simplify_method:str = "dp" # see simplify.METHODS
+    rules:segment.Rules = field(default_factory=segment.Rules) # when to split the log (if segment)
+    segment:bool = False # split the log into tracks (outings) and segments
+    split:bool = False # write each outing to its own file
+    metrics:Optional[str] = None # write metrics (see metrics) as JSON to this file ("-" for stderr)
+    metrics_interval:float = 10 # seconds between metrics dumps, when following
+    profile:Optional[str] = None # profile with cProfile, saving the statistics to this file
+    trace_malloc:int = 0 # trace allocations, and report this many of the top allocation sites
     commands:list[str] = field(default_factory=list) # list of commands to send to device
 
     @staticmethod
     def usage(progname:str, out:TextIO=sys.stderr) -> None:
         print(f"Usage: {progname} <device> [<option> ...] [<command> ...]", file=out)
+        print(f"       {progname} --replay <capture-file> [<option> ...] [<command> ...]", file=out)
+        print(f"       {progname} convert <input> ... --out <dir> [<option> ...] (see {progname} convert --help)", file=out)
+        print(f"       {progname} serve <device> [--listen <address>] ... (see {progname} serve --help)", file=out)
         print(f" where <command> is one of:", file=out)
         for c in sorted(mt3339.Driver.COMMANDS):
             cmd = mt3339.Driver.COMMANDS[c]
@@ -32,11 +60,42 @@ class Options:
             if cmd.help is not None:
                 print(f" : {cmd.help}", end='', file=out)
             print(file=out)
+        print(f"\tPMTK<type>,<arg>,... : the body of any other PMTK message; e.g., PMTK220,200", file=out)
         print(" and <option> is one of:", file=out)
         print(f"\t--b|baud <baud-rate> : defaults to {Options.DEF_BAUD}", file=out)
-        print(f"\t--l|log <log-file> : save log data (as GPX) to the given file", file=out)
+        print(f"\t--a|auto-baud : find the device's baud rate, and switch to the fastest one that works", file=out)
+        print(f"\t--l|log <log-file> : save log data (as GPX, or as an archive if the file name ends with {archive.EXT}) to the given file", file=out)
+        print(f"\t--s|stream : write log data to the log file as it is dumped", file=out)
+        print(f"\t--resume : append to a partially written log file (implies --stream)", file=out)
+        print(f"\t--m|manifest <manifest-file> : only dump log data that is not in the manifest (delta dump)", file=out)
+        print(f"\t--i|index <index-file> : add the log file(s) to the given index, once the log has been dumped", file=out)
+        print(f"\t--c|capture <capture-file> : record raw data from the device to the given file", file=out)
+        print(f"\t--replay <capture-file> : read data from the given capture file, instead of the device", file=out)
+        print(f"\t--replay-speed <speed> : 0 - as fast as possible (default), 1 - at the pace it was captured", file=out)
+        print(f"\t--simplify <meters> : drop log points that are within the given distance of the simplified track", file=out)
+        print(f"\t--simplify-method <method> : dp (Douglas-Peucker, default) or vw (Visvalingam-Whyatt)", file=out)
+        print(f"\t--segment : split the log into tracks (one per outing) and segments, at gaps in time or distance", file=out)
+        print(f"\t--split : write each outing to its own file, named after the log file and the start of the outing (implies --segment)", file=out)
+        print(f"\t--outing-gap <seconds> : start a new track after a longer gap; defaults to {segment.Rules.outing_gap}", file=out)
+        print(f"\t--segment-gap <seconds> : start a new segment after a longer gap; defaults to {segment.Rules.segment_gap}", file=out)
+        print(f"\t--max-jump <meters> : start a new segment after a longer jump; defaults to {segment.Rules.max_jump:.0f}", file=out)
+        print(f"\t--command-timeout <seconds> : wait this long for the device to acknowledge a command; defaults to {Options.command_timeout:.0f}", file=out)
+        print(f"\t--retries <n> : send a command that is not acknowledged again, up to n times; defaults to {Options.retries}", file=out)
+        print(f"\t--pipeline <n> : send up to n independent (configuration) commands without waiting for acknowledgements; defaults to {Options.pipeline}", file=out)
+        print(f"\t--metrics <file> : write counters and timings of the hot paths as JSON to the given file (- for stderr) at exit", file=out)
+        print(f"\t--metrics-interval <seconds> : also write the metrics periodically when following; defaults to {Options.metrics_interval:.0f}", file=out)
+        print(f"\t--profile <file> : profile with cProfile, and save the statistics to the given file", file=out)
+        print(f"\t--trace-malloc <n> : trace memory allocations, and report the top n allocation sites", file=out)
         print(f"\t--d|debug", file=out)
-        print(f"\t--f|follow : echo output from device", file=out)
+        print(f"\t--f|follow : stream the position (one line per fix) to stdout, or to a socket or file", file=out)
+        print(f"\t--min-quality <n> : drop fixes with a lower GGA fix quality (0 - accept fixes without GGA); defaults to {follow.Settings.min_quality}", file=out)
+        print(f"\t--max-hdop <hdop> : drop fixes with a higher HDOP", file=out)
+        print(f"\t--smooth <method> : smooth the position: {', '.join(follow.SMOOTHERS)}", file=out)
+        print(f"\t--follow-rate <hz> : publish at most this many fixes per second (the latest one wins)", file=out)
+        print(f"\t--min-move <meters> : drop fixes that moved less since the last published one", file=out)
+        print(f"\t--follow-format <format> : {' or '.join(follow.FORMATS)}", file=out)
+        print(f"\t--follow-socket <path> : publish fixes to the clients of the given UNIX socket (instead of stdout)", file=out)
+        print(f"\t--follow-file <path> : append fixes to the given file (instead of stdout)", file=out)
         print(f"\t--?|help", file=out)
         print(f"\t--no-progress : don't show progress", file=out)
         print(f"e.g.,", file=out)
@@ -69,6 +128,13 @@ class Options:
                     cfg.debug = True
                 elif arg in ["no-progress"]:
                     cfg.show_prog = False
+                elif arg in ["s","stream"]:
+                    cfg.stream = True
+                elif arg in ["resume"]:
+                    cfg.stream = True
+                    cfg.resume = True
+                elif arg in ["a","auto-baud"]:
+                    cfg.auto_baud = True
                 elif arg in ["f","follow"]:
                     cfg.follow = True
                 elif arg in ["b","baud"]:
@@ -77,20 +143,172 @@ class Options:
                     cfg.baudrate = parse_int(rate,0)
                     if cfg.baudrate < 9600:
                         raise Exception(f"Invalid baud rate: {rate}")
+                elif arg in ["m","manifest"]:
+                    iarg = require_arg()
+                    cfg.manifest = args[iarg]
+                elif arg in ["i","index"]:
+                    iarg = require_arg()
+                    cfg.index = args[iarg]
+                elif arg in ["c","capture"]:
+                    iarg = require_arg()
+                    cfg.capture = args[iarg]
+                elif arg in ["replay"]:
+                    iarg = require_arg()
+                    cfg.replay = args[iarg]
+                elif arg in ["replay-speed"]:
+                    iarg = require_arg()
+                    speed = args[iarg]
+                    try:
+                        cfg.replay_speed = float(speed)
+                    except ValueError:
+                        raise Exception(f"Invalid replay speed: {speed}")
+                    if cfg.replay_speed < 0:
+                        raise Exception(f"Invalid replay speed: {speed}")
+                elif arg in ["simplify"]:
+                    iarg = require_arg()
+                    tol = args[iarg]
+                    try:
+                        cfg.simplify = float(tol)
+                    except ValueError:
+                        raise Exception(f"Invalid tolerance: {tol}")
+                    if cfg.simplify <= 0:
+                        raise Exception(f"Invalid tolerance: {tol}")
+                elif arg in ["simplify-method"]:
+                    iarg = require_arg()
+                    cfg.simplify_method = args[iarg]
+                    if cfg.simplify_method not in simplify.METHODS:
+                        raise Exception(f"Invalid simplification method: {cfg.simplify_method}")
+                elif arg in ["segment"]:
+                    cfg.segment = True
+                elif arg in ["split"]:
+                    cfg.segment = True
+                    cfg.split = True
+                elif arg in ["outing-gap","segment-gap"]:
+                    iarg = require_arg()
+                    gap = parse_int(args[iarg],-1)
+                    if gap < 0:
+                        raise Exception(f"Invalid gap: {args[iarg]}")
+                    if arg == "outing-gap":
+                        cfg.rules.outing_gap = gap
+                    else:
+                        cfg.rules.segment_gap = gap
+                elif arg in ["max-jump"]:
+                    iarg = require_arg()
+                    jump = args[iarg]
+                    try:
+                        cfg.rules.max_jump = float(jump)
+                    except ValueError:
+                        raise Exception(f"Invalid distance: {jump}")
+                    if cfg.rules.max_jump < 0:
+                        raise Exception(f"Invalid distance: {jump}")
+                elif arg in ["min-quality"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    cfg.following.min_quality = parse_int(args[iarg],-1)
+                    if cfg.following.min_quality < 0:
+                        raise Exception(f"Invalid fix quality: {args[iarg]}")
+                elif arg in ["max-hdop","follow-rate","min-move"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    try:
+                        val = float(args[iarg])
+                    except ValueError:
+                        val = -1
+                    if val < 0:
+                        raise Exception(f"Invalid {arg}: {args[iarg]}")
+                    if arg == "max-hdop":
+                        cfg.following.max_hdop = val
+                    elif arg == "follow-rate":
+                        cfg.following.rate = val
+                    else:
+                        cfg.following.min_move = val
+                elif arg in ["smooth"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    cfg.following.smooth = args[iarg]
+                    if cfg.following.smooth not in follow.SMOOTHERS:
+                        raise Exception(f"Invalid smoothing method: {cfg.following.smooth}")
+                elif arg in ["follow-format"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    cfg.following.format = args[iarg]
+                    if cfg.following.format not in follow.FORMATS:
+                        raise Exception(f"Invalid format: {cfg.following.format}")
+                elif arg in ["follow-socket"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    cfg.following.socket = args[iarg]
+                elif arg in ["follow-file"]:
+                    iarg = require_arg()
+                    cfg.follow = True
+                    cfg.following.file = args[iarg]
+                elif arg in ["command-timeout"]:
+                    iarg = require_arg()
+                    timeout = args[iarg]
+                    try:
+                        cfg.command_timeout = float(timeout)
+                    except ValueError:
+                        raise Exception(f"Invalid timeout: {timeout}")
+                    if cfg.command_timeout <= 0:
+                        raise Exception(f"Invalid timeout: {timeout}")
+                elif arg in ["retries"]:
+                    iarg = require_arg()
+                    cfg.retries = parse_int(args[iarg],-1)
+                    if cfg.retries < 0:
+                        raise Exception(f"Invalid number of retries: {args[iarg]}")
+                elif arg in ["pipeline"]:
+                    iarg = require_arg()
+                    cfg.pipeline = parse_int(args[iarg],0)
+                    if cfg.pipeline <= 0:
+                        raise Exception(f"Invalid pipeline depth: {args[iarg]}")
+                elif arg in ["metrics"]:
+                    iarg = require_arg()
+                    cfg.metrics = args[iarg]
+                elif arg in ["metrics-interval"]:
+                    iarg = require_arg()
+                    interval = args[iarg]
+                    try:
+                        cfg.metrics_interval = float(interval)
+                    except ValueError:
+                        raise Exception(f"Invalid interval: {interval}")
+                    if cfg.metrics_interval < 0:
+                        raise Exception(f"Invalid interval: {interval}")
+                elif arg in ["profile"]:
+                    iarg = require_arg()
+                    cfg.profile = args[iarg]
+                elif arg in ["trace-malloc"]:
+                    iarg = require_arg()
+                    cfg.trace_malloc = parse_int(args[iarg],0)
+                    if cfg.trace_malloc <= 0:
+                        raise Exception(f"Invalid number of allocation sites: {args[iarg]}")
                 elif arg in ["l","log"]:
                     iarg = require_arg()
                     cfg.logfile = args[iarg]
                 else:
                     raise Exception(f"Unrecognized option: {arg}")
-            elif len(cfg.device) == 0:
+            elif len(cfg.device) == 0 and cfg.replay is None:
                 cfg.device = arg
-            elif arg in mt3339.Driver.COMMANDS:
+            elif arg in mt3339.Driver.COMMANDS or arg.startswith("PMTK"):
+                # (raises an exception if it is not a valid command)
+                mt3339.Driver.command_body(arg)
                 cfg.commands.append(arg)
             else:
                 raise Exception(f"Unrecognized argument: {arg}")
             iarg += 1
-        if not cfg.help and len(cfg.device) == 0:
+        if not cfg.help and len(cfg.device) == 0 and cfg.replay is None:
             raise Exception("Required arguments missing")
+        if cfg.stream and cfg.logfile is None:
+            raise Exception("--stream requires --log")
+        if cfg.index is not None and cfg.logfile is None:
+            raise Exception("--index requires --log")
+        if cfg.logfile is not None and archive.is_archive(cfg.logfile) and (cfg.segment or cfg.simplify > 0):
+            raise Exception(f"--segment, --split and --simplify can't be used with an archive ({archive.EXT}) log file")
+        if cfg.split and cfg.logfile is None:
+            raise Exception("--split requires --log")
+        if cfg.split and cfg.resume:
+            raise Exception("--split can't be used with --resume")
+        if cfg.stream and cfg.simplify > 0:
+            raise Exception("--simplify needs the whole log, and can't be used with --stream")
         return cfg
 
 
@@ -1,14 +1,42 @@
 # Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
 # vim: ts=4 sw=4 
-from typing import (TextIO)
+from typing import (Callable, TextIO)
 import math
 import shutil
+import time
+
+# width of the throughput and ETA readout: " 999.9 kB/s, ETA 99:59:59"
+ETA_WIDTH = 26
+
+def format_duration(seconds:float) -> str:
+    """
+    Format a duration as m:ss, or h:mm:ss
+    """
+    s = int(round(seconds))
+    h, s = divmod(s, 3600)
+    m, s = divmod(s, 60)
+    return f"{h}:{m:02}:{s:02}" if h > 0 else f"{m}:{s:02}"
+
+def format_rate(rate:float, unit:str) -> str:
+    """
+    Format a throughput; e.g., 11.5 kB/s
+    """
+    if rate >= 1e6:
+        return f"{rate/1e6:.1f} M{unit}/s"
+    if rate >= 1e3:
+        return f"{rate/1e3:.1f} k{unit}/s"
+    return f"{rate:.0f} {unit}/s"
 
 class Progress:
     """
     Simple progress bar
+    If eta is set, the throughput (in units of scale per step; e.g., bytes)
+    and the estimated time remaining are shown, too. The ETA is based on the
+    throughput so far, or, until there is some progress, on the expected
+    duration (in seconds), if there is one.
     """
-    def __init__(self,max:int,cur:int=0,bar=True,fract=True,fill='',blank='',label:str="",width:int=-1):
+    def __init__(self,max:int,cur:int=0,bar=True,fract=True,fill='',blank='',label:str="",width:int=-1,
+                 eta=False,unit:str="",scale:float=1,expected:float=0,clock:Callable[[],float]=time.monotonic):
         if bar and width==-1:
             # set width based on terminal width
             try:
@@ -19,6 +47,8 @@ class Progress:
                     # fraction: " (max/max)"
                     n = int(1+math.log10(max)) if max>0 else 1
                     width -= (2*n + 4)
+                if eta:
+                    width -= ETA_WIDTH
             except:
                 # what else is there to do?
                 width = 10
@@ -31,6 +61,13 @@ class Progress:
         self.bar = bar
         self.fill = fill[0] if len(fill)>0 else '#'
         self.blank = blank[0] if len(blank)>0 else ' '
+        self.eta = eta
+        self.unit = unit
+        self.scale = scale
+        self.expected = expected
+        self.clock = clock
+        self.start = clock()
+        self.first = self.cur # where we started (e.g., when resuming)
     def set(self,cur:int):
         self.cur = max(0,min(cur,self.max))
     def get(self) -> int:
@@ -44,7 +81,32 @@ class Progress:
             out.write(f"[{self.__bar()}]")
         if self.fract:
             out.write(f" ({self.cur}/{self.max})")
+        if self.eta:
+            out.write(self.readout().ljust(ETA_WIDTH))
         out.flush()
+    def rate(self) -> float:
+        """
+        Steps per second so far
+        """
+        elapsed = self.clock() - self.start
+        return (self.cur - self.first) / elapsed if elapsed > 0 else 0
+    def remaining(self) -> float:
+        """
+        Estimated seconds until done (negative if unknown)
+        """
+        rate = self.rate()
+        if rate > 0:
+            return (self.max - self.cur) / rate
+        if self.expected > 0:
+            return max(0, self.expected - (self.clock() - self.start))
+        return -1
+    def readout(self) -> str:
+        """
+        Throughput and ETA; e.g., " 11.5 kB/s, ETA 0:42"
+        """
+        rate = format_rate(self.rate() * self.scale, self.unit) if self.cur > self.first else "-"
+        remaining = self.remaining()
+        return f" {rate}, ETA {format_duration(remaining) if remaining >= 0 else '-'}"
     def __bar(self) -> str:
         # construct the progress bar
         p = (self.cur * self.width) // self.max
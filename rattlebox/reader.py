@@ -0,0 +1,207 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Background reader for a serial port.
+
+A dedicated thread drains the port in large reads, splits the input into
+lines, and pushes the lines into a bounded queue; the driver consumes the
+queue in batches. This keeps the serial port drained while the driver is
+busy decoding, writing GPX, or showing progress.
+"""
+
+from typing import (Any, Optional, Self)
+from collections import deque
+from dataclasses import (dataclass, asdict)
+import queue
+import threading
+import time
+import rattlebox.metrics as metrics
+
+@dataclass
+class Stats:
+    """
+    Reader statistics
+    """
+    reads:int = 0 # number of reads from the port
+    bytes:int = 0 # number of bytes read
+    lines:int = 0 # number of lines queued
+    max_depth:int = 0 # high-water mark of the queue
+    dropped:int = 0 # lines dropped because the queue was full
+    stalls:int = 0 # times the reader waited for the consumer (block=True)
+    overruns:int = 0 # lines discarded because they exceeded the maximum line length
+
+    def to_dict(self) -> dict[str,int]:
+        return asdict(self)
+
+class Reader:
+    """
+    Read lines from a port on a background thread.
+    The port must provide read(n); if it also provides in_waiting (as
+    serial.Serial does), everything that is waiting is read at once,
+    otherwise the port is read in chunk_size pieces.
+    If the queue is full, new lines are dropped, unless block is True, in
+    which case the reader waits for the consumer to catch up.
+    If metrics are given, the time that each line spends in the queue (from
+    the read that it came in, until it is consumed) is recorded, as
+    "reader.queue_latency_us".
+    """
+    def __init__(self, port:Any, maxsize:int = 4096, chunk_size:int = 4096, max_line:int = 1024, block:bool = True,
+                 metrics:Optional[metrics.Metrics] = None):
+        self.port = port
+        self.metrics = metrics
+        # when each queued line was read (perf_counter_ns), if there are metrics
+        self._stamps:Optional[deque[int]] = deque() if metrics is not None else None
+        self._stamp = 0
+        self.queue:queue.Queue[bytes] = queue.Queue(maxsize)
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self.block = block
+        self.stats = Stats()
+        self.error:Optional[Exception] = None # error that stopped the reader (if any)
+        self._stop = threading.Event()
+        self._thread:Optional[threading.Thread] = None
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rattlebox-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout:Optional[float] = None) -> None:
+        """
+        Stop the reader thread and wait for it to finish
+        """
+        self._stop.set()
+        cancel = getattr(self.port, "cancel_read", None)
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def depth(self) -> int:
+        """
+        Number of lines waiting in the queue
+        """
+        return self.queue.qsize()
+
+    def get(self, timeout:Optional[float] = None) -> Optional[bytes]:
+        """
+        Get the next line, waiting up to timeout seconds.
+        Returns None if there is no line.
+        """
+        try:
+            line = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._latency(1)
+        return line
+
+    def get_batch(self, max:int = 256, timeout:Optional[float] = 0.5) -> list[bytes]:
+        """
+        Get up to max lines; waits up to timeout seconds for the first line,
+        but not for the rest.
+        If the reader stopped because of an error reading from the port, and
+        there are no more lines, the error is raised.
+        """
+        batch:list[bytes] = []
+        try:
+            line:Optional[bytes] = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            line = None
+        if line is None and self.error is not None:
+            raise self.error
+        while line is not None:
+            batch.append(line)
+            if len(batch) >= max:
+                break
+            try:
+                line = self.queue.get_nowait()
+            except queue.Empty:
+                line = None
+        self._latency(len(batch))
+        return batch
+
+    def _latency(self, n:int) -> None:
+        """
+        Record the queue latency of the n lines that were just consumed
+        """
+        if self._stamps is None or self.metrics is None:
+            return
+        now = time.perf_counter_ns()
+        for _ in range(n):
+            self.metrics.observe("reader.queue_latency_us", (now - self._stamps.popleft()) // 1000)
+
+    def _run(self) -> None:
+        buf = bytearray()
+        discard = False # discarding the rest of an overlong line
+        try:
+            while not self._stop.is_set():
+                # read whatever is waiting (at least 1 byte, which may block
+                # until the port's timeout)
+                n = getattr(self.port, "in_waiting", None)
+                data = self.port.read(self.chunk_size if n is None else min(max(n,1), self.chunk_size))
+                if not data:
+                    continue
+                if self._stamps is not None:
+                    self._stamp = time.perf_counter_ns()
+                self.stats.reads += 1
+                self.stats.bytes += len(data)
+                buf.extend(data)
+                start = 0
+                while True:
+                    end = buf.find(b'\n', start)
+                    if end < 0:
+                        break
+                    if discard:
+                        discard = False
+                    else:
+                        self._put(bytes(buf[start:end+1]))
+                    start = end + 1
+                del buf[:start]
+                if len(buf) > self.max_line:
+                    # no line delimiter in sight; discard the rest of the line
+                    if not discard:
+                        self.stats.overruns += 1
+                        discard = True
+                    buf.clear()
+        except Exception as e:
+            if not self._stop.is_set():
+                self.error = e
+
+    def _put(self, line:bytes) -> None:
+        if len(line) > self.max_line:
+            self.stats.overruns += 1
+            return
+        # (the stamp goes first: the line may be consumed as soon as it is queued)
+        if self._stamps is not None:
+            self._stamps.append(self._stamp)
+        while True:
+            try:
+                self.queue.put(line, block=self.block and not self._stop.is_set(), timeout=0.1)
+                break
+            except queue.Full:
+                if not self.block or self._stop.is_set():
+                    self.stats.dropped += 1
+                    if self._stamps is not None:
+                        self._stamps.pop()
+                    return
+                self.stats.stalls += 1
+        self.stats.lines += 1
+        depth = self.queue.qsize()
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
@@ -0,0 +1,284 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Segmentation of logged points into tracks and segments.
+
+A logger dump is one long sequence of points, which may cover many
+separate outings. A Segmenter splits it in a single pass, as the points
+arrive (in pieces, e.g., one chunk of the dump at a time):
+* a gap of more than outing_gap seconds between two points (or time going
+  backwards) starts a new track (an outing)
+* a gap of more than segment_gap seconds, a jump of more than max_jump
+  meters, or a change of fix type starts a new segment of the current track
+Tracks and segments are written to an Output as they are found: in memory
+(DocumentOutput), to a single GPX file (WriterOutput), or to one GPX file
+per outing (OutingFiles), so the whole dump never has to be in memory.
+"""
+
+from typing import (BinaryIO, Iterable, Optional)
+from dataclasses import dataclass
+import os
+import time
+import rattlebox.analytics as analytics
+import rattlebox.gpx as gpx
+
+SEGMENT = 1
+TRACK = 2
+
+@dataclass
+class Rules:
+    """
+    When to start a new track or segment (0 disables a rule)
+    """
+    outing_gap:int = 3600 # seconds
+    segment_gap:int = 120 # seconds
+    max_jump:float = 1000 # meters
+    split_on_fix:bool = True
+
+class Output:
+    """
+    Receives the tracks and segments found by a Segmenter
+    """
+    def start_track(self, ts:int) -> None:
+        """
+        Start of a track; ts is the time of its first point
+        """
+        pass
+
+    def end_track(self) -> None:
+        pass
+
+    def start_segment(self) -> None:
+        pass
+
+    def end_segment(self) -> None:
+        pass
+
+    def write_points(self, points:gpx.Points) -> None:
+        """
+        Points of the current segment
+        """
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class DocumentOutput(Output):
+    """
+    Collect the tracks in a gpx.Document.
+    Where possible, segments share the storage of the points that are written.
+    """
+    def __init__(self):
+        self.doc = gpx.Document()
+
+    def start_track(self, ts:int) -> None:
+        self.doc.add_track(gpx.Track())
+
+    def start_segment(self) -> None:
+        self.doc.tracks[-1].add_seg(gpx.Segment())
+
+    def write_points(self, points:gpx.Points) -> None:
+        seg = self.doc.tracks[-1].segs[-1]
+        if len(seg.points) == 0:
+            seg.points = points
+        else:
+            seg.add_points(points)
+
+class WriterOutput(Output):
+    """
+    Write the tracks to a single GPX file, using the given writer (inside
+    the gpx element)
+    """
+    def __init__(self, writer:gpx.Writer):
+        self.writer = writer
+
+    def start_track(self, ts:int) -> None:
+        self.writer.start_track()
+
+    def end_track(self) -> None:
+        self.writer.end_track()
+
+    def start_segment(self) -> None:
+        self.writer.start_segment()
+
+    def end_segment(self) -> None:
+        self.writer.end_segment()
+
+    def write_points(self, points:gpx.Points) -> None:
+        self.writer.write_points(points)
+
+    def flush(self) -> None:
+        self.writer.flush()
+
+class OutingFiles(Output):
+    """
+    Write each track to its own GPX file, named after the given path and the
+    time of the track's first point; e.g., log.gpx -> log-20200811-210610.gpx
+    """
+    def __init__(self, path:str, pretty:bool = True):
+        self.base, self.ext = os.path.splitext(path)
+        if not self.ext:
+            self.ext = ".gpx"
+        self.pretty = pretty
+        self.paths:list[str] = [] # files written so far
+        self.out:Optional[BinaryIO] = None
+        self.writer:Optional[gpx.Writer] = None
+
+    def start_track(self, ts:int) -> None:
+        self.close()
+        path = outing_path(self.base, self.ext, ts, self.paths)
+        self.paths.append(path)
+        self.out = open(path, 'wb')
+        self.writer = gpx.Writer(self.out, self.pretty)
+        self.writer.start_document()
+        self.writer.start_track()
+
+    def end_track(self) -> None:
+        if self.writer is not None:
+            self.writer.end_track()
+            self.writer.end_document()
+        self.close()
+
+    def start_segment(self) -> None:
+        assert(self.writer is not None)
+        self.writer.start_segment()
+
+    def end_segment(self) -> None:
+        assert(self.writer is not None)
+        self.writer.end_segment()
+
+    def write_points(self, points:gpx.Points) -> None:
+        assert(self.writer is not None)
+        self.writer.write_points(points)
+
+    def flush(self) -> None:
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self) -> None:
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            self.writer = None
+
+def outing_path(base:str, ext:str, ts:int, taken:Iterable[str] = ()) -> str:
+    """
+    Name of the file for an outing that starts at ts; e.g.,
+    log-20200811-210640.gpx, or log-20200811-210640-2.gpx if the first name
+    is taken (say, the clock was reset)
+    """
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(ts))
+    path = f"{base}-{stamp}{ext}"
+    n = 1
+    while path in taken:
+        n += 1
+        path = f"{base}-{stamp}-{n}{ext}"
+    return path
+
+class Segmenter:
+    """
+    Splits a sequence of points, given in pieces (in order), into tracks
+    and segments (see Rules), and writes them to out
+    """
+    def __init__(self, out:Output, rules:Optional[Rules] = None):
+        self.out = out
+        self.rules = rules if rules is not None else Rules()
+        self.last:Optional[gpx.Points] = None # last point seen
+        self.in_track = False
+        self.tracks = 0
+        self.segments = 0
+
+    def resume(self) -> None:
+        """
+        Continue the current segment of out (e.g., when appending to a
+        partially written file)
+        """
+        self.in_track = True
+
+    def add(self, points:gpx.Points) -> None:
+        n = len(points)
+        if n == 0:
+            return
+        # include the last point of the previous piece
+        pts = points
+        k = 0 # index of points[0] in pts
+        if self.last is not None:
+            pts = gpx.Points()
+            pts.extend(self.last)
+            pts.extend(points)
+            k = 1
+        self.last = points[n-1:]
+        ts, _, _, _, fix = pts.columns()
+        # the kind of break (if any) between each point and the next
+        r = self.rules
+        dt = [ t2 - t1 for t1, t2 in zip(ts, ts[1:]) ]
+        kinds = [ TRACK if d < 0 or (r.outing_gap > 0 and d > r.outing_gap) else
+                  SEGMENT if r.segment_gap > 0 and d > r.segment_gap else 0 for d in dt ]
+        if r.max_jump > 0:
+            kinds = [ kind or (SEGMENT if d > r.max_jump else 0) for kind, d in zip(kinds, analytics.distances(pts)) ]
+        if r.split_on_fix:
+            kinds = [ kind or (SEGMENT if f1 != f2 else 0) for kind, f1, f2 in zip(kinds, fix, fix[1:]) ]
+        out = self.out
+        if not self.in_track:
+            self._start_track(ts[k])
+        start = 0
+        for i in [ i for i, kind in enumerate(kinds) if kind ]:
+            # break before pts[i+1], i.e., points[i+1-k]
+            j = i + 1 - k
+            if j > start:
+                out.write_points(points[start:j])
+            out.end_segment()
+            if kinds[i] == TRACK:
+                out.end_track()
+                self._start_track(ts[i+1])
+            else:
+                out.start_segment()
+                self.segments += 1
+            start = j
+        out.write_points(points[start:] if start > 0 else points)
+
+    def end(self) -> None:
+        """
+        End of the points; closes the current track
+        """
+        if self.in_track:
+            self.out.end_segment()
+            self.out.end_track()
+            self.in_track = False
+        self.last = None
+
+    def _start_track(self, ts:int) -> None:
+        self.out.start_track(ts)
+        self.out.start_segment()
+        self.in_track = True
+        self.tracks += 1
+        self.segments += 1
+
+def segment(points:gpx.Points, rules:Optional[Rules] = None) -> gpx.Document:
+    """
+    Split points into tracks and segments; the segments of the document
+    share the storage of points
+    """
+    out = DocumentOutput()
+    segmenter = Segmenter(out, rules)
+    segmenter.add(points)
+    segmenter.end()
+    return out.doc
+
+def write(doc:gpx.Document, out:Output) -> None:
+    """
+    Write the (non-empty) tracks and segments of a document to out
+    """
+    for track in doc.tracks:
+        segs = [ seg for seg in track.segs if len(seg.points) > 0 ]
+        if len(segs) == 0:
+            continue
+        out.start_track(segs[0].points.columns()[0][0])
+        for seg in segs:
+            out.start_segment()
+            out.write_points(seg.points)
+            out.end_segment()
+        out.end_track()
@@ -0,0 +1,393 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Fan-out server (daemon) for live fixes.
+
+A serial port can only be opened by one process. The server owns it
+(through aio.AsyncDriver, and so mt3339.Driver), and serves each epoch, as
+soon as it is complete, to any number of local clients, over UNIX domain
+sockets and/or localhost TCP, speaking (a subset of) the gpsd JSON protocol.
+Requests are lines, and responses are JSON objects, one per line:
+* each client is greeted with a VERSION object
+* ?WATCH={"enable":true,"json":true}; starts a stream of TPV (time, position
+  and velocity) and SKY (DOPs and satellites) objects; enable:false stops it
+* ?POLL; returns the latest TPV and SKY
+* ?VERSION; and ?DEVICES;
+* ?PMTK={"cmd":"logger-status"}; sends a command to the device: the name of
+  a command (see mt3339.Driver.COMMANDS), or the body of a PMTK message
+  (e.g., PMTK220,200). The commands of all clients go through one (bounded)
+  queue, and are sent one at a time; the response (a PMTK object) tells
+  how the device acknowledged the command (its status is succeeded, invalid,
+  unsupported, failed, or timed out; see command.FLAGS). Commands that would
+  take the device away from the other clients (changing the baud rate,
+  dumping the log), or destroy what it has (erasing the log, restarting it)
+  are refused.
+
+TCP is only served on loopback addresses (e.g., localhost:2947); the
+clients are local.
+
+Each client has a bounded output buffer (max_buffer bytes); a client that
+lets it fill up is disconnected, rather than holding up the device or the
+other clients.
+
+Usage: python -m rattlebox serve <device> [--listen <address>] ... (see main)
+"""
+
+from typing import (Any, Iterable, Optional)
+import asyncio
+import ipaddress
+import json
+import math
+import os
+import signal
+import stat
+import sys
+import rattlebox.aio as aio
+import rattlebox.follow as follow
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.options as options
+
+DEFAULT_ADDRESS = "localhost:2947" # gpsd's port
+PROTO_MAJOR = 3 # of the gpsd protocol
+PROTO_MINOR = 11
+
+# commands (message types) that clients may not send
+REFUSED = {
+    "PMTK101": "the device cannot be restarted while serving",
+    "PMTK102": "the device cannot be restarted while serving",
+    "PMTK103": "the device cannot be restarted while serving",
+    "PMTK104": "the device cannot be reset while serving",
+    "PMTK184": "the log cannot be erased while serving",
+    "PMTK251": "the server owns the baud rate",
+    "PMTK622": "the log cannot be dumped while serving",
+}
+
+def encode(obj:dict[str,Any]) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b"\r\n"
+
+def error(message:str) -> dict[str,Any]:
+    return { "class": "ERROR", "message": message }
+
+def tpv(fix:nmea.Fix, device:str) -> dict[str,Any]:
+    """
+    TPV (time-position-velocity) report of a fix; unknown values are left out
+    """
+    if fix.mode > 0:
+        mode = fix.mode
+    elif not fix.has_position():
+        mode = 1
+    else:
+        mode = 2 if math.isnan(fix.ele) else 3
+    report:dict[str,Any] = { "class": "TPV", "device": device, "mode": mode }
+    if fix.ts > 0:
+        report["time"] = follow.iso_time(follow.fix_time(fix))
+    if fix.quality == 2:
+        report["status"] = 2 # DGPS
+    for key, value in (("lat", fix.lat), ("lon", fix.lon), ("alt", fix.ele), ("altMSL", fix.ele),
+                       ("speed", fix.speed), ("track", fix.course)):
+        if not math.isnan(value):
+            report[key] = value
+    return report
+
+def sky(fix:nmea.Fix, device:str) -> Optional[dict[str,Any]]:
+    """
+    SKY report of a fix, if its epoch reported DOPs or satellites (GSA, GSV)
+    """
+    if math.isnan(fix.pdop) and fix.sats_in_view == 0:
+        return None
+    report:dict[str,Any] = { "class": "SKY", "device": device }
+    if fix.ts > 0:
+        report["time"] = follow.iso_time(follow.fix_time(fix))
+    for key, value in (("hdop", fix.hdop), ("pdop", fix.pdop), ("vdop", fix.vdop)):
+        if not math.isnan(value):
+            report[key] = value
+    report["nSat"] = fix.sats_in_view
+    report["uSat"] = fix.sats
+    report["satellites"] = [ { "PRN": prn, "used": True } for prn in fix.prns ]
+    return report
+
+def refused(cmd:str) -> Optional[str]:
+    """
+    Why a client may not send the command (if it may not)
+    """
+    body = mt3339.Driver.command_body(cmd)
+    return REFUSED.get(body.split(",")[0])
+
+def is_loopback(host:str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class Client:
+    """
+    A connected client; what is sent to it is buffered (by its transport),
+    up to max_buffer bytes
+    """
+    def __init__(self, writer:asyncio.StreamWriter, max_buffer:int):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.watch = False # stream the reports
+        self.closed = False
+
+    def write(self, data:bytes) -> bool:
+        """
+        Send data, unless the client has fallen behind; returns False (and
+        disconnects the client) if it has
+        """
+        if self.closed:
+            return False
+        if self.writer.is_closing() or self.writer.transport.get_write_buffer_size() + len(data) > self.max_buffer:
+            self.close()
+            return False
+        self.writer.write(data)
+        return True
+
+    def send(self, obj:dict[str,Any]) -> bool:
+        return self.write(encode(obj))
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+class Server:
+    """
+    Serves the fixes of a device (see the module docstring). Call listen
+    for each address, then start.
+    """
+    def __init__(self, drv:aio.AsyncDriver, device:str = "", max_buffer:int = 65536, max_queue:int = 16):
+        self.drv = drv
+        self.device = device
+        self.max_buffer = max_buffer
+        self.commands:asyncio.Queue[tuple[Client,str]] = asyncio.Queue(max_queue)
+        self.servers:list[asyncio.AbstractServer] = []
+        self.paths:list[str] = [] # of the UNIX sockets
+        self.clients:set[Client] = set()
+        self.handlers:set[asyncio.Task[Any]] = set() # of the connections
+        self.tpv:Optional[dict[str,Any]] = None # the latest reports
+        self.sky:Optional[dict[str,Any]] = None
+        self.task:Optional[asyncio.Task[None]] = None # sends the queued commands
+        # counts
+        self.connected = 0
+        self.published = 0
+        self.dropped = 0 # clients that were disconnected for falling behind
+        drv.driver.on_fix = self.publish
+        drv.driver.nmea.early = True
+
+    async def listen(self, address:str) -> None:
+        """
+        Accept clients at address: host:port (TCP, where host is a loopback
+        address), or the path of a UNIX socket
+        """
+        if ":" in address and "/" not in address:
+            host, _, port = address.rpartition(":")
+            host = host.strip("[]") or "localhost"
+            if not is_loopback(host):
+                raise Exception(f"not a loopback address: {host} (only local clients are served)")
+            self.servers.append(await asyncio.start_server(self._serve, host, int(port)))
+            return
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            # left over from an earlier run
+            os.remove(address)
+        self.servers.append(await asyncio.start_unix_server(self._serve, address))
+        self.paths.append(address)
+
+    def start(self) -> None:
+        self.drv.start()
+        if self.task is None:
+            self.task = asyncio.create_task(self._send_commands())
+
+    async def close(self) -> None:
+        for server in self.servers:
+            server.close()
+        for client in list(self.clients):
+            client.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
+
+    def publish(self, fix:nmea.Fix) -> None:
+        """
+        A complete epoch: send its reports to the watching clients
+        """
+        self.tpv = tpv(fix, self.device)
+        data = encode(self.tpv)
+        report = sky(fix, self.device)
+        if report is not None:
+            self.sky = report
+            data += encode(report)
+        for client in list(self.clients):
+            if client.watch and not client.write(data):
+                self.clients.discard(client)
+                self.dropped += 1
+        self.published += 1
+
+    def request(self, client:Client, line:str) -> None:
+        """
+        Handle a request from a client; e.g., ?WATCH={"enable":true};
+        """
+        line = line.strip().rstrip(";")
+        if len(line) == 0:
+            return
+        name, _, arg = line.partition("=")
+        try:
+            params = json.loads(arg) if arg else {}
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            client.send(error(f"invalid request parameters: {arg}"))
+            return
+        match name:
+            case "?VERSION":
+                client.send(self.version())
+            case "?DEVICES":
+                client.send(self.devices())
+            case "?WATCH":
+                if "enable" in params:
+                    client.watch = bool(params["enable"])
+                client.send(self.devices())
+                client.send({ "class": "WATCH", "enable": client.watch, "json": client.watch })
+            case "?POLL":
+                client.send({ "class": "POLL", "active": 0 if self.tpv is None else 1,
+                              "tpv": [] if self.tpv is None else [ self.tpv ],
+                              "sky": [] if self.sky is None else [ self.sky ] })
+            case "?PMTK":
+                self.submit(client, params.get("cmd"))
+            case _:
+                client.send(error(f"unrecognized request: {name}"))
+
+    def submit(self, client:Client, cmd:Any) -> None:
+        """
+        Queue a command from a client
+        """
+        if not isinstance(cmd, str):
+            client.send(error("missing command"))
+            return
+        try:
+            reason = refused(cmd)
+        except Exception as e:
+            reason = str(e)
+        if reason is not None:
+            client.send({ "class": "PMTK", "cmd": cmd, "status": "refused", "message": reason })
+            return
+        try:
+            self.commands.put_nowait((client, cmd))
+        except asyncio.QueueFull:
+            client.send({ "class": "PMTK", "cmd": cmd, "status": "busy", "message": "too many commands are queued" })
+
+    def version(self) -> dict[str,Any]:
+        return { "class": "VERSION", "release": "rattlebox", "rev": "rattlebox",
+                 "proto_major": PROTO_MAJOR, "proto_minor": PROTO_MINOR }
+
+    def devices(self) -> dict[str,Any]:
+        return { "class": "DEVICES", "devices": [ { "class": "DEVICE", "path": self.device, "driver": "MT3339" } ] }
+
+    async def _serve(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        client = Client(writer, self.max_buffer)
+        self.clients.add(client)
+        task = asyncio.current_task()
+        if task is not None:
+            self.handlers.add(task)
+        self.connected += 1
+        try:
+            client.send(self.version())
+            while not client.closed:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.request(client, line.decode('utf-8', 'replace'))
+        except (ConnectionError, ValueError):
+            # gone, or sent a line that is too long
+            pass
+        finally:
+            self.clients.discard(client)
+            self.handlers.discard(task)
+            client.close()
+
+    async def _send_commands(self) -> None:
+        while True:
+            client, cmd = await self.commands.get()
+            reply:dict[str,Any] = { "class": "PMTK", "cmd": cmd }
+            try:
+                req = await (await self.drv.send_command(cmd))
+                reply.update(status=req.status(), tries=req.tries)
+            except Exception as e:
+                reply.update(status="error", message=str(e))
+            client.send(reply)
+
+async def serve(transport:aio.Transport, addresses:list[str], device:str = "", init:Iterable[str] = (),
+                timeout:float = 2, retries:int = 2, **kwargs:Any) -> Server:
+    """
+    Serve the device at the other end of transport until it goes away (or
+    the task is cancelled); init are commands to send to the device first
+    (e.g., output-all). timeout and retries are for commands (see
+    command.Pipeline), and kwargs are passed to the Server.
+    """
+    async with aio.AsyncDriver(transport, timeout=timeout, retries=retries) as drv:
+        server = Server(drv, device, **kwargs)
+        try:
+            for address in addresses:
+                await server.listen(address)
+            server.start()
+            await asyncio.gather(*[ drv.command(cmd) for cmd in init ])
+            print(f"serving {device} at {', '.join(addresses)}", file=sys.stderr)
+            if drv.task is not None:
+                await drv.task
+        finally:
+            await server.close()
+            print(f"served {server.published} epochs to {server.connected} clients ({server.dropped} dropped)", file=sys.stderr)
+    return server
+
+def main(args:list[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox serve",
+                                     description="Serve live fixes from the device to local clients (gpsd JSON protocol)")
+    parser.add_argument("device", help="serial device; e.g., /dev/tty.usbserial-410")
+    parser.add_argument("-b", "--baud", type=int, default=options.Options.DEF_BAUD, help="serial port baud rate")
+    parser.add_argument("-l", "--listen", action="append", default=None,
+                        help=f"host:port (TCP, on a loopback address), or the path of a UNIX socket; can be repeated (default: {DEFAULT_ADDRESS})")
+    parser.add_argument("--init", action="append", default=[], help="command to send to the device first (e.g., output-all); can be repeated")
+    parser.add_argument("--max-buffer", type=int, default=65536, help="bytes buffered per client, before it is disconnected")
+    parser.add_argument("--max-queue", type=int, default=16, help="commands that can be queued")
+    parser.add_argument("--command-timeout", type=float, default=2, help="seconds to wait for the device to acknowledge a command")
+    parser.add_argument("--retries", type=int, default=2, help="times a command is sent again, if it is not acknowledged")
+    opts = parser.parse_args(args)
+    try:
+        transport = aio.FdTransport.open_serial(opts.device, opts.baud)
+    except Exception as e:
+        print(f"failed to open serial device: {e}", file=sys.stderr)
+        return 2
+    async def run() -> None:
+        # stop (cleanly) when terminated
+        task = asyncio.current_task()
+        assert(task is not None)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        await serve(transport, opts.listen or [ DEFAULT_ADDRESS ], opts.device, opts.init, max_buffer=opts.max_buffer,
+                    timeout=opts.command_timeout, retries=opts.retries, max_queue=opts.max_queue)
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
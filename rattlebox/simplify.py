@@ -0,0 +1,147 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+Track simplification.
+
+Drops points that don't contribute to the shape of a track, using either
+* Douglas-Peucker ("dp"): keeps the points that are more than tolerance
+  meters from the line through the points that are kept on either side.
+  O(n log n) on typical tracks, but O(n^2) in the worst case, so long
+  segments are simplified in windows of bounded size (see douglas_peucker).
+* Visvalingam-Whyatt ("vw"): repeatedly drops the point that forms the
+  smallest triangle with its neighbours, until all triangles are at least
+  tolerance^2 square meters. O(n log n) in the worst case.
+Both are iterative (no recursion), and work on a local equirectangular
+projection of the segment, in meters.
+"""
+
+from typing import (Callable)
+from array import array
+import heapq
+import math
+import rattlebox.gpx as gpx
+
+EARTH_RADIUS = 6371000 # meters
+
+METHODS = ("dp", "vw")
+
+def project(points:gpx.Points) -> tuple[array,array]:
+    """
+    Project the points onto a plane (x, y in meters), using an
+    equirectangular projection centered on the segment
+    """
+    _, lat, lon, _, _ = points.columns()
+    if len(lat) == 0:
+        return array('d'), array('d')
+    lat0 = math.radians((min(lat) + max(lat)) / 2)
+    ky = EARTH_RADIUS * math.pi / 180
+    kx = ky * math.cos(lat0)
+    return array('d', [ v * kx for v in lon ]), array('d', [ v * ky for v in lat ])
+
+def douglas_peucker(x:array, y:array, tolerance:float, window:int = 1024) -> list[int]:
+    """
+    Indices of the points to keep, using Douglas-Peucker.
+    To bound the worst case, the points are simplified in windows of at most
+    window points (the ends of each window are kept).
+    """
+    n = len(x)
+    if n < 3:
+        return list(range(n))
+    keep = bytearray(n)
+    tol2 = tolerance * tolerance
+    stack = [ (i, min(i+window, n) - 1) for i in range(0, n-1, window-1) ]
+    for first, last in stack:
+        keep[first] = keep[last] = 1
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x0, y0 = x[first], y[first]
+        dx, dy = x[last] - x0, y[last] - y0
+        len2 = dx*dx + dy*dy
+        # distance of each point in (first,last) to the line (squared, and
+        # scaled by len2, if the line has a length)
+        xs, ys = x[first+1:last], y[first+1:last]
+        if len2 == 0:
+            d2 = [ (px-x0)**2 + (py-y0)**2 for px, py in zip(xs, ys) ]
+            len2 = 1
+        else:
+            d2 = [ ((px-x0)*dy - (py-y0)*dx)**2 for px, py in zip(xs, ys) ]
+        imax = max(range(len(d2)), key=d2.__getitem__)
+        if d2[imax] > tol2 * len2:
+            i = first + 1 + imax
+            keep[i] = 1
+            stack.append((first, i))
+            stack.append((i, last))
+    return [ i for i in range(n) if keep[i] ]
+
+def visvalingam_whyatt(x:array, y:array, tolerance:float) -> list[int]:
+    """
+    Indices of the points to keep, using Visvalingam-Whyatt; points are
+    dropped while their effective area is less than tolerance^2
+    """
+    n = len(x)
+    if n < 3:
+        return list(range(n))
+    min_area = tolerance * tolerance
+    prev = list(range(-1, n-1))
+    next = list(range(1, n+1))
+    def area(i:int) -> float:
+        a, c = prev[i], next[i]
+        return abs((x[a]-x[i])*(y[c]-y[i]) - (x[c]-x[i])*(y[a]-y[i])) / 2
+    areas = [ math.inf ] + [ area(i) for i in range(1, n-1) ] + [ math.inf ]
+    heap = [ (areas[i], i) for i in range(1, n-1) ]
+    heapq.heapify(heap)
+    removed = bytearray(n)
+    last = 0.0
+    while heap:
+        a, i = heapq.heappop(heap)
+        if removed[i] or a != areas[i]:
+            # stale entry
+            continue
+        if a >= min_area:
+            break
+        # an area can't be less than that of a point that was dropped
+        # before it
+        last = max(last, a)
+        removed[i] = 1
+        p, q = prev[i], next[i]
+        next[p] = q
+        prev[q] = p
+        for j in (p, q):
+            if 0 < j < n-1:
+                areas[j] = max(area(j), last)
+                heapq.heappush(heap, (areas[j], j))
+    return [ i for i in range(n) if not removed[i] ]
+
+ALGORITHMS:dict[str,Callable[[array,array,float],list[int]]] = {
+    "dp": douglas_peucker,
+    "vw": visvalingam_whyatt,
+}
+
+def simplify(points:gpx.Points, tolerance:float, method:str = "dp") -> gpx.Points:
+    """
+    Simplify a sequence of points, with the given tolerance (meters)
+    """
+    if method not in ALGORITHMS:
+        raise Exception(f"unknown simplification method: {method}")
+    if len(points) < 3:
+        return points
+    x, y = project(points)
+    keep = ALGORITHMS[method](x, y, tolerance)
+    if len(keep) == len(points):
+        return points
+    return points.take(keep)
+
+def simplify_document(doc:gpx.Document, tolerance:float, method:str = "dp") -> int:
+    """
+    Simplify each segment of the document, in place.
+    Returns the number of points that were dropped.
+    """
+    dropped = 0
+    for track in doc.tracks:
+        for seg in track.segs:
+            n = len(seg.points)
+            seg.points = simplify(seg.points, tolerance, method)
+            dropped += n - len(seg.points)
+    return dropped
@@ -0,0 +1,513 @@
+# Copyright (c) 2024 Thomas Mikalsen. Subject to the MIT License
+# vim: ts=4 sw=4
+"""
+MT3339 simulator.
+
+Simulator speaks the subset of the PMTK protocol that the driver uses (see
+mt3339.Driver.COMMANDS), and synthesizes NMEA output and LOCUS logs:
+* PMTK000 - test packet
+* PMTK314 - NMEA output configuration
+* PMTK183/184/185 - logger status, erase, start/stop
+* PMTK622 - dump the log, as $PMTKLOX messages
+* PMTK251 - change the baud rate
+Faults (dropped lines, corrupt checksums, and stalls) can be injected.
+
+The simulator can be reached through SimPort (a stand-in for serial.Serial),
+SimTransport (see aio), or a pty (see PtyServer, and main).
+"""
+
+from typing import (Callable, Optional, Self)
+from dataclasses import dataclass
+import asyncio
+import math
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+import rattlebox.aio as aio
+import rattlebox.locus as locus
+import rattlebox.nmea as nmea
+
+# Sentences in the order of the PMTK314 fields
+OUTPUTS = ("GLL", "RMC", "VTG", "GGA", "GSA", "GSV")
+
+FLASH_SIZE = locus.FLASH_SIZE # bytes of LOCUS flash (for the "percent used" status)
+WORDS_PER_CHUNK = locus.CHUNK_SIZE // 4 # 32-bit words per $PMTKLOX,1 message
+EARTH_RADIUS = 6371000 # meters
+
+@dataclass
+class Faults:
+    """
+    Faults to inject into the output of the simulator; probabilities are per
+    line.
+    """
+    drop:float = 0 # drop the line
+    corrupt:float = 0 # corrupt the checksum of the line
+    stall:float = 0 # stop sending for stall_time seconds (before the line)
+    stall_time:float = 0.5
+
+@dataclass
+class Stats:
+    lines:int = 0 # lines sent
+    bytes:int = 0 # bytes sent
+    dropped:int = 0
+    corrupted:int = 0
+    stalls:int = 0
+    commands:int = 0 # commands received
+
+@dataclass
+class Track:
+    """
+    A simulated track: constant speed and course, from the given start
+    """
+    lat:float = 41.4509 # decimal degrees
+    lon:float = -73.9312 # decimal degrees
+    ele:float = 100 # meters
+    speed:float = 1.5 # meters per second
+    course:float = 200 # degrees
+
+    def position(self, t:float) -> tuple[float,float,float]:
+        """
+        Position (lat, lon, ele) after t seconds
+        """
+        d = self.speed * t
+        rad = math.radians(self.course)
+        lat = self.lat + math.degrees(d * math.cos(rad) / EARTH_RADIUS)
+        lon = self.lon + math.degrees(d * math.sin(rad) / (EARTH_RADIUS * math.cos(math.radians(self.lat))))
+        ele = self.ele + 10 * math.sin(t / 600)
+        return lat, lon, ele
+
+def make_log(n:int, start_ts:int = 1597180000, interval:int = 15, track:Optional[Track] = None, first:int = 0) -> bytes:
+    """
+    Make a LOCUS log image with n records, one every interval seconds,
+    starting with record number first (to make a long log in pieces)
+    """
+    if track is None:
+        track = Track()
+    recs = bytearray()
+    for i in range(first, first + n):
+        lat, lon, ele = track.position(i * interval)
+        recs += locus.encode(start_ts + i * interval, 2, lat, lon, int(ele))
+    return bytes(recs)
+
+def sentence(body:str) -> bytes:
+    """
+    Frame a sentence: $<body>*<checksum><CR><LF>
+    """
+    return f"${body}*{nmea.checksum(body)}\r\n".encode("ascii")
+
+def lox_sentence(seq:int, data:bytes|bytearray) -> bytes:
+    """
+    The $PMTKLOX,1 message for chunk number seq of a log
+    """
+    hex = data.hex().upper()
+    words = ",".join([ hex[i:i+8] for i in range(0, len(hex), 8) ])
+    return sentence(f"PMTKLOX,1,{seq},{words}")
+
+def format_deg(deg:float, width:int) -> tuple[str,int]:
+    """
+    Format as (d)ddmm.mmmm, and the sign
+    """
+    sign = -1 if deg < 0 else 1
+    deg = abs(deg)
+    d = int(deg)
+    return f"{d:0{width}d}{(deg - d) * 60:07.4f}", sign
+
+class Simulator:
+    """
+    Simulated MT3339. Commands are fed in with write(), and output is taken
+    with read(); output is generated as time passes (see update).
+    """
+    def __init__(self, log:bytes = b'', rate:float = 1, start_ts:int = 1597180000,
+                 track:Optional[Track] = None, faults:Optional[Faults] = None, seed:int = 0,
+                 log_interval:int = 15, clock:Callable[[],float] = time.monotonic, pad:bool = False):
+        self.log = bytearray(log) # LOCUS flash
+        self.pad = pad # like a real device, fill the last chunk of a dump with unwritten flash (0xFF)
+        self.rate = rate # fixes per second
+        self.start_ts = start_ts # Unix/epoch time of the first fix
+        self.track = track if track is not None else Track()
+        self.faults = faults if faults is not None else Faults()
+        self.random = random.Random(seed)
+        self.log_interval = log_interval # seconds between log records
+        self.clock = clock
+        self.outputs = [0,1,1,1,1,5] # sentences per fix (see OUTPUTS)
+        self.baudrate = 9600
+        self.logging = False
+        self.out = bytearray() # output, waiting to be read
+        self.inbuf = b'' # partial command
+        self.t0 = clock()
+        self.epoch = 0 # next epoch
+        self.stalled_until = 0.0
+        self.stats = Stats()
+
+    def now(self) -> float:
+        return self.clock() - self.t0
+
+    def next_due(self) -> float:
+        """
+        Time until there is more output (seconds)
+        """
+        stall = self.stalled_until - self.clock()
+        if len(self.out) > 0:
+            return max(0, stall)
+        due = self.epoch / self.rate - self.now() if self.rate > 0 else math.inf
+        return max(0, due, stall)
+
+    def update(self) -> None:
+        """
+        Generate the output that is due
+        """
+        if self.rate <= 0:
+            return
+        now = self.now()
+        while self.epoch / self.rate <= now:
+            self.emit_epoch(self.epoch)
+            self.epoch += 1
+
+    def read(self, n:int) -> bytes:
+        """
+        Take up to n bytes of output
+        """
+        self.update()
+        if len(self.out) == 0 or self.clock() < self.stalled_until:
+            return b''
+        data = bytes(self.out[:n])
+        del self.out[:n]
+        return data
+
+    def write(self, data:bytes) -> None:
+        """
+        Receive data (commands) from the host
+        """
+        buf = self.inbuf + data
+        lines = buf.split(b'\n')
+        self.inbuf = lines.pop()
+        for line in lines:
+            status, fields = nmea.tokenize(line)
+            if status == nmea.OK and fields[0].startswith("$PMTK") and fields[0][5:].isdigit():
+                self.stats.commands += 1
+                self.handle_command(fields[0][5:], fields[1:])
+
+    def send(self, line:bytes) -> None:
+        """
+        Queue a line of output, injecting faults
+        """
+        f = self.faults
+        if f.stall > 0 and self.random.random() < f.stall:
+            self.stats.stalls += 1
+            self.stalled_until = self.clock() + f.stall_time
+        if f.drop > 0 and self.random.random() < f.drop:
+            self.stats.dropped += 1
+            return
+        if f.corrupt > 0 and self.random.random() < f.corrupt:
+            self.stats.corrupted += 1
+            chk = int(line[-4:-2], 16) ^ 0x5a
+            line = line[:-4] + b'%02X\r\n' % chk
+        self.out += line
+        self.stats.lines += 1
+        self.stats.bytes += len(line)
+
+    def ack(self, cmd:str, flag:int = 3) -> None:
+        """
+        Acknowledge a command: 0 - invalid, 1 - unsupported, 2 - failed, 3 - success
+        """
+        self.send(sentence(f"PMTK001,{int(cmd)},{flag}"))
+
+    def handle_command(self, cmd:str, args:list[str]) -> None:
+        match cmd:
+            case "000":
+                self.ack(cmd)
+            case "314":
+                try:
+                    outputs = [ int(a) for a in args[:len(OUTPUTS)] ]
+                except ValueError:
+                    self.ack(cmd, 0)
+                    return
+                if len(outputs) < len(OUTPUTS) or any([ r < 0 or r > 5 for r in outputs ]):
+                    self.ack(cmd, 0)
+                    return
+                self.outputs = outputs
+                self.ack(cmd)
+            case "183":
+                self.send(sentence(self.status()))
+                self.ack(cmd)
+            case "184":
+                self.log.clear()
+                self.ack(cmd)
+            case "185":
+                if args[:1] not in (["0"],["1"]):
+                    self.ack(cmd, 0)
+                    return
+                self.logging = args[0] == "0"
+                self.ack(cmd)
+            case "622":
+                self.dump()
+                self.ack(cmd)
+            case "251":
+                # the device switches right away, and does not acknowledge
+                try:
+                    baudrate = int(args[0])
+                except (ValueError, IndexError):
+                    return
+                if baudrate in (4800, 9600, 14400, 19200, 38400, 57600, 115200):
+                    self.baudrate = baudrate
+            case _:
+                self.ack(cmd, 1)
+
+    def status(self) -> str:
+        """
+        Logger status ($PMTKLOG)
+        """
+        records = len(self.log) // locus.RECORD_SIZE
+        percent = min(100, len(self.log) * 100 // FLASH_SIZE)
+        status = 0 if self.logging else 1
+        # serial#, type (overlap), mode (interval), content, interval, distance, speed, status, records, percent
+        return f"PMTKLOG,1,0,8,1,{self.log_interval},0,0,{status},{records},{percent}"
+
+    def dump(self) -> None:
+        """
+        Dump the log, as $PMTKLOX messages
+        """
+        chunk = WORDS_PER_CHUNK * 4
+        total = (len(self.log) + chunk - 1) // chunk
+        log = self.log
+        if self.pad:
+            log = log + b'\xff' * (total * chunk - len(log))
+        self.send(sentence(f"PMTKLOX,0,{total}"))
+        for seq in range(total):
+            self.send(lox_sentence(seq, log[seq*chunk:(seq+1)*chunk]))
+        self.send(sentence("PMTKLOX,2"))
+
+    def emit_epoch(self, epoch:int) -> None:
+        """
+        Output the NMEA sentences for an epoch (and log it, if logging)
+        """
+        t = epoch / self.rate
+        ts = self.start_ts + t
+        lat, lon, ele = self.track.position(t)
+        if self.logging and epoch % max(1, round(self.log_interval * self.rate)) == 0:
+            self.log += locus.encode(int(ts), 2, lat, lon, int(ele))
+        if not any(self.outputs):
+            return
+        tm = time.gmtime(ts)
+        hms = time.strftime("%H%M%S", tm) + f"{ts % 1:.3f}"[1:]
+        date = time.strftime("%d%m%y", tm)
+        lat_s, lat_sign = format_deg(lat, 2)
+        lon_s, lon_sign = format_deg(lon, 3)
+        pos = f"{lat_s},{'N' if lat_sign > 0 else 'S'},{lon_s},{'E' if lon_sign > 0 else 'W'}"
+        knots = self.track.speed / nmea.KNOTS
+        course = self.track.course
+        for i, sid in enumerate(OUTPUTS):
+            r = self.outputs[i]
+            if r == 0 or epoch % r != 0:
+                continue
+            match sid:
+                case "GLL":
+                    self.send(sentence(f"GPGLL,{pos},{hms},A,A"))
+                case "RMC":
+                    self.send(sentence(f"GPRMC,{hms},A,{pos},{knots:.2f},{course:.2f},{date},,,A"))
+                case "VTG":
+                    self.send(sentence(f"GPVTG,{course:.2f},T,,M,{knots:.2f},N,{knots * 1.852:.2f},K,A"))
+                case "GGA":
+                    self.send(sentence(f"GPGGA,{hms},{pos},1,08,0.95,{ele:.1f},M,-34.1,M,,"))
+                case "GSA":
+                    self.send(sentence("GPGSA,A,3,01,03,08,11,14,17,22,28,,,,,1.25,0.95,0.81"))
+                case "GSV":
+                    self.send(sentence("GPGSV,2,1,08,01,63,271,32,03,54,065,30,08,38,133,28,11,24,315,26"))
+                    self.send(sentence("GPGSV,2,2,08,14,20,045,24,17,15,180,22,22,12,250,21,28,08,300,20"))
+
+class SimPort:
+    """
+    A serial port connected to a simulator; a stand-in for serial.Serial.
+    Data only gets through if the port's baud rate matches the simulator's.
+    If realtime is True, output is limited to what the baud rate allows.
+    """
+    def __init__(self, sim:Simulator, baudrate:int = 9600, timeout:Optional[float] = None, realtime:bool = False):
+        self.sim = sim
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.realtime = realtime
+        self.is_open = True
+        self.cond = threading.Condition()
+        self.cancelled = False
+        self.credit = 0.0 # bytes that may be sent (realtime)
+        self.last = time.monotonic()
+
+    def _connected(self) -> bool:
+        return self.baudrate == self.sim.baudrate
+
+    def _allowed(self, n:int) -> int:
+        if not self.realtime:
+            return n
+        now = time.monotonic()
+        # 10 bits per byte (8N1); allow a burst of up to 10ms
+        bps = self.baudrate / 10
+        self.credit = min(self.credit + (now - self.last) * bps, max(1.0, bps / 100))
+        self.last = now
+        return min(n, int(self.credit))
+
+    def read(self, n:int = 1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.cond:
+            while self.is_open and not self.cancelled:
+                m = self._allowed(n)
+                data = self.sim.read(m) if m > 0 else b''
+                if data:
+                    self.credit -= len(data)
+                    if not self._connected():
+                        # framing errors
+                        return bytes([0xff]) * len(data)
+                    return data
+                wait = self.sim.next_due()
+                if m == 0:
+                    wait = min(wait, 10 / self.baudrate)
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    wait = min(wait, left)
+                self.cond.wait(wait if wait < math.inf else None)
+            self.cancelled = False
+            return b''
+
+    @property
+    def in_waiting(self) -> int:
+        with self.cond:
+            self.sim.update()
+            return len(self.sim.out)
+
+    def write(self, data:bytes) -> int:
+        with self.cond:
+            if self._connected():
+                self.sim.write(data)
+            self.cond.notify_all()
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        with self.cond:
+            self.sim.update()
+            self.sim.out.clear()
+
+    def cancel_read(self) -> None:
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def close(self) -> None:
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+class SimTransport(aio.Transport):
+    """
+    Async transport connected to a simulator
+    """
+    def __init__(self, sim:Simulator):
+        self.sim = sim
+        self.closed = False
+        self.wakeup = asyncio.Event()
+
+    async def read(self, n:int) -> bytes:
+        while not self.closed:
+            data = self.sim.read(n)
+            if data:
+                return data
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(self.sim.next_due(), 1))
+            except asyncio.TimeoutError:
+                pass
+        return b''
+
+    async def write(self, data:bytes) -> None:
+        if self.closed:
+            raise IOError("transport is closed")
+        self.sim.write(data)
+        self.wakeup.set()
+
+    async def close(self) -> None:
+        self.closed = True
+        self.wakeup.set()
+
+class PtyServer:
+    """
+    Serves a simulator on a pty, from a background thread; connect to the
+    device named by name (e.g., with serial.Serial).
+    A pty has no baud rate, so the simulator's baud rate is not enforced.
+    """
+    def __init__(self, sim:Simulator):
+        self.sim = sim
+        self.master, self.slave = os.openpty()
+        self.name = os.ttyname(self.slave)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self._stop = threading.Event()
+        self._thread:Optional[threading.Thread] = None
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="rattlebox-sim", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _run(self) -> None:
+        pending = b''
+        while not self._stop.is_set():
+            wait = min(self.sim.next_due(), 0.1)
+            r, w, _ = select.select([self.master], [self.master] if pending else [], [], wait)
+            if r:
+                try:
+                    self.sim.write(os.read(self.master, 4096))
+                except BlockingIOError:
+                    pass
+            if not pending:
+                pending = self.sim.read(4096)
+            if pending:
+                try:
+                    n = os.write(self.master, pending)
+                    pending = pending[n:]
+                except BlockingIOError:
+                    pass
+
+def main(args:list[str]) -> None:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m rattlebox.simulator", description="Serve a simulated MT3339 on a pty")
+    parser.add_argument("--records", type=int, default=1000, help="number of records in the log")
+    parser.add_argument("--rate", type=float, default=1, help="fixes per second")
+    parser.add_argument("--drop", type=float, default=0, help="probability of dropping a line")
+    parser.add_argument("--corrupt", type=float, default=0, help="probability of corrupting a checksum")
+    parser.add_argument("--stall", type=float, default=0, help="probability of stalling")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pad", action="store_true", help="pad the last chunk of a dump with unwritten flash (0xFF)")
+    opts = parser.parse_args(args)
+    sim = Simulator(make_log(opts.records), rate=opts.rate, seed=opts.seed,
+                    faults=Faults(drop=opts.drop, corrupt=opts.corrupt, stall=opts.stall), pad=opts.pad)
+    with PtyServer(sim) as server:
+        print(f"simulated MT3339 at {server.name}", file=sys.stderr)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
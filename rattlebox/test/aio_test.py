@@ -0,0 +1,96 @@
+import unittest
+import asyncio
+import os
+import tty
+import rattlebox.aio as aio
+import rattlebox.gpx as gpx
+import rattlebox.test.fixtures as fixtures
+
+async def fake_device(transport:aio.Transport) -> None:
+    """
+    Respond to logger-dump and logger-status, and report fixes afterward
+    """
+    messages = fixtures.read_messages()
+    buf = b''
+    while True:
+        data = await transport.read(1024)
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n',1)
+            if line.startswith(b'$PMTK622'):
+                # dump the log, in small pieces
+                for msg in messages:
+                    for i in range(0,len(msg),50):
+                        await transport.write(msg[i:i+50])
+            elif line.startswith(b'$PMTK183'):
+                await transport.write(b'$PMTK001,183,3*3A\r\n')
+
+class AsyncDriverTest(unittest.IsolatedAsyncioTestCase):
+    async def test_memory_transport(self) -> None:
+        a, b = aio.MemoryTransport.pair()
+        await a.write(b"hello")
+        self.assertEqual(b"hel",await b.read(3))
+        self.assertEqual(b"lo",await b.read(10))
+        await a.close()
+        self.assertEqual(b"",await b.read(10))
+        self.assertEqual(b"",await a.read(10))
+        # a transport must implement read and write
+        class ReadOnly(aio.Transport):
+            async def read(self, n:int) -> bytes:
+                return b''
+        self.assertRaises(TypeError, ReadOnly)
+
+    async def test_command(self) -> None:
+        host, dev = aio.MemoryTransport.pair()
+        device = asyncio.create_task(fake_device(dev))
+        async with aio.AsyncDriver(host) as drv:
+            done = await drv.send_command("logger-dump")
+            await asyncio.wait_for(done,5)
+            self.assertEqual(18,len(drv.driver.log_points))
+            fixes = drv.fixes()
+            pt = await asyncio.wait_for(anext(fixes),5)
+            self.assertEqual(41,int(pt.lat))
+            await asyncio.wait_for(drv.command("logger-status"),5)
+            with self.assertRaises(Exception):
+                await drv.command("bogus")
+            # the failed command must not block the next one
+            await asyncio.wait_for(drv.command("logger-status"),5)
+        await device
+        self.assertTrue(drv.closed)
+
+    async def test_closed(self) -> None:
+        host, dev = aio.MemoryTransport.pair()
+        async with aio.AsyncDriver(host) as drv:
+            done = await drv.send_command("logger-status")
+            await dev.close()
+            with self.assertRaises(IOError):
+                await asyncio.wait_for(done,5)
+            fixes = [ pt async for pt in drv.fixes() ]
+            self.assertEqual([],fixes)
+
+    async def test_many_devices(self) -> None:
+        async def dump(host:aio.Transport) -> gpx.Points:
+            async with aio.AsyncDriver(host) as drv:
+                await asyncio.wait_for(drv.command("logger-dump"),5)
+                return drv.driver.log_points
+        pairs = [ aio.MemoryTransport.pair() for _ in range(20) ]
+        devices = [ asyncio.create_task(fake_device(dev)) for _, dev in pairs ]
+        logs = await asyncio.gather(*[ dump(host) for host, _ in pairs ])
+        self.assertEqual([18]*20,[len(log) for log in logs])
+        await asyncio.gather(*devices)
+
+    async def test_pty(self) -> None:
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        dev = aio.FdTransport(master)
+        device = asyncio.create_task(fake_device(dev))
+        async with aio.AsyncDriver(aio.FdTransport(slave)) as drv:
+            await asyncio.wait_for(drv.command("logger-dump"),5)
+            self.assertEqual(18,len(drv.driver.log_points))
+        await asyncio.wait_for(device,5)
+        await dev.close()
+
+if __name__ == '__main__':
+    unittest.main()
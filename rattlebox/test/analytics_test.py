@@ -0,0 +1,72 @@
+import unittest
+import rattlebox.analytics as analytics
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+
+def make_points(ts:list[int], lat:list[float], ele:list[int]) -> gpx.Points:
+    points = gpx.Points()
+    points.extend_columns(ts, lat, [-73.0]*len(ts), ele)
+    return points
+
+class AnalyticsTest(unittest.TestCase):
+    def test_distance(self) -> None:
+        # Land's End to John o' Groats
+        self.assertAlmostEqual(969954.166,analytics.vincenty(50.06632,-5.71475,58.64402,-3.07009),2)
+        self.assertAlmostEqual(968.9,analytics.haversine(50.06632,-5.71475,58.64402,-3.07009)/1000,1)
+        self.assertEqual(0,analytics.vincenty(41,-73,41,-73))
+        # antipodal: falls back to haversine
+        self.assertAlmostEqual(analytics.haversine(0,0,0.5,179.7),analytics.vincenty(0,0,0.5,179.7),-5)
+        # 0.001 degrees of latitude is ~111m
+        points = make_points([0,10,20,30],[41.0,41.001,41.002,41.002],[0]*4)
+        for method in analytics.METHODS:
+            dist = analytics.distances(points, method)
+            self.assertEqual(3,len(dist))
+            self.assertAlmostEqual(111,dist[0],0)
+            self.assertEqual(0,dist[2])
+        dist = analytics.distances(points)
+        self.assertEqual([0,dist[0],dist[0]+dist[1],dist[0]+dist[1]],list(analytics.cumulative(dist)))
+        self.assertEqual([dist[0]/10,dist[1]/10,0],list(analytics.speeds(points)))
+        self.assertEqual(0,len(analytics.distances(gpx.Points())))
+
+    def test_stats(self) -> None:
+        # moving at ~11 m/s for 20s, stopped for 10s, a 1000s gap, then moving for 10s
+        points = make_points([0,10,20,30,1030,1040],[41.0,41.001,41.002,41.002,41.003,41.004],[100,102,110,108,100,104])
+        stats = analytics.stats(points)
+        self.assertEqual(6,stats.points)
+        self.assertEqual(1040,stats.elapsed)
+        self.assertEqual(30,stats.moving_time)
+        self.assertEqual(10,stats.stopped_time)
+        self.assertAlmostEqual(111.2*4,stats.distance,-1)
+        self.assertAlmostEqual(11.1,stats.max_speed,1)
+        # 100 -> 110 (+10), 110 -> 100 (-10); +2, -2 and +4 are within the hysteresis
+        self.assertEqual((10,10),(stats.gain,stats.loss))
+        self.assertEqual(stats,analytics.stats(gpx.Points()).merge(stats))
+        self.assertIn("km/h",str(stats))
+
+    def test_accumulator(self) -> None:
+        points = gpxread.read('doc/SunkMineRoad.gpx').tracks[0].segs[0].points
+        whole = analytics.stats(points)
+        for n in [1, 7, 100]:
+            acc = analytics.Accumulator()
+            for i in range(0,len(points),n):
+                acc.add(points[i:i+n])
+            stats = acc.stats()
+            self.assertAlmostEqual(whole.distance,stats.distance,6)
+            stats.distance = whole.distance
+            self.assertEqual(whole,stats)
+        self.assertRaises(Exception, lambda: analytics.Accumulator("bogus"))
+
+    def test_segment_cache(self) -> None:
+        seg = gpx.Segment(make_points([0,10],[41.0,41.001],[0,0]))
+        stats = seg.stats()
+        self.assertIs(stats,seg.stats())
+        seg.add_point(gpx.Point(20,41.002,-73.0,0))
+        self.assertEqual(3,seg.stats().points)
+        seg.points = seg.points[:1]
+        self.assertEqual(1,seg.stats().points)
+        track = gpx.Track([seg, gpx.Segment(make_points([0,10],[41.0,41.001],[0,0]))])
+        self.assertEqual(3,track.stats().points)
+        self.assertEqual(10,track.stats().elapsed)
+
+if __name__ == '__main__':
+    unittest.main()
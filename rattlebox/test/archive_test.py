@@ -0,0 +1,117 @@
+import unittest
+import io
+import json
+import os
+import tempfile
+import rattlebox.archive as archive
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+import rattlebox.mt3339 as mt3339
+import rattlebox.test.fixtures as fixtures
+
+def read_points() -> gpx.Points:
+    points = gpxread.read('doc/SunkMineRoad.gpx').tracks[0].segs[0].points
+    # with fix types, too
+    ts, lat, lon, ele, _ = points.columns()
+    result = gpx.Points()
+    result.extend_columns(ts, lat, lon, ele, [ 2 + 2*(i%2) for i in range(len(points)) ])
+    return result
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "log.rbx")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_roundtrip(self) -> None:
+        points = read_points()
+        for compress in [False, True]:
+            with archive.ArchiveWriter(self.path, compress, block_points=100) as writer:
+                writer.write(points[:150])
+                writer.write(points[150:])
+                self.assertEqual(400,writer.points)
+            with archive.Archive(self.path) as arc:
+                self.assertEqual(len(points),len(arc))
+                self.assertEqual([100]*4+[7],[ b.n for b in arc.blocks ])
+                self.assertEqual(points,arc.read())
+                self.assertEqual(list(points.columns()[4]),[ f for pts in arc for f in pts.columns()[4] ])
+                block = arc.blocks[1]
+                pts = points[100:200]
+                ts, lat, lon, ele, _ = pts.columns()
+                self.assertEqual((min(ts),max(ts),min(lat),max(lat),min(lon),max(lon),min(ele),max(ele)),
+                                 (block.ts_min,block.ts_max,block.lat_min,block.lat_max,block.lon_min,block.lon_max,block.ele_min,block.ele_max))
+                self.assertEqual(compress,block.flags == archive.COMPRESSED)
+                cols = arc.columns(block)
+                self.assertEqual(list(lat),list(cols[1]))
+                if not compress:
+                    # a view of the file
+                    self.assertIs(arc.map,cols[1].obj)
+                del cols
+            size = os.path.getsize(self.path)
+            self.assertLess(size,len(points)*(archive.POINT_SIZE+1) if not compress else len(points)*10)
+
+    def test_read(self) -> None:
+        points = read_points()
+        archive.write(self.path, points)
+        ts, lat, lon, _, _ = points.columns()
+        with archive.Archive(self.path) as arc:
+            self.assertEqual(points[10:20],arc.read(ts[10],ts[19]))
+            bbox = (41.43, -73.87, 41.435, -73.86)
+            self.assertEqual([ pt for pt in points if 41.43 <= pt.lat <= 41.435 and -73.87 <= pt.lon <= -73.86 ],list(arc.read(bbox=bbox)))
+            self.assertEqual(0,len(arc.read(bbox=(0,0,1,1))))
+
+    def test_truncated(self) -> None:
+        points = read_points()
+        with archive.ArchiveWriter(self.path, block_points=100) as writer:
+            writer.write(points)
+        with archive.Archive(self.path) as arc:
+            ends = [ b.end() for b in arc.blocks ]
+        with open(self.path, 'r+b') as file:
+            file.truncate(ends[2] + 10)
+        with archive.Archive(self.path) as arc:
+            self.assertEqual(points[:300],arc.read())
+        # append after the committed blocks
+        with archive.ArchiveWriter(self.path, append=True, committed=ends[1] + 5) as writer:
+            writer.write(points[200:])
+        with archive.Archive(self.path) as arc:
+            self.assertEqual(points,arc.read())
+        with open(self.path, 'wb') as file:
+            file.write(b'RBXARC\x00\x02' + bytes(8))
+        self.assertRaises(Exception, lambda: archive.Archive(self.path))
+
+    def test_export(self) -> None:
+        points = read_points()
+        archive.write(self.path, points)
+        with archive.Archive(self.path) as arc:
+            out = io.StringIO()
+            archive.to_gpx(arc, out)
+            self.assertEqual(gpx.Document.from_points(points).to_xml(),out.getvalue())
+            out = io.StringIO()
+            archive.to_geojson(arc, out)
+            feature = json.loads(out.getvalue())["features"][0]
+            self.assertEqual([ [pt.lon,pt.lat,pt.ele] for pt in points ],feature["geometry"]["coordinates"])
+            self.assertEqual([ gpx.format_time(pt.ts) for pt in points ],feature["properties"]["coordTimes"])
+            out = io.StringIO()
+            archive.to_csv(arc, out)
+            lines = out.getvalue().splitlines()
+            self.assertEqual(len(points)+1,len(lines))
+            self.assertEqual(f"{gpx.format_time(points[1].ts)},{points[1].lat},{points[1].lon},{points[1].ele},4",lines[2])
+
+    def test_sink(self) -> None:
+        messages = fixtures.read_messages()
+        memory = dump.MemorySink()
+        for sink in [memory, dump.ArchiveSink(self.path)]:
+            driver = mt3339.Driver(None,show_prog=False,sink=sink)
+            driver.cmd = "logger-dump"
+            for msg in messages:
+                driver.recv_message(msg)
+            sink.close()
+        with archive.Archive(self.path) as arc:
+            self.assertEqual(memory.points,arc.read())
+            self.assertEqual(list(memory.points.columns()[4]),list(arc.read().columns()[4]))
+
+if __name__ == '__main__':
+    unittest.main()
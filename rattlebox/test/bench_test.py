@@ -0,0 +1,60 @@
+import unittest
+import contextlib
+import io
+import os
+import tempfile
+import rattlebox.bench as bench
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+
+class BenchTest(unittest.TestCase):
+    def test_sources(self) -> None:
+        batches = list(bench.nmea_batches(25, batch=10))
+        self.assertEqual([10,10,5],[ len(b.splitlines()) for b in batches ])
+        self.assertTrue(all(status == nmea.OK for b in batches for status, _ in nmea.parse_many(b)[0]))
+        batches = list(bench.lox_batches(100, batch=40))
+        self.assertEqual(3,len(batches))
+        self.assertTrue(batches[0].startswith(b"$PMTKLOX,0,17*"))
+        self.assertTrue(batches[-1].endswith(b"$PMTKLOX,2*47\r\n"))
+        driver = mt3339.Driver(None, show_prog=False)
+        driver.cmd = "logger-dump"
+        with contextlib.redirect_stderr(io.StringIO()):
+            for b in batches:
+                driver.recv_messages(b.splitlines())
+        self.assertEqual(100,len(driver.log_points))
+        self.assertEqual([],driver.missing_chunks())
+        self.assertEqual(list(range(100)),[ (pt.ts - 1597180000) // 15 for pt in driver.log_points ])
+
+    def test_measure(self) -> None:
+        for b in bench.BENCHMARKS:
+            result = bench.measure(b, 50, repeat=1)
+            self.assertEqual(b.name,result.name)
+            self.assertEqual(50,result.records)
+            self.assertGreater(result.ops,0)
+            self.assertGreater(result.mbps,0)
+            self.assertGreater(result.peak_rss,0)
+
+    def test_compare(self) -> None:
+        baseline = [ bench.Result("a", 1000, 1000, 1, 1000, 1, 0, 100), bench.Result("b", 1000, 1000, 1, 1000, 1, 0, 100) ]
+        results = [ bench.Result("a", 1000, 1000, 1, 950, 1, 0, 105), bench.Result("a", 10, 10, 1, 1, 1, 0, 100),
+                    bench.Result("c", 1000, 1000, 1, 1, 1, 0, 100) ]
+        self.assertEqual([],bench.compare(results, baseline, 0.1))
+        results = [ bench.Result("a", 1000, 1000, 1, 850, 1, 0, 100), bench.Result("b", 1000, 1000, 1, 1000, 1, 0, 120) ]
+        self.assertEqual(["a (1000 records): 850 ops/s, was 1000 (-15%)",
+                          "b (1000 records): 120 bytes allocated per record, was 100"],bench.compare(results, baseline, 0.1))
+        self.assertEqual([],bench.compare(results, baseline, 0.25))
+        self.assertEqual([1000,100000,10000000],[ bench.parse_count(s) for s in ("1000","100k","10M") ])
+
+    def test_main(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "baseline.json")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(0,bench.main([ "--records=20", "--repeat=1", "--only=nmea.", f"--save={path}" ]))
+                self.assertEqual(0,bench.main([ "--records=20", "--repeat=1", "--only=nmea.", f"--baseline={path}", "--threshold=1" ]))
+                self.assertEqual(0,bench.main([ "--records=20", "--repeat=1", "--only=nmea.", f"--baseline={path}.missing" ]))
+            self.assertEqual(["nmea.checksum","nmea.parse_sentence","nmea.parse_many"],[ r.name for r in bench.load(path) ])
+            self.assertEqual(9,len([ line for line in out.getvalue().splitlines() if line.startswith("nmea.") ]))
+
+if __name__ == '__main__':
+    unittest.main()
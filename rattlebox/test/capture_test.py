@@ -0,0 +1,125 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import time
+import rattlebox.aio as aio
+import rattlebox.capture as capture
+import rattlebox.mt3339 as mt3339
+import rattlebox.reader as reader
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "test.cap")
+        self.data = fixtures.read_data()
+        # captured in 100 byte pieces, 10ms apart
+        with capture.Recorder(self.path, 115200) as rec:
+            for i in range(0,len(self.data),100):
+                rec.write(self.data[i:i+100], 10000)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_capture(self) -> None:
+        with capture.Capture(self.path) as cap:
+            self.assertEqual(115200,cap.baudrate)
+            self.assertEqual((len(self.data)+99)//100,len(cap))
+            self.assertEqual(len(self.data),cap.size())
+            self.assertEqual(self.data,b''.join([bytes(rec) for _,rec in cap]))
+            self.assertEqual([10000*(i+1) for i in range(len(cap))],[t for t,_ in cap])
+            self.assertAlmostEqual(0.01*len(cap),cap.duration())
+
+    def test_truncated(self) -> None:
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path)-10)
+        with capture.Capture(self.path) as cap:
+            self.assertEqual(self.data[:-10],b''.join([bytes(rec) for _,rec in cap]))
+        with open(self.path, 'wb') as file:
+            file.write(b'bogus')
+        self.assertRaises(Exception, lambda: capture.Capture(self.path))
+
+    def test_large_write(self) -> None:
+        data = bytes(range(256)) * 1000
+        with capture.Recorder(self.path) as rec:
+            rec.write(data)
+        with capture.Capture(self.path) as cap:
+            self.assertEqual(4,len(cap))
+            self.assertEqual(data,b''.join([bytes(rec) for _,rec in cap]))
+
+    def test_replay_port(self) -> None:
+        port = capture.ReplayPort(self.path)
+        driver = mt3339.Driver(port,show_prog=False)
+        driver.send_command("logger-dump")
+        self.assertEqual([b"$PMTK622,1*29\r\n"],port.written)
+        rdr = reader.Reader(port)
+        rdr.start()
+        try:
+            while driver.is_command_active():
+                driver.recv_messages(rdr.get_batch())
+        finally:
+            rdr.stop()
+        self.assertEqual(18,len(driver.log_points))
+        self.assertEqual(len(self.data),rdr.stats.bytes)
+        self.assertRaises(EOFError, lambda: rdr.get_batch(timeout=0.1))
+        port.close()
+
+    def test_pace(self) -> None:
+        port = capture.ReplayPort(self.path, speed=2)
+        start = time.monotonic()
+        data = b''
+        while True:
+            try:
+                data += port.read(1000)
+            except EOFError:
+                break
+        elapsed = time.monotonic() - start
+        self.assertEqual(self.data,data)
+        # the first record is released right away
+        expected = (len(port.capture)-1) * 0.01 / 2
+        self.assertGreaterEqual(elapsed,expected)
+        self.assertLess(elapsed,expected+0.5)
+        port.close()
+
+    def test_capture_port(self) -> None:
+        src = capture.ReplayPort(self.path)
+        path = os.path.join(self.tmp.name, "copy.cap")
+        with capture.Recorder(path) as rec:
+            port = capture.CapturePort(src, rec)
+            self.assertEqual(115200,port.baudrate)
+            while True:
+                try:
+                    port.read(64)
+                except EOFError:
+                    break
+        src.close()
+        with capture.Capture(path) as cap:
+            self.assertEqual(self.data,b''.join([bytes(rec) for _,rec in cap]))
+
+    def test_capture_port_baud(self) -> None:
+        # settings go through to the port, so switching baud switches the port
+        sim = simulator.Simulator(rate=0)
+        src = simulator.SimPort(sim, baudrate=9600, timeout=1)
+        with capture.Recorder(os.path.join(self.tmp.name, "sim.cap"), 9600) as rec:
+            port = capture.CapturePort(src, rec)
+            driver = mt3339.Driver(port,show_prog=False)
+            self.assertTrue(driver.set_baud(57600, 0.2))
+            self.assertEqual((57600,57600,57600),(sim.baudrate,src.baudrate,port.baudrate))
+            self.assertEqual(115200,driver.negotiate_baud(0.2))
+            self.assertEqual((115200,115200),(sim.baudrate,src.baudrate))
+            port.timeout = 0.5
+            self.assertEqual(0.5,src.timeout)
+            self.assertEqual({"port","recorder"},set(port.__dict__))
+
+    def test_replay_transport(self) -> None:
+        async def run() -> int:
+            async with aio.AsyncDriver(capture.ReplayTransport(self.path)) as drv:
+                fut = await drv.send_command("logger-dump")
+                await asyncio.wait_for(fut,5)
+                return len(drv.driver.log_points)
+        self.assertEqual(18,asyncio.run(run()))
+
+if __name__ == '__main__':
+    unittest.main()
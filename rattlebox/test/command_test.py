@@ -0,0 +1,160 @@
+import unittest
+import rattlebox.command as command
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.reader as reader
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
+
+def request(body:str, pipelined:bool = True) -> command.Request:
+    return command.Request(body, body, pipelined=pipelined)
+
+class PipelineTest(unittest.TestCase):
+    def test_pipelining(self) -> None:
+        pipeline = command.Pipeline(window=3, clock=fixtures.Clock())
+        reqs = [ pipeline.submit(request(body)) for body in ("PMTK314,1", "PMTK220,200", "PMTK314,0", "PMTK300,200") ]
+        status = pipeline.submit(request("PMTK183", pipelined=False))
+        ping = pipeline.submit(request("PMTK000"))
+        # one per type: the second 314 waits for the first one
+        self.assertEqual([b"$PMTK314,1*29\r\n", command.message("PMTK220,200")],pipeline.due())
+        self.assertEqual([],pipeline.due())
+        self.assertEqual(reqs[0],pipeline.active())
+        # acknowledgements are matched by type, in any order
+        self.assertEqual(reqs[1],pipeline.ack(220,3))
+        self.assertEqual(reqs[0],pipeline.ack(314,3))
+        self.assertEqual([command.message("PMTK314,0"),command.message("PMTK300,200")],pipeline.due())
+        # the status request waits for all of them, and holds up the ping
+        pipeline.ack(314,3)
+        self.assertEqual([],pipeline.due())
+        pipeline.ack(300,3)
+        self.assertEqual([command.message("PMTK183")],pipeline.due())
+        self.assertEqual([],pipeline.due())
+        self.assertIsNone(pipeline.ack(999,3))
+        self.assertEqual(1,pipeline.stray)
+        pipeline.ack(183,3)
+        self.assertEqual([command.message("PMTK000")],pipeline.due())
+        pipeline.ack(0,3)
+        self.assertTrue(pipeline.idle())
+        self.assertEqual(["succeeded"]*6,[ r.status() for r in reqs + [status, ping] ])
+
+    def test_failure(self) -> None:
+        pipeline = command.Pipeline(clock=fixtures.Clock())
+        done:list[command.Request] = []
+        pipeline.on_done = done.append
+        a, b = pipeline.submit(request("PMTK220,200")), pipeline.submit(request("PMTK300,200"))
+        c = pipeline.submit(request("PMTK185,1", pipelined=False))
+        self.assertEqual(2,len(pipeline.due()))
+        pipeline.ack(220,1)
+        # the ones that were not sent yet are cancelled
+        self.assertEqual([(a,"unsupported"),(c,"cancelled")],[ (r,r.status()) for r in done ])
+        pipeline.ack(300,2)
+        self.assertEqual("failed",b.status())
+        self.assertTrue(pipeline.idle())
+        # (an unknown flag)
+        ping = request("PMTK000")
+        pipeline.start(ping)
+        self.assertEqual(ping,pipeline.ack(0,7))
+        self.assertEqual("invalid",ping.status())
+
+    def test_retries(self) -> None:
+        clock = fixtures.Clock()
+        pipeline = command.Pipeline(timeout=1, retries=2, clock=clock)
+        req = pipeline.submit(request("PMTK622,1", pipelined=False))
+        self.assertEqual(1,len(pipeline.due()))
+        self.assertEqual(0.5,pipeline.wait(0.5))
+        clock.t = 0.75
+        self.assertAlmostEqual(0.25,pipeline.wait(0.5))
+        # responses move the deadline
+        pipeline.extend()
+        clock.t = 1.5
+        self.assertEqual([],pipeline.due())
+        clock.t = 1.75
+        self.assertEqual([command.message("PMTK622,1")],pipeline.due())
+        clock.t = 2.75
+        self.assertEqual(1,len(pipeline.due()))
+        self.assertEqual(3,req.tries)
+        clock.t = 3.75
+        self.assertEqual([],pipeline.due())
+        self.assertEqual(("timed out",3),(req.status(),req.tries))
+        self.assertTrue(pipeline.idle())
+        # a late acknowledgement is stray
+        self.assertIsNone(pipeline.ack(622,3))
+
+    def test_skip(self) -> None:
+        pipeline = command.Pipeline(clock=fixtures.Clock())
+        status = pipeline.submit(request("PMTK183", pipelined=False))
+        dump = pipeline.submit(request("PMTK622,1", pipelined=False))
+        start = pipeline.submit(request("PMTK185,0"))
+        self.assertEqual(1,len(pipeline.due()))
+        self.assertEqual(dump,pipeline.next())
+        # a skipped command is ok, and does not hold up the rest
+        pipeline.skip(dump)
+        self.assertEqual(("skipped",True),(dump.status(),dump.ok()))
+        pipeline.ack(183,3)
+        self.assertEqual([command.message("PMTK185,0")],pipeline.due())
+        pipeline.ack(185,3)
+        self.assertEqual(["succeeded","succeeded"],[ r.status() for r in (status, start) ])
+        self.assertIsNone(pipeline.next())
+
+    def test_optional(self) -> None:
+        clock = fixtures.Clock()
+        pipeline = command.Pipeline(timeout=1, retries=0, clock=clock)
+        status = pipeline.submit(request("PMTK183", pipelined=False))
+        status.optional = True
+        dump = pipeline.submit(request("PMTK622,1", pipelined=False))
+        self.assertEqual([command.message("PMTK183")],pipeline.due())
+        # an optional command that times out does not hold up the rest
+        clock.t = 1
+        self.assertEqual([command.message("PMTK622,1")],pipeline.due())
+        self.assertEqual(("timed out","pending"),(status.status(),dump.status()))
+
+    def test_plan_failed(self) -> None:
+        # the device does not support logger-status; the dump goes ahead
+        class Port:
+            def __init__(self) -> None:
+                self.written:list[bytes] = []
+            def write(self, data:bytes) -> None:
+                self.written.append(data)
+        port = Port()
+        driver = mt3339.Driver(port, show_prog=False)
+        dump = driver.submit_command("logger-dump")
+        driver.service()
+        self.assertEqual([command.message("PMTK183")],port.written)
+        self.assertTrue(driver.recv_message(command.message("PMTK001,183,1")))
+        driver.service()
+        self.assertEqual(command.message("PMTK622,1"),port.written[-1])
+        self.assertEqual(("pending","logger-dump"),(dump.status(),driver.cmd))
+        self.assertIsNone(driver.log_status)
+
+    def test_driver(self) -> None:
+        driver = mt3339.Driver(None, show_prog=False)
+        self.assertEqual((True,True),(driver.request("output-all").pipelined,driver.request("PMTK220,200").pipelined))
+        self.assertEqual((False,False),(driver.request("logger-dump").pipelined,driver.request("PMTK622,1").pipelined))
+        self.assertFalse(driver.request("baud-9600").acked)
+        with self.assertRaises(Exception):
+            driver.request("PMTK220,200*2C\r\n$PMTK184,1")
+
+    def test_simulator(self) -> None:
+        # with lines dropped, commands are sent again until they are acknowledged
+        sim = simulator.Simulator(simulator.make_log(10), rate=0, faults=simulator.Faults(drop=0.3), seed=3)
+        port = simulator.SimPort(sim, timeout=1)
+        driver = mt3339.Driver(port, show_prog=False)
+        driver.commands.timeout = 0.05
+        driver.commands.retries = 10
+        reqs = [ driver.submit_command(cmd) for cmd in ("output-all", "logger-stop", "ping", "logger-status", "logger-start", "PMTK000") ]
+        with reader.Reader(port) as rdr:
+            driver.run_commands(lambda timeout: rdr.get_batch(timeout=timeout))
+        self.assertEqual(["succeeded"]*6,[ r.status() for r in reqs ])
+        self.assertGreater(sum(r.tries for r in reqs),6)
+        self.assertTrue(sim.logging)
+        self.assertFalse(driver.is_command_active())
+        # an unsupported command fails, and cancels the rest
+        reqs = [ driver.submit_command(cmd) for cmd in ("PMTK999", "logger-erase") ]
+        sim.faults.drop = 0
+        with reader.Reader(port) as rdr:
+            driver.run_commands(lambda timeout: rdr.get_batch(timeout=timeout))
+        self.assertEqual(["unsupported","cancelled"],[ r.status() for r in reqs ])
+        self.assertEqual(10,len(locus.decode(bytes(sim.log))))
+
+if __name__ == '__main__':
+    unittest.main()
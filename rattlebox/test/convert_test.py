@@ -0,0 +1,105 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import tempfile
+import rattlebox.archive as archive
+import rattlebox.capture as capture
+import rattlebox.convert as convert
+import rattlebox.gpxread as gpxread
+import rattlebox.segment as segment
+import rattlebox.simulator as simulator
+
+def dump_data(log:bytes) -> bytes:
+    sim = simulator.Simulator(log, rate=0)
+    sim.write(simulator.sentence("PMTK622,1"))
+    return sim.read(1 << 24)
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.inputs = os.path.join(self.tmp.name, "in")
+        self.out = os.path.join(self.tmp.name, "out")
+        os.makedirs(os.path.join(self.inputs, "sub"))
+        shutil.copy('test-data/test-messages.txt', os.path.join(self.inputs, "a.txt"))
+        # two outings, a day apart
+        log = simulator.make_log(500, start_ts=1597180000) + simulator.make_log(300, start_ts=1597180000+86400)
+        self.data = dump_data(log)
+        with open(os.path.join(self.inputs, "sub", "b.lox"), 'wb') as file:
+            file.write(self.data)
+        with capture.Recorder(os.path.join(self.inputs, "c.cap")) as rec:
+            for i in range(0, len(self.data), 1000):
+                rec.write(self.data[i:i+1000], 1000)
+        with open(os.path.join(self.inputs, "ignored.gpx"), 'w') as file:
+            file.write("<gpx/>")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def convert(self, settings:convert.Settings, jobs:int = 2) -> list[convert.Result]:
+        out = io.StringIO()
+        results = convert.convert_all(convert.inputs([ self.inputs ]), settings, jobs, out)
+        self.report = out.getvalue()
+        return results
+
+    def test_convert(self) -> None:
+        paths = convert.inputs([ self.inputs, os.path.join(self.inputs, "a.txt") ])
+        self.assertEqual([ "a.txt", "c.cap", "b.lox" ],[ os.path.basename(p) for p in paths ])
+        settings = convert.Settings(self.out)
+        results = self.convert(settings)
+        self.assertEqual(paths,[ r.input for r in results ])
+        self.assertEqual([18,800,800],[ r.points for r in results ])
+        self.assertEqual([None]*3,[ r.error for r in results ])
+        self.assertIn("converted 3 files",self.report)
+        # the capture and the text dump are the same log
+        with open(os.path.join(self.out, "b.gpx")) as b, open(os.path.join(self.out, "c.gpx")) as c:
+            self.assertEqual(b.read(),c.read())
+        self.assertEqual(800,len(gpxread.read(os.path.join(self.out, "b.gpx")).tracks[0].segs[0].points))
+        # nothing has changed
+        results = self.convert(settings)
+        self.assertEqual([True]*3,[ r.skipped for r in results ])
+        self.assertIn("3 unchanged",self.report)
+        # a changed input, and changed settings
+        with open(os.path.join(self.inputs, "sub", "b.lox"), 'wb') as file:
+            file.write(self.data[:len(self.data)//2])
+        results = self.convert(settings, jobs=1)
+        self.assertEqual([True,True,False],[ r.skipped for r in results ])
+        self.assertLess(results[2].points,800)
+        self.assertGreater(len(results[2].missing),0)
+        results = self.convert(convert.Settings(self.out, rules=segment.Rules()))
+        self.assertEqual([False]*3,[ r.skipped for r in results ])
+        self.assertEqual(2,len(gpxread.read(os.path.join(self.out, "c.gpx")).tracks))
+
+    def test_formats(self) -> None:
+        self.convert(convert.Settings(self.out, "rbx"))
+        with archive.Archive(os.path.join(self.out, "c.rbx")) as arc:
+            self.assertEqual(800,len(arc))
+        self.convert(convert.Settings(self.out, "geojson"))
+        with open(os.path.join(self.out, "c.geojson")) as file:
+            self.assertEqual(800,len(json.load(file)["features"][0]["geometry"]["coordinates"]))
+        self.convert(convert.Settings(self.out, "csv"))
+        with open(os.path.join(self.out, "c.csv")) as file:
+            self.assertEqual(801,len(file.readlines()))
+        self.assertEqual([],[ name for name in os.listdir(self.out) if name.endswith(".tmp") ])
+
+    def test_split(self) -> None:
+        results = self.convert(convert.Settings(self.out, "csv", segment.Rules(), split=True))
+        self.assertEqual(["c-20200811-210640.csv","c-20200812-210640.csv"],[ os.path.basename(p) for p in results[1].outputs ])
+        with open(results[1].outputs[1]) as file:
+            self.assertEqual(301,len(file.readlines()))
+
+    def test_errors(self) -> None:
+        with open(os.path.join(self.inputs, "bogus.txt"), 'w') as file:
+            file.write("$GPGGA,bogus\nhello\n")
+        results = self.convert(convert.Settings(self.out))
+        self.assertEqual("no logger dump found",results[1].error)
+        self.assertEqual(2,convert.main([ self.inputs, "--out", self.out ]))
+        os.remove(os.path.join(self.inputs, "bogus.txt"))
+        self.assertEqual(0,convert.main([ self.inputs, "--out", self.out, "--jobs", "1" ]))
+        # inputs with the same name
+        shutil.copy(os.path.join(self.inputs, "a.txt"), os.path.join(self.inputs, "sub", "a.txt"))
+        self.assertRaises(Exception, lambda: self.convert(convert.Settings(self.out)))
+
+if __name__ == '__main__':
+    unittest.main()
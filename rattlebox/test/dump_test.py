@@ -0,0 +1,204 @@
+import unittest
+import os
+from typing import (Optional)
+import tempfile
+import zlib
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.reader as reader
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
+
+def feed(messages:list[bytes], sink:Optional[dump.Sink] = None, manifest:Optional[dump.Manifest] = None,
+         commit:bool = False) -> mt3339.Driver:
+    """
+    Feed the messages of a logger dump to a driver, with the given sink and
+    manifest; if commit is set, the log data is then taken to be saved
+    (see mt3339.Driver.commit)
+    """
+    driver = mt3339.Driver(None,show_prog=False,sink=sink,manifest=manifest)
+    driver.cmd = "logger-dump"
+    for msg in messages:
+        driver.recv_message(msg)
+    if commit:
+        driver.commit()
+    return driver
+
+def expected_gpx(messages:list[bytes], pretty:bool = True) -> str:
+    return gpx.Document.from_points(feed(messages).log_points).to_xml(pretty)
+
+class DumpTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "log.gpx")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def read(self) -> str:
+        with open(self.path, 'r') as file:
+            return file.read()
+
+    def test_memory_sink(self) -> None:
+        sink = dump.MemorySink()
+        driver = feed(fixtures.read_messages(),sink)
+        self.assertEqual(18,len(sink.points))
+        self.assertEqual(18,driver.log_count)
+        self.assertEqual(0,len(driver.log_points))
+        self.assertIsNone(driver.get_log_as_gpx())
+
+    def test_gpx_sink(self) -> None:
+        messages = fixtures.read_messages()
+        for pretty in [False,True]:
+            sink = dump.GPXSink(self.path,pretty=pretty,sync_every=1)
+            feed(messages,sink)
+            sink.close()
+            self.assertEqual(expected_gpx(messages,pretty),self.read())
+
+    def test_complete(self) -> None:
+        messages = fixtures.read_messages()
+        # link drops after the 2nd chunk
+        sink = dump.GPXSink(self.path)
+        feed(messages[:3],sink)
+        self.assertFalse(self.read().endswith("</gpx>\n"))
+        self.assertTrue(self.read().endswith("</trkpt>\n"))
+        dump.complete(self.path)
+        self.assertEqual(expected_gpx(messages[:3]),self.read())
+        # partial file without any points
+        sink = dump.GPXSink(self.path,pretty=False)
+        feed(messages[:1],sink)
+        dump.complete(self.path)
+        self.assertEqual(gpx.Document.from_points([]).to_xml(False),self.read())
+
+    def test_resume(self) -> None:
+        messages = fixtures.read_messages()
+        for pretty in [True,False]:
+            sink = dump.GPXSink(self.path,pretty=pretty)
+            feed(messages[:2],sink)
+            # simulate a crash in the middle of writing the next chunk
+            with open(self.path,'ab') as out:
+                out.write(b'<trkpt lat="41')
+            sink = dump.GPXSink(self.path,resume=True)
+            feed(messages[2:],sink)
+            sink.close()
+            self.assertEqual(expected_gpx(messages,pretty),self.read())
+
+    def test_close_incomplete(self) -> None:
+        messages = fixtures.read_messages()
+        sink = dump.GPXSink(self.path)
+        feed(messages[:2],sink)
+        sink.close()
+        self.assertEqual(expected_gpx(messages[:2]),self.read())
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "log.manifest")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_save_load(self) -> None:
+        manifest = dump.Manifest(self.path)
+        feed(fixtures.read_messages(),manifest=manifest,commit=True)
+        self.assertEqual(3,manifest.total)
+        self.assertEqual([1,2,3],sorted(manifest.chunks))
+        loaded = dump.Manifest.load(self.path)
+        self.assertEqual(manifest,loaded)
+        self.assertEqual(dump.Manifest(self.path+"x"),dump.Manifest.load(self.path+"x"))
+
+    def test_delta(self) -> None:
+        messages = fixtures.read_messages()
+        manifest = dump.Manifest(self.path)
+        # first dump is interrupted after the first chunk
+        driver = feed(messages[:2],manifest=manifest,commit=True)
+        self.assertEqual(6,driver.log_count)
+        # next dump only ingests the chunks that we don't have yet
+        manifest = dump.Manifest.load(self.path)
+        driver = feed(messages,manifest=manifest,commit=True)
+        self.assertEqual(1,driver.log_skipped)
+        self.assertEqual(12,driver.log_count)
+        self.assertEqual(12,len(driver.log_points))
+        self.assertEqual(feed(messages).log_points[6:],driver.log_points)
+        # and nothing, the next time
+        driver = feed(messages,manifest=dump.Manifest.load(self.path),commit=True)
+        self.assertEqual(3,driver.log_skipped)
+        self.assertEqual(0,driver.log_count)
+
+    def test_duplicate_and_missing(self) -> None:
+        messages = fixtures.read_messages()
+        manifest = dump.Manifest(self.path)
+        driver = feed(messages[:2]+messages[1:2]+messages[3:],manifest=manifest,commit=True)
+        self.assertEqual(1,driver.log_dups)
+        self.assertEqual([0,2],driver.missing_chunks())
+        self.assertEqual(12,driver.log_count)
+        # the gap is recovered by the next dump
+        driver = feed(messages,manifest=dump.Manifest.load(self.path),commit=True)
+        self.assertEqual(2,driver.log_skipped)
+        self.assertEqual(feed(messages).log_points[6:12],driver.log_points)
+
+    def test_check(self) -> None:
+        manifest = dump.Manifest()
+        data = bytes(range(32))
+        manifest.add(0,data)
+        manifest.add(1,data[:16])
+        self.assertEqual(32,manifest.check(0,data))
+        # chunk that has grown: only the tail is new
+        self.assertEqual(16,manifest.check(1,data))
+        # changed chunk
+        self.assertEqual(0,manifest.check(1,bytes(32)))
+        self.assertEqual(2,len(manifest.chunks))
+        # first chunk has changed: the log was erased
+        self.assertEqual(0,manifest.check(0,bytes(32)))
+        self.assertEqual(0,len(manifest.chunks))
+        # padded with unwritten records (0xFF); only the written ones count
+        pad = b'\xff' * 16
+        manifest.add(0,data[:16] + pad*2)
+        self.assertEqual([zlib.crc32(data[:16])],manifest.chunks[0])
+        self.assertEqual(48,manifest.check(0,data[:16] + pad*2))
+        self.assertEqual(16,manifest.check(0,data + pad))
+        self.assertEqual(1,len(manifest.chunks))
+        # an ingested record has been overwritten
+        self.assertEqual(0,manifest.check(0,pad + data))
+        self.assertEqual(0,len(manifest.chunks))
+
+    def test_delta_padded(self) -> None:
+        # the last chunk is padded, and fills up between dumps
+        sim = simulator.Simulator(simulator.make_log(5), rate=0, pad=True)
+        port = simulator.SimPort(sim, timeout=1)
+        def sim_dump() -> mt3339.Driver:
+            driver = mt3339.Driver(port,show_prog=False,manifest=dump.Manifest.load(self.path))
+            driver.submit_command("logger-dump")
+            with reader.Reader(port) as rdr:
+                driver.run_commands(lambda timeout: rdr.get_batch(timeout=timeout))
+            driver.commit()
+            return driver
+        self.assertEqual(5,sim_dump().log_count)
+        sim.log = bytearray(simulator.make_log(20))
+        driver = sim_dump()
+        self.assertEqual(15,driver.log_count)
+        self.assertEqual(list(driver.log_points),locus.decode(simulator.make_log(15, first=5)).to_points())
+        # nothing new
+        driver = sim_dump()
+        self.assertEqual((0,4),(driver.log_count,driver.log_skipped))
+
+    def test_resume_stream(self) -> None:
+        messages = fixtures.read_messages()
+        log = os.path.join(self.tmp.name, "log.gpx")
+        manifest = dump.Manifest(self.path)
+        sink = dump.GPXSink(log,sync_every=1)
+        driver = feed(messages[:3],sink,manifest,commit=True)
+        # chunk #2 makes it to the file, but not to the manifest
+        driver.recv_message(messages[3])
+        sink.close()
+        manifest = dump.Manifest.load(self.path)
+        sink = dump.GPXSink(log,resume=True,committed=manifest.committed)
+        feed(messages,sink,manifest)
+        sink.close()
+        with open(log, 'r') as file:
+            self.assertEqual(expected_gpx(messages),file.read())
+
+if __name__ == '__main__':
+    unittest.main()
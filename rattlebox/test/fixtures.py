@@ -0,0 +1,28 @@
+"""
+Fixtures shared by the tests
+"""
+
+MESSAGES = 'test-data/test-messages.txt' # a short logger dump, and some NMEA output
+
+class Clock:
+    """
+    A clock for tests: the time is whatever t is set to
+    """
+    def __init__(self) -> None:
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+def read_messages() -> list[bytes]:
+    """
+    The messages in MESSAGES, each ending with CR LF
+    """
+    with open(MESSAGES, 'rb') as file:
+        return [ line.rstrip() + b"\r\n" for line in file ]
+
+def read_data() -> bytes:
+    """
+    The messages in MESSAGES, as they come from the device
+    """
+    return b"".join(read_messages())
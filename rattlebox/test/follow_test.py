@@ -0,0 +1,137 @@
+import unittest
+import io
+import json
+import math
+import os
+import random
+import socket
+import tempfile
+import rattlebox.follow as follow
+import rattlebox.metrics as metrics
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
+
+class ListSink(follow.Sink):
+    def __init__(self) -> None:
+        self.lines:list[str] = []
+
+    def publish(self, line:str) -> None:
+        self.lines.append(line)
+
+def make_fix(ts:float, lat:float = 41.45, lon:float = -73.93, quality:int = 1, hdop:float = 1.0) -> nmea.Fix:
+    return nmea.Fix(tod=ts % 86400, ts=int(ts), lat=lat, lon=lon, ele=100, quality=quality, sats=8, hdop=hdop, speed=1.5, course=90)
+
+class FollowTest(unittest.TestCase):
+    def test_simulator(self) -> None:
+        # epochs are published as they are complete
+        sim = simulator.Simulator(rate=5)
+        sink = ListSink()
+        meter = metrics.Metrics()
+        follower = follow.Follower([ sink ], follow.Settings(format="json"), meter, wallclock=lambda: 1597180010.0)
+        driver = mt3339.Driver(None, show_prog=False)
+        driver.on_fix = follower.add
+        driver.nmea.early = True
+        for epoch in range(25):
+            sim.emit_epoch(epoch)
+            driver.recv_messages(bytes(sim.out).splitlines())
+            sim.out.clear()
+        # (RMC, VTG, GGA, GSA and, every 5th epoch, GSV: only GSV always
+        # ends an epoch, so the others are complete when the next one starts)
+        self.assertEqual(24,follower.count)
+        self.assertEqual(24,meter.counters["follow.published"])
+        fixes = [ json.loads(line) for line in sink.lines ]
+        self.assertEqual([ 1597180000 + i * 0.2 for i in range(24) ],[ round(f["ts"], 1) for f in fixes ])
+        self.assertEqual((1,8,0.95),(fixes[0]["quality"],fixes[0]["sats"],fixes[0]["hdop"]))
+        self.assertAlmostEqual(1.5,fixes[-1]["speed"],2)
+        self.assertAlmostEqual(10 - 4.6,fixes[-1]["age"],3)
+
+    def test_filter(self) -> None:
+        sink = ListSink()
+        follower = follow.Follower([ sink ], follow.Settings(min_quality=1, max_hdop=2))
+        follower.add(make_fix(0, quality=0))
+        follower.add(make_fix(1, hdop=3))
+        follower.add(make_fix(2, hdop=math.nan))
+        follower.add(make_fix(3, lat=math.nan))
+        self.assertEqual((4,4,0),(follower.epochs,follower.rejected,follower.count))
+        self.assertEqual("quality",follower.check(make_fix(0, quality=0)))
+        self.assertEqual("hdop",follower.check(make_fix(0, hdop=3)))
+        self.assertEqual("position",follower.check(make_fix(0, lat=math.nan)))
+        follower.add(make_fix(4, hdop=1.5))
+        self.assertEqual(1,follower.count)
+        self.assertEqual("1970-01-01T00:00:04.000Z lat=41.450000 lon=-73.930000 ele=100.0 speed=1.50 course=90.0 quality=1 sats=8 hdop=1.50",
+                         sink.lines[0].split(" latency_ms=")[0])
+
+    def test_rate(self) -> None:
+        clock = fixtures.Clock()
+        sink = ListSink()
+        follower = follow.Follower([ sink ], follow.Settings(rate=1, min_move=5), clock=clock)
+        for i in range(12):
+            clock.t = i * 0.25
+            follower.add(make_fix(i * 0.25, lon=-73.93 + i * 0.0001))
+            follower.poll()
+        # published at 0, 1 and 2 (the latest fix each time), the last one pending
+        self.assertEqual(3,follower.count)
+        self.assertEqual(8,follower.coalesced)
+        self.assertEqual(["00:00:00.000Z","00:00:01.000Z","00:00:02.000Z"],[ line.split()[0][11:] for line in sink.lines ])
+        self.assertAlmostEqual(0.25,follower.wait(0.5))
+        clock.t = 3.0
+        self.assertEqual(0,follower.wait(0.5))
+        follower.poll()
+        self.assertEqual(4,follower.count)
+        self.assertIn("latency_ms=250.00",sink.lines[-1])
+        self.assertEqual(0.5,follower.wait(0.5))
+        # unmoved
+        clock.t = 10
+        follower.add(make_fix(10, lon=-73.93 + 11 * 0.0001 + 0.00001))
+        self.assertEqual((4,1),(follower.count,follower.unmoved))
+
+    def test_smoothing(self) -> None:
+        rnd = random.Random(1)
+        errors:dict[str,float] = {}
+        for method in follow.SMOOTHERS:
+            sink = ListSink()
+            follower = follow.Follower([ sink ], follow.Settings(smooth=method, format="json"))
+            truth = []
+            for i in range(120):
+                # 1.5 m/s east, with 4 m of noise
+                lon = -73.93 + i * 1.5 / 83500
+                truth.append(lon)
+                follower.add(make_fix(1597180000 + i, lat=41.45 + rnd.gauss(0, 4) / 111195, lon=lon + rnd.gauss(0, 4) / 83500))
+            fixes = [ json.loads(line) for line in sink.lines ]
+            errors[method] = math.sqrt(sum(((f["lat"] - 41.45) * 111195)**2 + ((f["lon"] - lon) * 83500)**2
+                                           for f, lon in zip(fixes[20:], truth[20:])) / 100)
+            if method == "kalman":
+                # (the estimated speed is noisy, and biased up by the noise)
+                self.assertAlmostEqual(1.5,sum(f["speed"] for f in fixes[20:]) / 100,delta=0.5)
+                self.assertAlmostEqual(90,sum(f["course"] for f in fixes[20:]) / 100,delta=15)
+        self.assertGreater(errors["none"],4)
+        self.assertLess(errors["alpha-beta"],errors["none"])
+        self.assertLess(errors["kalman"],errors["none"])
+
+    def test_sinks(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fixes.txt")
+            sock = os.path.join(tmp, "fixes.sock")
+            sinks = follow.make_sinks(follow.Settings(file=path, socket=sock), io.StringIO())
+            self.assertEqual([follow.SocketSink,follow.FileSink],[ type(s) for s in sinks ])
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(sock)
+            follower = follow.Follower(sinks)
+            follower.add(make_fix(0))
+            follower.add(make_fix(1))
+            self.assertEqual(2,len(client.recv(4096).decode().splitlines()))
+            client.close()
+            follower.add(make_fix(2))
+            follower.add(make_fix(3))
+            socket_sink = sinks[0]
+            assert(isinstance(socket_sink, follow.SocketSink))
+            self.assertEqual((0,1),(len(socket_sink.clients),socket_sink.dropped))
+            follower.close()
+            self.assertFalse(os.path.exists(sock))
+            with open(path) as file:
+                self.assertEqual(4,len(file.readlines()))
+
+if __name__ == '__main__':
+    unittest.main()
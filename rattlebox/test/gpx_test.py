@@ -4,6 +4,8 @@ import logging
 import sys
 import io
 import rattlebox.gpx as gpx
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesNSImpl
 
 class GPXTest(unittest.TestCase):
     def test_from_points(self) -> None:
@@ -15,5 +17,122 @@ class GPXTest(unittest.TestCase):
         gpx_str = doc.to_xml()
         print(gpx_str)
 
+    def test_to_xml(self) -> None:
+        doc = gpx.Document()
+        track = gpx.Track()
+        track.add_seg(gpx.Segment())
+        track.add_points([gpx.Point(1597178010,41.5,-73.25,100)])
+        doc.add_track(track)
+        doc.add_track(gpx.Track())
+        pretty = (
+            '<?xml version="1.0" ?>\n'
+            '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="rattlebox">\n'
+            '  <trk>\n'
+            '    <trkseg/>\n'
+            '    <trkseg>\n'
+            '      <trkpt lat="41.5" lon="-73.25">\n'
+            '        <time>2020-08-11T20:33:30+00:00</time>\n'
+            '        <ele>100</ele>\n'
+            '      </trkpt>\n'
+            '    </trkseg>\n'
+            '  </trk>\n'
+            '  <trk/>\n'
+            '</gpx>\n')
+        self.assertEqual(pretty,doc.to_xml())
+        compact = (
+            '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="rattlebox">'
+            '<trk><trkseg/><trkseg><trkpt lat="41.5" lon="-73.25">'
+            '<time>2020-08-11T20:33:30+00:00</time><ele>100</ele></trkpt></trkseg></trk><trk/></gpx>')
+        self.assertEqual(compact,doc.to_xml(pretty=False))
+        # compare with the SAX-based serialization
+        out = io.StringIO()
+        xml = XMLGenerator(out, 'utf-8', True)
+        xml.startElementNS(("", u'gpx'), u'gpx', AttributesNSImpl({
+            ("", u'xmlns'): gpx.GPX_NS, ("",u'version'): u'1.1', ("",u'creator'): u'rattlebox' }, {
+            ("", u'xmlns'): u'xmlns', ("",u'version'): u'version', ("",u'creator'): u'creator' }))
+        for trk in doc.tracks:
+            trk.to_xml(xml)
+        xml.endElementNS(("", u'gpx'), u'gpx')
+        self.assertEqual(compact,out.getvalue())
+
+    def test_writer(self) -> None:
+        points = gpx.Points(gpx.Point(1597178010+i,41.5,-73.25,i) for i in range(1000))
+        doc = gpx.Document.from_points(points)
+        for pretty in [True,False]:
+            out = io.BytesIO()
+            writer = gpx.Writer(out,pretty,chunk_size=256)
+            writer.start_document()
+            writer.start_track()
+            writer.start_segment()
+            # write in chunks, as they would arrive from the device
+            for i in range(0,len(points),100):
+                writer.write_points(points[i:i+100])
+                self.assertLess(len(writer.buf),256)
+            writer.end_segment()
+            writer.end_track()
+            writer.end_document()
+            self.assertEqual(doc.to_xml(pretty),out.getvalue().decode('utf-8'))
+        writer = gpx.Writer(io.StringIO())
+        writer.start_document()
+        self.assertRaises(Exception, lambda: writer.end_track())
+
+    def test_points(self) -> None:
+        pts = gpx.Points()
+        for i in range(10):
+            pts.append(gpx.Point(1000+i,41.0+i,-73.0-i,i),fix=2)
+        self.assertEqual(10,len(pts))
+        self.assertEqual(gpx.Point(1003,44.0,-76.0,3),pts[3])
+        self.assertEqual(gpx.Point(1009,50.0,-82.0,9),pts[-1])
+        self.assertEqual(2,pts.fix(-1))
+        self.assertRaises(IndexError, lambda: pts[10])
+        self.assertEqual(25*10,pts.nbytes())
+        self.assertEqual([pt.ts for pt in pts],list(range(1000,1010)))
+
+    def test_points_view(self) -> None:
+        pts = gpx.Points(gpx.Point(i,0,0,0) for i in range(10))
+        view = pts[2:5]
+        self.assertEqual(3,len(view))
+        self.assertEqual(2,view[0].ts)
+        self.assertEqual([3,4],[pt.ts for pt in view[1:]])
+        self.assertEqual([0,2,4,6,8],[pt.ts for pt in pts[::2]])
+        # appending to a view must not clobber the original
+        view.append(gpx.Point(99,0,0,0))
+        self.assertEqual(5,pts[5].ts)
+        self.assertEqual([2,3,4,99],[pt.ts for pt in view])
+        # appending to the end of the original does not affect the view
+        pts.append(gpx.Point(10,0,0,0))
+        self.assertEqual(11,len(pts))
+        self.assertEqual(4,len(view))
+
+    def test_points_columns(self) -> None:
+        pts = gpx.Points()
+        pts.extend_columns([1,2],[41.5,42.5],[-73.5,-74.5],[10,20],[2,4])
+        self.assertEqual([gpx.Point(1,41.5,-73.5,10),gpx.Point(2,42.5,-74.5,20)],list(pts))
+        self.assertEqual(4,pts.fix(1))
+        self.assertRaises(Exception, lambda: pts.extend_columns([1],[1.0],[1.0],[]))
+        self.assertRaises(Exception, lambda: pts.extend_columns([3],[1.0],[1.0],[1],[]))
+        self.assertRaises(Exception, lambda: pts.extend_columns((t for t in [3]),[1.0],[1.0],[1],[300]))
+        # (nothing was added)
+        self.assertEqual(2,len(pts))
+        self.assertEqual([2,2,2,2,2],[ len(c) for c in pts.columns() ])
+        pts.extend_columns((t for t in [3]),[43.5],[-75.5],[30])
+        self.assertEqual((3,0),(pts[2].ts,pts.fix(2)))
+
+    def test_points_take(self) -> None:
+        pts = gpx.Points()
+        pts.extend_columns(range(10),[41.0+i for i in range(10)],[-73.0]*10,range(10),[2]*10)
+        taken = pts[1:].take([0,4,8])
+        self.assertEqual([1,5,9],[pt.ts for pt in taken])
+        self.assertEqual(2,taken.fix(2))
+        self.assertEqual(0,len(pts.take([])))
+
+    def test_segment_shares_points(self) -> None:
+        pts = gpx.Points([gpx.Point(1,2,3,4)])
+        doc = gpx.Document.from_points(pts)
+        self.assertIs(pts,doc.tracks[0].segs[0].points)
+        seg = gpx.Segment()
+        seg.add_points([gpx.Point(1,2,3,4)])
+        self.assertEqual(pts,seg.points)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import unittest
+import io
+import os
+import tempfile
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+
+GPX_1_0 = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.0" creator="other" xmlns="http://www.topografix.com/GPX/1/0" xmlns:x="urn:x">
+  <time>2001-01-01T00:00:00Z</time>
+  <wpt lat="1" lon="2"><time>2002-01-01T00:00:00Z</time></wpt>
+  <trk>
+    <name>one</name>
+    <trkseg>
+      <trkpt lat="41.5" lon="-73.5"><ele>100.6</ele><time>2020-08-11T21:06:10Z</time><x:time>bogus</x:time></trkpt>
+      <trkpt lat="41.6" lon="-73.6"><time>2020-08-11T17:06:25.250-04:00</time></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="-1" lon="1"/>
+    </trkseg>
+  </trk>
+  <trk>
+    <trkseg/>
+  </trk>
+</gpx>
+"""
+
+class GPXReadTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        path = 'doc/SunkMineRoad.gpx'
+        doc = gpxread.read(path)
+        self.assertEqual(407,len(doc.tracks[0].segs[0].points))
+        with open(path, 'r') as file:
+            self.assertEqual(file.read(),doc.to_xml())
+        # and compact GPX
+        compact = doc.to_xml(False)
+        self.assertEqual(compact,gpxread.read(io.BytesIO(compact.encode())).to_xml(False))
+
+    def test_gpx_1_0(self) -> None:
+        doc = gpxread.read(io.BytesIO(GPX_1_0))
+        self.assertEqual(2,len(doc.tracks))
+        self.assertEqual([2,1],[seg.len() for seg in doc.tracks[0].segs])
+        self.assertEqual([0],[seg.len() for seg in doc.tracks[1].segs])
+        self.assertEqual([
+            gpx.Point(1597179970,41.5,-73.5,101),
+            gpx.Point(1597179985,41.6,-73.6,0),
+        ],doc.tracks[0].segs[0].points)
+        self.assertEqual([gpx.Point(0,-1,1,0)],doc.tracks[0].segs[1].points)
+
+    def test_pieces(self) -> None:
+        points = gpx.Points(gpx.Point(1597179970+i,41+i/1000,-73,i) for i in range(10))
+        data = gpx.Document.from_points(points).to_xml().encode()
+        pieces = list(gpxread.iter_pieces(io.BytesIO(data),max_points=4,chunk_size=100))
+        self.assertEqual([4,4,2],[len(p.points) for p in pieces])
+        self.assertEqual([False,False,True],[p.last for p in pieces])
+        self.assertEqual(points,gpxread.read(io.BytesIO(data),max_points=4).tracks[0].segs[0].points)
+
+    def test_invalid(self) -> None:
+        self.assertRaises(Exception, lambda: gpxread.read(io.BytesIO(b"<kml/>")))
+        self.assertRaises(Exception, lambda: gpxread.read(io.BytesIO(b"<gpx><trk><trkseg><trkpt/></trkseg></trk></gpx>")))
+        self.assertRaises(Exception, lambda: gpxread.read(io.BytesIO(b"<gpx><trk>")))
+        self.assertRaises(Exception, lambda: gpxread.read(io.BytesIO(GPX_1_0.replace(b"17:06:25",b"17-06-25"))))
+        # a segment outside of a track, and a time that does not fit (before 1970)
+        self.assertRaisesRegex(Exception, "outside of a trk", lambda: gpxread.read(io.BytesIO(b"<gpx><trkseg><trkpt lat='1' lon='2'/></trkseg></gpx>")))
+        self.assertRaisesRegex(Exception, "out of range", lambda: gpxread.read(io.BytesIO(GPX_1_0.replace(b"2020-",b"1969-"))))
+
+    def test_read_many(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for n in range(6):
+                path = os.path.join(tmp, f"{n}.gpx")
+                points = gpx.Points(gpx.Point(1597179970+i,41,-73,n) for i in range(n*100))
+                with open(path, 'wb') as out:
+                    gpx.Document.from_points(points).write(out)
+                paths.append(path)
+            docs = gpxread.read_many(paths, processes=2)
+            self.assertEqual([n*100 for n in range(6)],[doc.tracks[0].segs[0].len() for doc in docs])
+            self.assertEqual([gpxread.read(path) for path in paths],docs)
+
+if __name__ == '__main__':
+    unittest.main()
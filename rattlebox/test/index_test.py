@@ -0,0 +1,101 @@
+import unittest
+import os
+import shutil
+import tempfile
+import rattlebox.analytics as analytics
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+import rattlebox.index as index
+
+DAY = 1597180000
+
+def make_points(n:int, ts:int, lat:float, lon:float) -> gpx.Points:
+    points = gpx.Points()
+    points.extend_columns([ ts + i*5 for i in range(n) ], [ lat + i*1e-5 for i in range(n) ], [ lon ]*n, [ i % 100 for i in range(n) ])
+    return points
+
+class IndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = index.Index(os.path.join(self.tmp.name, "index.db"))
+
+    def tearDown(self) -> None:
+        self.index.close()
+        self.tmp.cleanup()
+
+    def test_chunks(self) -> None:
+        # 3000 points, with a gap after 100, and (5s apart) crossing midnight
+        points = make_points(3000, DAY, 41, -73)
+        ts = [ t + (1000 if i >= 100 else 0) for i, t in enumerate(points.columns()[0]) ]
+        points = gpx.Points()
+        points.extend_columns(ts, [41.0]*3000, [-73.0]*3000, [0]*3000)
+        chunks = list(index.chunks(points))
+        self.assertEqual(3000,sum(len(c) for c in chunks))
+        for c in chunks:
+            cts = c.columns()[0]
+            self.assertLessEqual(len(c),index.CHUNK_POINTS)
+            self.assertEqual(cts[0]//index.DAY,cts[-1]//index.DAY)
+            self.assertLessEqual(max(b-a for a,b in zip(cts,cts[1:])) if len(c)>1 else 0,index.CHUNK_GAP)
+        self.assertEqual(len(chunks[0]),100)
+        self.assertEqual(points,index.decode(3000,b''.join(
+            [ points.columns()[0].tobytes(), points.columns()[1].tobytes(), points.columns()[2].tobytes(), points.columns()[3].tobytes() ])))
+
+    def test_query(self) -> None:
+        a = make_points(5000, DAY, 41, -73)
+        b = make_points(5000, DAY + 30*86400, 45, -70)
+        self.assertEqual(5000,self.index.add(a, "a"))
+        self.assertEqual(5000,self.index.add([b[:2000], b[2000:]], "b"))
+        self.assertEqual(10000,len(self.index))
+        self.assertEqual(list(a)+list(b),list(self.index.query()))
+        # bounding box
+        pts = self.index.query((41.01, -74, 41.02, -72))
+        self.assertEqual([ pt for pt in a if 41.01 <= pt.lat <= 41.02 ],list(pts))
+        self.assertEqual(0,len(self.index.query((42, -74, 44, -72))))
+        # time range
+        self.assertEqual(list(b[:100]),list(self.index.query(start=DAY + 30*86400, end=DAY + 30*86400 + 99*5)))
+        self.assertEqual(list(a[10:20]),list(self.index.query((40, -74, 42, -72), DAY + 50, DAY + 95)))
+        # replacing a source
+        self.assertEqual(100,self.index.add(a[:100], "a"))
+        self.assertEqual([("a",100),("b",5000)],self.index.sources())
+        self.assertEqual(list(a[:100])+list(b),list(self.index.query()))
+        self.index.remove("b")
+        self.assertEqual(100,len(self.index))
+
+    def test_nearest(self) -> None:
+        self.index.add(make_points(5000, DAY, 41, -73), "a")
+        d, pt = self.index.nearest(41.01, -73)[0]
+        self.assertAlmostEqual(41.01,pt.lat,9)
+        self.assertAlmostEqual(0,d,3)
+        found = self.index.nearest(41.5, -72, 3)
+        self.assertEqual(3,len(found))
+        self.assertEqual([41.04999,41.04998,41.04997],[ round(pt.lat,5) for _, pt in found ])
+        self.assertAlmostEqual(analytics.haversine(41.5,-72,41.04999,-73),found[0][0],3)
+        self.assertEqual([],index.Index(os.path.join(self.tmp.name, "empty.db")).nearest(41, -73))
+
+    def test_add_file(self) -> None:
+        path = os.path.join(self.tmp.name, "log.gpx")
+        shutil.copy('doc/SunkMineRoad.gpx', path)
+        n = len(gpxread.read(path).tracks[0].segs[0].points)
+        self.assertEqual(n,self.index.add_file(path))
+        # unchanged
+        self.assertEqual(0,self.index.add_file(path))
+        self.assertEqual(n,len(self.index))
+        os.utime(path, ns=(0,0))
+        self.assertEqual(n,self.index.add_file(path))
+        self.assertEqual(n,len(self.index))
+        self.assertEqual(gpxread.read(path).tracks[0].segs[0].points,self.index.query())
+
+    def test_add_delta(self) -> None:
+        # consecutive delta dumps, written to the same file, add up
+        path = os.path.join(self.tmp.name, "new-data.gpx")
+        for i in range(2):
+            with open(path, 'wb') as out:
+                gpx.Document.from_points(list(make_points(10, DAY + i*100, 41, -73))).write(out)
+            os.utime(path, ns=(i*10**9, i*10**9))
+            self.assertEqual(10,self.index.add_file(path, delta=True))
+            self.assertEqual(0,self.index.add_file(path, delta=True))
+        self.assertEqual(20,len(self.index))
+        self.assertEqual(2,len(self.index.sources()))
+
+if __name__ == '__main__':
+    unittest.main()
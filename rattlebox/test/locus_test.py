@@ -0,0 +1,121 @@
+import unittest
+import random
+import struct
+import rattlebox.gpx as gpx
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
+
+def decode_reference(data:bytes) -> list[gpx.Point]:
+    """
+    Decode one 16-byte block at a time.
+    """
+    points:list[gpx.Point] = []
+    for i in range(0,len(data),16):
+        block = bytearray(data[i:i+16])
+        if mt3339.checksum(block[:15]) != block[15]:
+            continue
+        wp = gpx.Point()
+        wp.ts = int.from_bytes(block[0:4],"little")
+        fix = block[4]
+        wp.lat = struct.unpack('<f', block[5:9])[0]
+        wp.lon = struct.unpack('<f', block[9:13])[0]
+        wp.ele = int.from_bytes(block[13:15],"little")
+        if (fix==2 or fix==4) and wp.is_valid():
+            points.append(wp)
+    return points
+
+def random_dump(n:int, seed:int=42) -> bytes:
+    rnd = random.Random(seed)
+    data = bytearray()
+    for _ in range(n):
+        ts = rnd.choice([rnd.randint(locus.TS_MIN,locus.TS_MAX), rnd.randint(0,2**32-1)])
+        fix = rnd.choice([0,2,2,4,4,1])
+        rec = bytearray(locus.encode(ts,fix,rnd.uniform(-90,90),rnd.uniform(-180,180),rnd.randint(0,9000)))
+        if rnd.random() < 0.1:
+            rec[rnd.randrange(16)] ^= 1 << rnd.randrange(8)
+        data.extend(rec)
+    return bytes(data)
+
+class LocusTest(unittest.TestCase):
+    def test_doc(self) -> None:
+        self.assertIsNotNone(locus.__doc__)
+
+    def test_record_layout(self) -> None:
+        self.assertEqual(16,locus.RECORD_SIZE)
+
+    def test_decode_words(self) -> None:
+        words = ["03E85667","04347B25","421AE293","C235006A","12E85667","04407B25","4200E293","C2390019"]
+        recs = locus.decode_words(words)
+        self.assertEqual(2,len(recs))
+        self.assertEqual(0,recs.bad_checksum)
+        self.assertEqual(41,int(recs.lat[0]))
+        self.assertEqual(-73,int(recs.lon[0]))
+        self.assertEqual(53,recs.ele[0])
+        self.assertEqual(4,recs.fix[0])
+
+    def test_bad_checksum(self) -> None:
+        recs = locus.decode_words(["03E85667","04347B25","421AE293","C235006B"])
+        self.assertEqual(0,len(recs))
+        self.assertEqual(1,recs.bad_checksum)
+
+    def test_invalid_length(self) -> None:
+        self.assertRaises(Exception, lambda: locus.decode(bytes(15)))
+
+    def test_empty(self) -> None:
+        self.assertEqual(0,len(locus.decode(b'')))
+
+    def test_matches_reference(self) -> None:
+        data = random_dump(2000)
+        recs = locus.decode(data)
+        expected = decode_reference(data)
+        self.assertEqual(expected,recs.to_points())
+        self.assertEqual(len(expected)+recs.bad_checksum+recs.invalid,len(data)//16)
+        self.assertGreater(recs.bad_checksum,0)
+        self.assertGreater(recs.invalid,0)
+
+    def test_decode_lox(self) -> None:
+        messages = [ nmea.parse_sentence(msg.decode("ascii").rstrip()) for msg in fixtures.read_messages() ]
+        recs = locus.decode_lox(messages)
+        driver = mt3339.Driver(None)
+        points:list[gpx.Point] = []
+        for fields in messages:
+            if fields[0]=="$PMTKLOX" and fields[1]=='1':
+                points.extend(driver.lox_to_points(fields[3:]))
+        self.assertEqual(18,len(recs))
+        self.assertEqual(points,recs.to_points())
+
+    def test_status(self) -> None:
+        status = locus.Status.parse("$PMTKLOG,3,1,8,1,15,0,0,0,100,2".split(","))
+        self.assertEqual(locus.Status(serial=3, overlap=False, mode=8, content=1, interval=15, logging=True, records=100, percent=2),
+                         status)
+        self.assertEqual(["Interval"],status.modes())
+        self.assertEqual("log #3: logging, 100 records (2% of flash), mode Interval, interval 15s; when full, stops",str(status))
+        with self.assertRaises(Exception):
+            locus.Status.parse("$PMTKLOG,3,1,8".split(","))
+        with self.assertRaises(Exception):
+            locus.Status.parse("$PMTKLOG,3,1,8,1,15,0,0,0,x,2".split(","))
+
+    def test_dump_size(self) -> None:
+        # the size of a dump, as sent by the simulator
+        for n in (0, 1, 6, 7, 1000):
+            log = simulator.make_log(n)
+            status = locus.Status(records=n)
+            chunks = [ log[i:i+locus.CHUNK_SIZE] for i in range(0, len(log), locus.CHUNK_SIZE) ]
+            msgs = [ simulator.sentence(f"PMTKLOX,0,{len(chunks)}") ]
+            msgs += [ simulator.lox_sentence(seq, chunk) for seq, chunk in enumerate(chunks) ]
+            msgs.append(simulator.sentence("PMTKLOX,2"))
+            self.assertEqual((len(log),len(chunks)),(status.data_size(),status.chunks()))
+            self.assertEqual(sum(len(m) for m in msgs),status.dump_size())
+        self.assertAlmostEqual(status.dump_size()/960,status.dump_time(9600))
+
+    def test_extend(self) -> None:
+        data = random_dump(100)
+        recs = locus.decode(data[:800])
+        recs.extend(locus.decode(data[800:]))
+        self.assertEqual(decode_reference(data),recs.to_points())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import contextlib
+import io
+import json
+import os
+import tempfile
+import rattlebox.metrics as metrics
+import rattlebox.mt3339 as mt3339
+import rattlebox.reader as reader
+import rattlebox.test.reader_test as reader_test
+import rattlebox.test.fixtures as fixtures
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self) -> None:
+        h = metrics.Histogram()
+        self.assertEqual(0,h.percentile(50))
+        for v in [0, 1, 5, 6, 7, 100, 1000, -3] + [10]*92:
+            h.add(v)
+        d = h.to_dict()
+        self.assertEqual(100,d["count"])
+        self.assertEqual(0,d["min"])
+        self.assertEqual(1000,d["max"])
+        self.assertAlmostEqual((1+5+6+7+100+1000+920)/100,d["mean"])
+        self.assertEqual(15,d["p50"])
+        self.assertEqual(127,d["p99"])
+        self.assertEqual(1000,h.percentile(100))
+        self.assertEqual({"<1": 2, "<2": 1, "<8": 3, "<16": 92, "<128": 1, "<1024": 1},d["buckets"])
+
+    def test_driver(self) -> None:
+        meter = metrics.Metrics()
+        driver = mt3339.Driver(None, show_prog=False, metrics=meter)
+        driver.cmd = "logger-dump"
+        lines = fixtures.read_messages()
+        with contextlib.redirect_stderr(io.StringIO()):
+            driver.recv_messages(lines + [ b"$GPGGA,bogus*00\r\n", b"GPGGA\r\n", b"\r\n" ])
+        c = meter.counters
+        self.assertEqual(len(lines)+3,c["nmea.lines"])
+        self.assertEqual(sum(map(len, lines))+26,c["nmea.bytes"])
+        self.assertEqual(1,c["nmea.bad_checksum"])
+        self.assertEqual(1,c["nmea.no_start"])
+        self.assertEqual(len(driver.log_seqs),c["lox.chunks"])
+        self.assertEqual(18,c["lox.records"])
+        self.assertEqual(c["lox.chunks"],meter.histograms["lox.decode_us"].count)
+        self.assertEqual(1,c["nmea.empty"])
+        self.assertEqual(len(lines),sum(v for k, v in c.items() if k.startswith("nmea.type.")))
+
+    def test_reader(self) -> None:
+        meter = metrics.Metrics()
+        data = fixtures.read_data()
+        with reader.Reader(reader_test.FakePort(data, 64), metrics=meter) as rdr:
+            lines:list[bytes] = [ line for line in [ rdr.get(1) ] if line is not None ]
+            while len(lines) < data.count(b'\n'):
+                lines += rdr.get_batch(max=5, timeout=1)
+        h = meter.histograms["reader.queue_latency_us"]
+        self.assertEqual(len(lines),h.count)
+        self.assertEqual(0,len(rdr._stamps or []))
+        self.assertGreaterEqual(h.min,0)
+        # without metrics, nothing is recorded
+        with reader.Reader(reader_test.FakePort(data, 64)) as rdr:
+            self.assertIsNotNone(rdr.get(1))
+            self.assertIsNone(rdr._stamps)
+
+    def test_dump(self) -> None:
+        meter = metrics.Metrics()
+        meter.count("a")
+        meter.count("a", 2)
+        meter.observe("b_us", 3)
+        self.assertFalse(meter.due(0))
+        self.assertFalse(meter.due(3600))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            meter.dump(path, reader={"bytes": 10})
+            with open(path) as file:
+                d = json.load(file)
+        self.assertEqual({"a": 3},d["counters"])
+        self.assertEqual(3,d["histograms"]["b_us"]["max"])
+        self.assertEqual({"bytes": 10},d["reader"])
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            meter.dump("-")
+        self.assertEqual(3,json.loads(err.getvalue())["counters"]["a"])
+
+    def test_profiler(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "rattlebox.prof")
+            profiler = metrics.Profiler(path, trace_malloc=2)
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                profiler.start()
+                sorted([ str(i) for i in range(1000) ])
+                profiler.stop()
+            self.assertTrue(os.path.exists(path))
+        self.assertIn("top functions",err.getvalue())
+        self.assertEqual(2,len(err.getvalue().split("top allocation sites:")[1].strip().splitlines()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,9 @@ import unittest
 import sys
 import rattlebox.mt3339 as mt3339
 import rattlebox.gpx as gpx
+import rattlebox.reader as reader
+import rattlebox.simulator as simulator
+import rattlebox.test.fixtures as fixtures
 from typing import (Any, Optional)
 
 class MT3339Test(unittest.TestCase):
@@ -33,10 +36,8 @@ class MT3339Test(unittest.TestCase):
     def test_messages(self) -> None:
         driver = mt3339.Driver(None,debug=True)
         driver.cmd = "logger-dump"
-        with open('test-data/test-messages.txt', 'r') as file:
-            messages = file.readlines()
-            for msg in messages:
-                self.assertTrue(driver.recv_message(msg.encode("ascii")))
+        for msg in fixtures.read_messages():
+            self.assertTrue(driver.recv_message(msg))
         # confirm that we dumped the log
         doc = self.must_be(driver.get_log_as_gpx())
         print(doc.to_xml())
@@ -47,6 +48,65 @@ class MT3339Test(unittest.TestCase):
         self.assertEqual(-73,int(loc.lon))
         self.assertEqual(85,loc.ele)
 
+    def test_negotiate_baud(self) -> None:
+        # device is at 9600 baud, but we start at 115200
+        sim = simulator.Simulator(simulator.make_log(100), rate=0)
+        port = simulator.SimPort(sim, baudrate=115200, timeout=1)
+        driver = mt3339.Driver(port,show_prog=False)
+        self.assertEqual(9600,driver.probe_baud(0.2))
+        self.assertEqual(9600,port.baudrate)
+        self.assertEqual(115200,driver.negotiate_baud(0.2))
+        self.assertEqual((115200,115200),(sim.baudrate,port.baudrate))
+        self.assertTrue(driver.ping())
+        # and the log is dumped at that rate
+        with reader.Reader(port) as rdr:
+            driver.send_command("logger-dump")
+            while driver.is_command_active():
+                driver.recv_messages(rdr.get_batch())
+        self.assertEqual(100,len(driver.log_points))
+        self.assertEqual(1600,driver.log_bytes)
+
+    def test_negotiate_baud_fallback(self) -> None:
+        # device that ignores baud rate changes
+        class Stuck(simulator.Simulator):
+            def handle_command(self, cmd:str, args:list[str]) -> None:
+                if cmd != "251":
+                    super().handle_command(cmd, args)
+        sim = Stuck(rate=0)
+        port = simulator.SimPort(sim, baudrate=9600, timeout=1)
+        driver = mt3339.Driver(port,show_prog=False)
+        self.assertFalse(driver.set_baud(115200,0.2))
+        self.assertEqual(9600,port.baudrate)
+        self.assertEqual(9600,driver.negotiate_baud(0.2))
+        self.assertFalse(driver.is_command_active())
+        # no device at all
+        silent = simulator.Simulator(rate=0)
+        silent.baudrate = 4800
+        driver = mt3339.Driver(simulator.SimPort(silent, timeout=1),show_prog=False)
+        self.assertIsNone(driver.probe_baud(0.1))
+        self.assertRaises(Exception, lambda: driver.negotiate_baud(0.1))
+
+    def test_plan_dump(self) -> None:
+        # the logger status is checked before dumping the log
+        sim = simulator.Simulator(simulator.make_log(100), rate=0)
+        port = simulator.SimPort(sim, timeout=1)
+        driver = mt3339.Driver(port,show_prog=False)
+        req = driver.submit_command("logger-dump")
+        self.assertEqual(["logger-status","logger-dump"],[ r.cmd for r in driver.commands.queued ])
+        with reader.Reader(port) as rdr:
+            driver.run_commands(lambda timeout: rdr.get_batch(timeout=timeout))
+            status = self.must_be(driver.log_status)
+            self.assertEqual((100,"succeeded"),(status.records,req.status()))
+            self.assertEqual((status.chunks(),100),(driver.log_total,len(driver.log_points)))
+            # an empty log is not dumped; the commands after it carry on
+            sim.log.clear()
+            reqs = [ driver.submit_command(cmd) for cmd in ("logger-status", "logger-dump", "logger-start") ]
+            self.assertEqual(3,len(driver.commands.queued))
+            driver.run_commands(lambda timeout: rdr.get_batch(timeout=timeout))
+        self.assertEqual(["succeeded","skipped","succeeded"],[ r.status() for r in reqs ])
+        self.assertEqual(0,self.must_be(driver.log_status).records)
+        self.assertTrue(sim.logging)
+
     def must_be(self, obj: Optional[Any]) -> Any:
         """
         Assert that the given object is not None,
@@ -1,5 +1,7 @@
 import unittest
+import rattlebox.gpx as gpx
 import rattlebox.nmea as nmea
+import rattlebox.test.fixtures as fixtures
 
 class NMEATest(unittest.TestCase):
     def test_doc(self) -> None:
@@ -17,5 +19,106 @@ class NMEATest(unittest.TestCase):
         bad_chk = "$GPRMC,011727.000,A,4125.9840,N,07357.0713,W,0.07,159.48,140820,,,A*42"
         self.assertRaises(Exception, lambda: nmea.parse_sentence(bad_chk))
 
+    def test_tokenize(self) -> None:
+        valid = b"$GPRMC,011727.000,A,4125.9840,N,07357.0713,W,0.07,159.48,140820,,,A*73\r\n"
+        status, fields = nmea.tokenize(valid)
+        self.assertEqual(nmea.OK,status)
+        self.assertEqual(13,len(fields))
+        self.assertEqual("$GPRMC",fields[0])
+        self.assertEqual("A",fields[-1])
+        # lower case hex digits in the checksum are fine, too
+        self.assertEqual(nmea.OK,nmea.tokenize(b"$PMTKLOX,0,3*5a")[0])
+        self.assertEqual(nmea.EMPTY,nmea.tokenize(b"\r\n")[0])
+        self.assertEqual(nmea.NO_START,nmea.tokenize(b"bogus")[0])
+        self.assertEqual(nmea.NO_CHECKSUM,nmea.tokenize(valid[:-5])[0])
+        self.assertEqual(nmea.NO_CHECKSUM,nmea.tokenize(valid[:-4]+b"G\r\n")[0])
+        self.assertEqual(nmea.BAD_CHECKSUM,nmea.tokenize(valid.replace(b"*73",b"*42"))[0])
+        self.assertEqual(nmea.BAD_CHECKSUM,nmea.tokenize(b"$\xff\xfe*00")[0])
+        self.assertEqual((nmea.OK,["$PMTK001","622","3"]),nmea.tokenize(b"$PMTK001,622,3*36"))
+
+    def test_parse_many(self) -> None:
+        data = fixtures.read_data()
+        results, rest = nmea.parse_many(data[:500])
+        more, rest = nmea.parse_many(rest + data[500:] + b"\r\n$GP")
+        results.extend(more)
+        self.assertEqual(b"$GP",rest)
+        self.assertEqual(10,len(results))
+        self.assertEqual([nmea.OK]*10,[status for status,_ in results])
+        self.assertEqual([nmea.parse_sentence(line.decode()) for line in data.splitlines()],[f for _,f in results])
+        results, rest = nmea.parse_many(b"bogus\n$GPXXX*00\n")
+        self.assertEqual([nmea.NO_START,nmea.BAD_CHECKSUM],[status for status,_ in results])
+
+    def test_checksum(self) -> None:
+        self.assertEqual("36",nmea.checksum("PMTK001,622,3"))
+        self.assertEqual("00",nmea.checksum(""))
+        body = bytes(range(1,200))
+        chk = 0
+        for b in body:
+            chk ^= b
+        self.assertEqual(chk,nmea.xor(body))
+
+    def test_assembler(self) -> None:
+        def fields(body:str) -> list[str]:
+            return nmea.parse_sentence(f"${body}*{nmea.checksum(body)}")
+        asm = nmea.Assembler()
+        # RMC, VTG, GGA, GSA, GSV for one epoch
+        self.assertEqual((None,True),asm.add(fields("GNRMC,235959.000,A,4125.9840,N,07357.0713,W,0.07,159.48,140820,,,A")))
+        self.assertEqual((None,False),asm.add(fields("GNVTG,159.48,T,,M,0.07,N,0.13,K,A")))
+        self.assertEqual((None,True),asm.add(fields("GNGGA,235959.000,4125.9840,N,07357.0713,W,1,06,1.20,85.9,M,-34.1,M,,")))
+        asm.add(fields("GNGSA,A,3,01,21,24,,,,,,,,,,1.48,1.20,0.86"))
+        asm.add(fields("GNGSA,A,3,65,66,,,,,,,,,,,1.48,1.20,0.86"))
+        asm.add(fields("GPGSV,3,1,11,01,63,271,32,21,54,065,30,24,38,133,28,31,24,315,26"))
+        asm.add(fields("GPXXX,1,2,3"))
+        # GLL (without a fix) starts the next epoch, just past midnight
+        fix, has_pos = asm.add(fields("GPGLL,,,,,000000.000,V,N"))
+        self.assertFalse(has_pos)
+        assert(fix is not None)
+        self.assertEqual(1597449599,fix.ts) # 2020-08-14T23:59:59Z
+        self.assertEqual((41.43306666666667,-73.95118833333334,85.9),(fix.lat,fix.lon,fix.ele))
+        self.assertEqual((1,3,6,11),(fix.quality,fix.mode,fix.sats,fix.sats_in_view))
+        self.assertEqual([1,21,24,65,66],fix.prns)
+        self.assertEqual((1.48,1.20,0.86),(fix.pdop,fix.hdop,fix.vdop))
+        self.assertAlmostEqual(0.13/3.6,fix.speed)
+        self.assertEqual(159.48,fix.course)
+        self.assertTrue(fix.valid)
+        self.assertEqual(gpx.Point(1597449599,fix.lat,fix.lon,85),fix.to_point())
+        assert(asm.fix is not None)
+        self.assertEqual(1597449600,asm.fix.ts)
+        # epoch without a position is not reported
+        self.assertEqual((None,False),asm.add(fields("GPGGA,000001.000,,,,,0,00,,,M,,M,,")))
+
+    def test_assembler_early(self) -> None:
+        def fields(body:str) -> list[str]:
+            return nmea.parse_sentence(f"${body}*{nmea.checksum(body)}")
+        def epoch(tod:str, gsv:bool) -> list[list[str]]:
+            # in the order of the MT3339: GGA, GSA, (GSV), RMC, VTG
+            return [ fields(f"GPGGA,{tod},4125.9840,N,07357.0713,W,1,06,1.20,85.9,M,-34.1,M,,"),
+                     fields("GPGSA,A,3,01,21,24,,,,,,,,,,1.48,1.20,0.86") ] + \
+                   ([ fields("GPGSV,3,1,11,01,63,271,32,21,54,065,30,24,38,133,28,31,24,315,26") ] if gsv else []) + \
+                   [ fields(f"GPRMC,{tod},A,4125.9840,N,07357.0713,W,0.07,159.48,140820,,,A"),
+                     fields("GPVTG,159.48,T,,M,0.07,N,0.13,K,A") ]
+        asm = nmea.Assembler(early=True)
+        done:list[tuple[int,str]] = []
+        for i, tod in enumerate(["120000.000","120001.000","120002.000","120003.000"]):
+            for f in epoch(tod, i == 2):
+                fix, _ = asm.add(f)
+                if fix is not None:
+                    done.append((int(fix.tod) % 100, f[0]))
+        # the first epoch is complete when the next one starts; after that,
+        # as soon as VTG (which always ends an epoch) arrives
+        self.assertEqual([(0,"$GPGGA"),(1,"$GPVTG"),(2,"$GPVTG"),(3,"$GPVTG")],done)
+        self.assertEqual({"VTG"},asm.last - asm.not_last)
+        # without early, epochs are complete when the next one starts
+        asm = nmea.Assembler()
+        self.assertEqual(3,len([ f for i in range(4) for f in epoch(f"12000{i}.000", False) if asm.add(f)[0] is not None ]))
+
+    def test_gga_no_fix(self) -> None:
+        no_fix = nmea.parse_sentence("$GPGGA,011619.000,4125.9840,N,07357.0713,W,0,00,,85.9,M,-34.1,M,,*74")
+        self.assertIsNone(nmea.parse_gpgga(no_fix))
+        fix = nmea.parse_sentence("$GPGGA,011619.000,4125.9840,N,07357.0713,W,1,06,1.20,85.9,M,-34.1,M,,*6E")
+        pt = nmea.parse_gpgga(fix)
+        assert(pt is not None)
+        self.assertEqual((41,-73,85),(int(pt.lat),int(pt.lon),pt.ele))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import unittest
 import rattlebox.progress as progress
+import rattlebox.test.fixtures as fixtures
 import sys
 
 class ProgressTest(unittest.TestCase):
@@ -14,3 +15,19 @@ class ProgressTest(unittest.TestCase):
             progRock.display(sys.stdout,delta=1)
         self.assertEqual(100,progRock.get())
         self.assertEqual(0,prog.get())
+
+    def test_eta(self) -> None:
+        clock = fixtures.Clock()
+        prog = progress.Progress(max=10,label="dump log: ",width=10,eta=True,unit="B",scale=96,expected=20,clock=clock)
+        # until there is progress, the ETA is the expected duration
+        self.assertEqual(" -, ETA 0:20",prog.readout())
+        clock.t = 5
+        self.assertEqual(" -, ETA 0:15",prog.readout())
+        prog.inc(5)
+        self.assertEqual(" 96 B/s, ETA 0:05",prog.readout())
+        clock.t = 6
+        prog.inc(5)
+        self.assertEqual(" 160 B/s, ETA 0:00",prog.readout())
+        prog.display(sys.stdout)
+        self.assertEqual(("0:42","1:02:05"),(progress.format_duration(42),progress.format_duration(3725)))
+        self.assertEqual(("1.2 kB/s","3.0 MB/s"),(progress.format_rate(1234,"B"),progress.format_rate(3e6,"B")))
@@ -0,0 +1,104 @@
+import unittest
+import threading
+import time
+import rattlebox.mt3339 as mt3339
+import rattlebox.reader as reader
+import rattlebox.test.fixtures as fixtures
+
+class FakePort:
+    """
+    A port that returns the given data in pieces of (at most) n bytes,
+    and then times out (returns no data).
+    """
+    def __init__(self, data:bytes, n:int=7):
+        self.data = data
+        self.n = n
+        self.pos = 0
+        self.closed = False
+
+    @property
+    def in_waiting(self) -> int:
+        return min(self.n, len(self.data)-self.pos)
+
+    def read(self, size:int=1) -> bytes:
+        if self.closed:
+            raise IOError("port closed")
+        if self.pos >= len(self.data):
+            time.sleep(0.01)
+            return b''
+        size = min(size, self.n)
+        data = self.data[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+class ReaderTest(unittest.TestCase):
+    def read_all(self, rdr:reader.Reader, n:int) -> list[bytes]:
+        lines:list[bytes] = []
+        while len(lines) < n:
+            batch = rdr.get_batch(timeout=2)
+            self.assertGreater(len(batch),0)
+            lines.extend(batch)
+        return lines
+
+    def test_lines(self) -> None:
+        data = fixtures.read_data() + b"$GPGGA,"
+        with reader.Reader(FakePort(data)) as rdr:
+            lines = self.read_all(rdr,10)
+            # the last line is incomplete
+            self.assertEqual([],rdr.get_batch(timeout=0.1))
+        self.assertFalse(rdr.is_alive())
+        self.assertEqual(fixtures.read_messages(),lines)
+        self.assertEqual(len(data),rdr.stats.bytes)
+        self.assertEqual(10,rdr.stats.lines)
+        self.assertEqual(0,rdr.stats.dropped)
+
+    def test_driver(self) -> None:
+        driver = mt3339.Driver(None,show_prog=False)
+        driver.cmd = "logger-dump"
+        n = 0
+        with reader.Reader(FakePort(fixtures.read_data(),n=100)) as rdr:
+            while driver.is_command_active():
+                n += driver.recv_messages(rdr.get_batch(timeout=2))
+            # the rest
+            while n < 10:
+                n += driver.recv_messages(rdr.get_batch(timeout=2))
+        self.assertEqual(18,len(driver.log_points))
+        self.assertIsNotNone(driver.get_loc())
+
+    def test_dropped(self) -> None:
+        data = b"$GPXXX*00\r\n" * 100
+        rdr = reader.Reader(FakePort(data,n=1000),maxsize=10,block=False)
+        rdr.start()
+        while rdr.stats.lines + rdr.stats.dropped < 100:
+            time.sleep(0.01)
+        self.assertEqual(10,rdr.stats.lines)
+        self.assertEqual(90,rdr.stats.dropped)
+        self.assertEqual(10,rdr.stats.max_depth)
+        self.assertEqual(10,len(rdr.get_batch(max=100)))
+        rdr.stop()
+
+    def test_backpressure(self) -> None:
+        data = b"$GPXXX*00\r\n" * 100
+        with reader.Reader(FakePort(data,n=1000),maxsize=10) as rdr:
+            lines = self.read_all(rdr,100)
+        self.assertEqual(100,len(lines))
+        self.assertEqual(0,rdr.stats.dropped)
+        self.assertLessEqual(rdr.stats.max_depth,10)
+
+    def test_overrun(self) -> None:
+        data = b"$" + b"X"*2000 + b"\r\n$GPXXX*00\r\n"
+        with reader.Reader(FakePort(data,n=100),max_line=1024) as rdr:
+            lines = self.read_all(rdr,1)
+        self.assertEqual([b"$GPXXX*00\r\n"],lines)
+        self.assertEqual(1,rdr.stats.overruns)
+
+    def test_error(self) -> None:
+        port = FakePort(b"")
+        port.closed = True
+        rdr = reader.Reader(port)
+        rdr.start()
+        self.assertRaises(IOError, lambda: rdr.get_batch(timeout=1))
+        rdr.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import tempfile
+import rattlebox.dump as dump
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+import rattlebox.segment as segment
+
+DAY = 1597180000
+
+def make_points() -> gpx.Points:
+    """
+    Two outings (a day apart); the first one has a 10 minute stop, and the
+    second one a fix type change and a 5km jump
+    """
+    ts = [ DAY + i*15 for i in range(10) ] + [ DAY + 600 + i*15 for i in range(10, 20) ] + \
+         [ DAY + 86400 + i*15 for i in range(20) ]
+    lat = [ 41.0 + i*0.0001 for i in range(30) ] + [ 41.05 + i*0.0001 for i in range(30, 40) ]
+    fix = [2]*25 + [4]*15
+    points = gpx.Points()
+    points.extend_columns(ts, lat, [-73.0]*40, [100]*40, fix)
+    return points
+
+def shape(doc:gpx.Document) -> list[list[int]]:
+    return [ [ len(seg.points) for seg in track.segs ] for track in doc.tracks ]
+
+class SegmentTest(unittest.TestCase):
+    def test_segment(self) -> None:
+        points = make_points()
+        doc = segment.segment(points)
+        self.assertEqual([[10,10],[5,5,10]],shape(doc))
+        self.assertEqual(list(points),[ pt for track in doc.tracks for seg in track.segs for pt in seg.points ])
+        self.assertEqual([[10,10],[20]],shape(segment.segment(points,segment.Rules(split_on_fix=False,max_jump=0))))
+        self.assertEqual([[20],[20]],shape(segment.segment(points,segment.Rules(segment_gap=0,split_on_fix=False,max_jump=0))))
+        self.assertEqual([[40]],shape(segment.segment(points,segment.Rules(0,0,0,False))))
+        self.assertEqual([],shape(segment.segment(gpx.Points())))
+        # time going backwards starts a new track
+        back = gpx.Points()
+        back.extend(points[20:])
+        back.extend(points[:20])
+        self.assertEqual([[5,5,10],[10,10]],shape(segment.segment(back)))
+
+    def test_pieces(self) -> None:
+        points = make_points()
+        whole = segment.segment(points)
+        for n in [1, 3, 10, 15]:
+            out = segment.DocumentOutput()
+            segmenter = segment.Segmenter(out)
+            for i in range(0,len(points),n):
+                segmenter.add(points[i:i+n])
+            segmenter.end()
+            self.assertEqual((2,5),(segmenter.tracks,segmenter.segments))
+            self.assertEqual(whole,out.doc)
+
+    def test_outing_files(self) -> None:
+        points = make_points()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp,"log.gpx")
+            sink = dump.SegmentSink(segment.OutingFiles(path))
+            for i in range(0,len(points),6):
+                sink.write(i,points[i:i+6])
+            sink.close()
+            self.assertEqual(["log-20200811-210640.gpx","log-20200812-210640.gpx"],sorted(os.listdir(tmp)))
+            docs = [ gpxread.read(os.path.join(tmp,name)) for name in sorted(os.listdir(tmp)) ]
+            self.assertEqual([[10,10]],shape(docs[0]))
+            self.assertEqual([[5,5,10]],shape(docs[1]))
+            # a document can be written the same way
+            out = segment.OutingFiles(os.path.join(tmp,"doc"))
+            segment.write(segment.segment(points), out)
+            self.assertEqual(["doc-20200811-210640.gpx","doc-20200812-210640.gpx"],[ os.path.basename(p) for p in out.paths ])
+            with open(out.paths[1],'rb') as f1, open(os.path.join(tmp,"log-20200812-210640.gpx"),'rb') as f2:
+                self.assertEqual(f1.read(),f2.read())
+
+    def test_gpx_sink(self) -> None:
+        points = make_points()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp,"log.gpx")
+            sink = dump.GPXSink(path,rules=segment.Rules())
+            sink.begin(0)
+            for i in range(0,len(points),7):
+                sink.write(i,points[i:i+7])
+            sink.close()
+            with open(path,'r') as file:
+                self.assertEqual(segment.segment(points).to_xml(),file.read())
+
+if __name__ == '__main__':
+    unittest.main()
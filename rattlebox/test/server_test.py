@@ -0,0 +1,159 @@
+import unittest
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import rattlebox.aio as aio
+import rattlebox.nmea as nmea
+import rattlebox.server as server
+import rattlebox.simulator as simulator
+
+class Connection:
+    def __init__(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, request:str) -> None:
+        self.writer.write(request.encode() + b"\n")
+        await self.writer.drain()
+
+    async def recv(self) -> dict:
+        line = await asyncio.wait_for(self.reader.readline(), 5)
+        assert(line.endswith(b"\r\n"))
+        return json.loads(line)
+
+    async def recv_class(self, cls:str) -> dict:
+        while True:
+            obj = await self.recv()
+            if obj["class"] == cls:
+                return obj
+
+    def close(self) -> None:
+        self.writer.close()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def make_fix() -> nmea.Fix:
+    return nmea.Fix(tod=76000.2, ts=1597180000, lat=41.45, lon=-73.93, ele=100, quality=1, mode=3, sats=8, sats_in_view=11,
+                    prns=[3,6,19], hdop=0.95, pdop=1.6, vdop=1.3, speed=1.5, course=90)
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    def test_reports(self) -> None:
+        fix = make_fix()
+        self.assertEqual({"class":"TPV","device":"sim","mode":3,"time":"2020-08-11T21:06:40.200Z","lat":41.45,"lon":-73.93,
+                          "alt":100,"altMSL":100,"speed":1.5,"track":90},server.tpv(fix, "sim"))
+        self.assertEqual({"class":"SKY","device":"sim","time":"2020-08-11T21:06:40.200Z","hdop":0.95,"pdop":1.6,"vdop":1.3,
+                          "nSat":11,"uSat":8,"satellites":[{"PRN":3,"used":True},{"PRN":6,"used":True},{"PRN":19,"used":True}]},
+                         server.sky(fix, "sim"))
+        # unknown values are left out
+        self.assertEqual({"class":"TPV","device":"sim","mode":1},server.tpv(nmea.Fix(), "sim"))
+        self.assertIsNone(server.sky(nmea.Fix(), "sim"))
+        self.assertIsNone(server.refused("logger-status"))
+        self.assertIsNone(server.refused("PMTK220,200"))
+        self.assertIsNotNone(server.refused("baud-9600"))
+        self.assertIsNotNone(server.refused("PMTK622,1"))
+        self.assertIsNotNone(server.refused("logger-erase"))
+        self.assertIsNotNone(server.refused("PMTK104"))
+        self.assertEqual((True,True,True),(server.is_loopback("localhost"),server.is_loopback("127.0.0.1"),server.is_loopback("::1")))
+        self.assertEqual((False,False),(server.is_loopback("0.0.0.0"),server.is_loopback("example.com")))
+        with self.assertRaises(Exception):
+            server.refused("PMTK220,200*2C\r\n$PMTK622,1")
+
+    async def test_serve(self) -> None:
+        sim = simulator.Simulator(rate=20)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "gps.sock")
+            port = free_port()
+            task = asyncio.create_task(server.serve(simulator.SimTransport(sim), [ path, f"localhost:{port}" ], "sim", [ "output-all" ]))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            # a client on each address
+            a = Connection(*await asyncio.open_unix_connection(path))
+            self.assertEqual({"class":"VERSION","release":"rattlebox","rev":"rattlebox","proto_major":3,"proto_minor":11},await a.recv())
+            await a.send('?WATCH={"enable":true,"json":true};')
+            self.assertEqual("DEVICES",(await a.recv())["class"])
+            self.assertEqual({"class":"WATCH","enable":True,"json":True},await a.recv())
+            tpv = await a.recv_class("TPV")
+            self.assertEqual(("sim",3),(tpv["device"],tpv["mode"]))
+            self.assertAlmostEqual(41.4,tpv["lat"],0)
+            await a.recv_class("SKY")
+            b = Connection(*await asyncio.open_connection("localhost", port))
+            await b.recv()
+            await b.send("?POLL;")
+            poll = await b.recv()
+            self.assertEqual(("POLL",1,1),(poll["class"],len(poll["tpv"]),len(poll["sky"])))
+            # commands are queued, and answered
+            await b.send('?PMTK={"cmd":"logger-status"};')
+            await b.send('?PMTK={"cmd":"PMTK000"};')
+            await b.send('?PMTK={"cmd":"baud-9600"};')
+            await b.send('?PMTK={"cmd":"bogus"};')
+            await b.send('?BOGUS;')
+            await b.send('?WATCH={"enable":tru;')
+            replies = [ await b.recv() for _ in range(6) ]
+            self.assertEqual([("PMTK","baud-9600","refused"),("PMTK","bogus","refused")],
+                             [ (r["class"],r["cmd"],r["status"]) for r in replies[:2] ])
+            self.assertEqual(["ERROR","ERROR"],[ r["class"] for r in replies[2:4] ])
+            self.assertEqual([("logger-status","succeeded"),("PMTK000","succeeded")],[ (r["cmd"],r["status"]) for r in replies[4:] ])
+            # the device does not support this one
+            await b.send('?PMTK={"cmd":"PMTK999"};')
+            reply = await b.recv()
+            self.assertEqual(("unsupported",1),(reply["status"],reply["tries"]))
+            # nor this one, which would erase the log
+            await b.send('?PMTK={"cmd":"logger-erase"};')
+            self.assertEqual("refused",(await b.recv())["status"])
+            # a client that is not watching only gets replies
+            await b.send('?WATCH={"enable":false};')
+            self.assertEqual(False,(await b.recv_class("WATCH"))["enable"])
+            a.close()
+            b.close()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertFalse(os.path.exists(path))
+
+    async def test_listen(self) -> None:
+        # TCP only on loopback addresses
+        srv = server.Server(aio.AsyncDriver(aio.MemoryTransport()), "mem")
+        for address in ("0.0.0.0:2947", "example.com:2947"):
+            with self.assertRaises(Exception):
+                await srv.listen(address)
+        await srv.listen(f"[::1]:{free_port()}")
+        await srv.listen(f":{free_port()}")
+        self.assertEqual(2,len(srv.servers))
+        await srv.close()
+
+    async def test_slow_client(self) -> None:
+        host, dev = aio.MemoryTransport.pair()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "gps.sock")
+            async with aio.AsyncDriver(host) as drv:
+                srv = server.Server(drv, "mem", max_buffer=65536)
+                await srv.listen(path)
+                srv.start()
+                slow = Connection(*await asyncio.open_unix_connection(path))
+                await slow.send('?WATCH={"enable":true};')
+                while not any(c.watch for c in srv.clients):
+                    await asyncio.sleep(0.01)
+                # the slow client does not read; publishing does not block
+                fix = make_fix()
+                for _ in range(5000):
+                    srv.publish(fix)
+                self.assertEqual((5000,1),(srv.published,srv.dropped))
+                self.assertEqual(0,len([ c for c in srv.clients if not c.closed ]))
+                fast = Connection(*await asyncio.open_unix_connection(path))
+                await fast.recv()
+                await fast.send('?WATCH={"enable":true};')
+                await fast.recv_class("WATCH")
+                srv.publish(fix)
+                self.assertEqual("TPV",(await fast.recv())["class"])
+                slow.close()
+                fast.close()
+                await srv.close()
+            await dev.close()
+
+if __name__ == '__main__':
+    unittest.main()
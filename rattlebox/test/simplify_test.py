@@ -0,0 +1,78 @@
+import unittest
+import math
+import random
+from array import array
+import rattlebox.gpx as gpx
+import rattlebox.gpxread as gpxread
+import rattlebox.simplify as simplify
+
+def make_points(lat:list[float], lon:list[float]) -> gpx.Points:
+    points = gpx.Points()
+    points.extend_columns(range(len(lat)), lat, lon, [0]*len(lat))
+    return points
+
+def line_dist(x:array, y:array, i:int, a:int, b:int) -> float:
+    # distance from point i to the line through points a and b
+    dx, dy = x[b]-x[a], y[b]-y[a]
+    return abs((x[i]-x[a])*dy - (y[i]-y[a])*dx) / math.hypot(dx, dy)
+
+class SimplifyTest(unittest.TestCase):
+    def test_line(self) -> None:
+        points = make_points([41+i*1e-4 for i in range(100)], [-73.0]*100)
+        for method in simplify.METHODS:
+            simple = simplify.simplify(points, 1, method)
+            self.assertEqual([points[0],points[99]],simple)
+
+    def test_zigzag(self) -> None:
+        # 11m zig-zag
+        lat = [41+i*1e-4 for i in range(50)]
+        lon = [-73+(i%2)*1e-4 for i in range(50)]
+        points = make_points(lat, lon)
+        self.assertEqual(50,len(simplify.simplify(points, 5, "dp")))
+        self.assertEqual(2,len(simplify.simplify(points, 20, "dp")))
+        self.assertEqual(50,len(simplify.simplify(points, 5, "vw")))
+        self.assertEqual(2,len(simplify.simplify(points, 50, "vw")))
+
+    def test_tolerance(self) -> None:
+        random.seed(42)
+        n = 5000
+        lat = [41+i*2e-5+random.gauss(0,5e-5) for i in range(n)]
+        lon = [-73+math.sin(i/200)*1e-3 for i in range(n)]
+        points = make_points(lat, lon)
+        x, y = simplify.project(points)
+        for tol in [1.0, 10.0]:
+            for window in [3, 100, n]:
+                keep = simplify.douglas_peucker(x, y, tol, window)
+                self.assertEqual(0,keep[0])
+                self.assertEqual(n-1,keep[-1])
+                # every dropped point is within tol of the line between the
+                # points kept on either side
+                for a, b in zip(keep, keep[1:]):
+                    for i in range(a+1, b):
+                        self.assertLessEqual(line_dist(x, y, i, a, b), tol)
+        keep = simplify.visvalingam_whyatt(x, y, 10)
+        self.assertLess(len(keep), n)
+        self.assertEqual(sorted(keep),keep)
+
+    def test_small(self) -> None:
+        for n in range(3):
+            points = make_points([41.0]*n, [-73.0]*n)
+            for method in simplify.METHODS:
+                self.assertEqual(n,len(simplify.simplify(points, 10, method)))
+        # repeated points
+        points = make_points([41.0]*10, [-73.0]*10)
+        for method in simplify.METHODS:
+            self.assertEqual(2,len(simplify.simplify(points, 10, method)))
+        self.assertRaises(Exception, lambda: simplify.simplify(points, 10, "bogus"))
+
+    def test_document(self) -> None:
+        doc = gpxread.read('doc/SunkMineRoad.gpx')
+        points = doc.tracks[0].segs[0].points
+        dropped = simplify.simplify_document(doc, 5)
+        self.assertEqual(len(points),dropped+len(doc.tracks[0].segs[0].points))
+        self.assertGreater(dropped,len(points)//2)
+        # the points that are kept are unchanged
+        self.assertTrue(set(doc.tracks[0].segs[0].points.columns()[0]) <= set(points.columns()[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import asyncio
+import time
+from serial import Serial
+import rattlebox.aio as aio
+import rattlebox.locus as locus
+import rattlebox.mt3339 as mt3339
+import rattlebox.nmea as nmea
+import rattlebox.reader as reader
+import rattlebox.simulator as simulator
+
+def run_command(driver:mt3339.Driver, rdr:reader.Reader, cmd:str, timeout:float = 5) -> None:
+    driver.send_command(cmd)
+    deadline = time.monotonic() + timeout
+    while driver.is_command_active():
+        if time.monotonic() > deadline:
+            raise Exception(f"command timed out: {cmd}")
+        driver.recv_messages(rdr.get_batch(timeout=0.1))
+
+class SimulatorTest(unittest.TestCase):
+    def test_make_log(self) -> None:
+        log = simulator.make_log(100, start_ts=1597180000, interval=15)
+        recs = locus.decode(log)
+        self.assertEqual(100,len(recs))
+        self.assertEqual(0,recs.bad_checksum)
+        self.assertEqual(1597180000+99*15,recs.ts[-1])
+
+    def test_dump(self) -> None:
+        # a partial last chunk, too
+        sim = simulator.Simulator(simulator.make_log(1000), rate=0)
+        port = simulator.SimPort(sim, timeout=1)
+        driver = mt3339.Driver(port, show_prog=False)
+        with reader.Reader(port) as rdr:
+            run_command(driver, rdr, "logger-dump")
+        self.assertEqual(1000,len(driver.log_points))
+        self.assertEqual(list(locus.decode(bytes(sim.log)).ts),list(driver.log_points.columns()[0]))
+        self.assertEqual([],driver.missing_chunks())
+
+    def test_commands(self) -> None:
+        sim = simulator.Simulator(simulator.make_log(10), rate=0)
+        sim.write(simulator.sentence("PMTK183"))
+        sim.write(simulator.sentence("PMTK185,0")[:5])
+        sim.write(simulator.sentence("PMTK185,0")[5:])
+        sim.write(simulator.sentence("PMTK999"))
+        sim.write(simulator.sentence("PMTK314,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0"))
+        sim.write(b"$PMTK184,1*00\r\n") # bad checksum: ignored
+        sim.write(simulator.sentence("PMTK184,1"))
+        sentences, rest = nmea.parse_many(sim.read(4096))
+        self.assertEqual(b'',rest)
+        self.assertEqual([
+            ["$PMTKLOG","1","0","8","1","15","0","0","1","10","0"],
+            ["$PMTK001","183","3"],
+            ["$PMTK001","185","3"],
+            ["$PMTK001","999","1"],
+            ["$PMTK001","314","3"],
+            ["$PMTK001","184","3"],
+        ],[ fields for _,fields in sentences ])
+        self.assertTrue(sim.logging)
+        self.assertEqual([0]*6,sim.outputs)
+        self.assertEqual(0,len(sim.log))
+
+    def test_logging(self) -> None:
+        t = [0.0]
+        sim = simulator.Simulator(rate=1, log_interval=15, clock=lambda: t[0])
+        sim.write(simulator.sentence("PMTK185,0"))
+        t[0] = 60
+        sim.update()
+        self.assertEqual(5,len(locus.decode(bytes(sim.log))))
+
+    def test_nmea(self) -> None:
+        sim = simulator.Simulator(rate=20)
+        port = simulator.SimPort(sim, timeout=1)
+        driver = mt3339.Driver(port, show_prog=False)
+        with reader.Reader(port) as rdr:
+            start = time.monotonic()
+            while driver.fix is None or driver.fix.ts < sim.start_ts + 1:
+                self.assertLess(time.monotonic()-start, 5)
+                driver.recv_messages(rdr.get_batch(timeout=0.1))
+        fix = driver.fix
+        self.assertEqual(sim.start_ts+1,fix.ts)
+        lat, lon, ele = sim.track.position(1)
+        self.assertAlmostEqual(lat,fix.lat,5)
+        self.assertAlmostEqual(lon,fix.lon,5)
+        self.assertAlmostEqual(ele,fix.ele,1)
+        self.assertAlmostEqual(sim.track.speed,fix.speed,2)
+        self.assertEqual((1,3,8,8),(fix.quality,fix.mode,fix.sats,fix.sats_in_view))
+
+    def test_faults(self) -> None:
+        faults = simulator.Faults(drop=0.1, corrupt=0.1)
+        sim = simulator.Simulator(simulator.make_log(600), rate=0, faults=faults)
+        sim.write(simulator.sentence("PMTK622,1"))
+        sentences, _ = nmea.parse_many(sim.read(1 << 20))
+        statuses = [ status for status,_ in sentences ]
+        self.assertEqual(sim.stats.corrupted,statuses.count(nmea.BAD_CHECKSUM))
+        self.assertEqual(sim.stats.lines,len(sentences))
+        self.assertGreater(sim.stats.dropped,0)
+        self.assertEqual(100+3,sim.stats.lines+sim.stats.dropped)
+
+    def test_stall(self) -> None:
+        t = [0.0]
+        faults = simulator.Faults(stall=1, stall_time=2)
+        sim = simulator.Simulator(rate=0, faults=faults, clock=lambda: t[0])
+        sim.write(simulator.sentence("PMTK000"))
+        self.assertEqual(b'',sim.read(100))
+        self.assertEqual(2,sim.next_due())
+        t[0] = 2
+        self.assertEqual(simulator.sentence("PMTK001,0,3"),sim.read(100))
+
+    def test_baud(self) -> None:
+        sim = simulator.Simulator(rate=0)
+        port = simulator.SimPort(sim, baudrate=9600, timeout=0.1)
+        driver = mt3339.Driver(port, show_prog=False)
+        driver.send_command("baud-115200")
+        self.assertEqual(115200,sim.baudrate)
+        # can't talk to the device until the port is switched, too
+        port.write(simulator.sentence("PMTK000"))
+        self.assertEqual(b'',port.read(100))
+        port.baudrate = 115200
+        port.write(simulator.sentence("PMTK000"))
+        self.assertEqual(simulator.sentence("PMTK001,0,3"),port.read(100))
+
+    def test_realtime(self) -> None:
+        sim = simulator.Simulator(simulator.make_log(60), rate=0)
+        port = simulator.SimPort(sim, baudrate=9600, timeout=1, realtime=True)
+        port.write(simulator.sentence("PMTK622,1"))
+        start = time.monotonic()
+        n = 0
+        while n < 960:
+            n += len(port.read(4096))
+        # 960 bytes at 960 bytes/s
+        self.assertGreater(time.monotonic()-start, 0.9)
+
+    def test_pty(self) -> None:
+        sim = simulator.Simulator(simulator.make_log(100), rate=0)
+        with simulator.PtyServer(sim) as server:
+            port = Serial(server.name, 9600, timeout=1)
+            driver = mt3339.Driver(port, show_prog=False)
+            with reader.Reader(port) as rdr:
+                run_command(driver, rdr, "logger-dump")
+            port.close()
+        self.assertEqual(100,len(driver.log_points))
+
+class SimTransportTest(unittest.IsolatedAsyncioTestCase):
+    async def test_dump(self) -> None:
+        sim = simulator.Simulator(simulator.make_log(500), rate=10)
+        async with aio.AsyncDriver(simulator.SimTransport(sim)) as drv:
+            await asyncio.wait_for(drv.command("logger-dump"),5)
+            self.assertEqual(500,len(drv.driver.log_points))
+            pt = await asyncio.wait_for(anext(drv.fixes()),5)
+            self.assertEqual(41,int(pt.lat))
+
+if __name__ == '__main__':
+    unittest.main()